@@ -13,29 +13,94 @@ endif
 if !exists("g:pyTestLastTest")
   let g:pyTestLastTest = ""
 endif
+if !exists("g:pyTestRunnerBuiltinTags")
+  let g:pyTestRunnerBuiltinTags = 1
+endif
+if !exists("g:pyTestRunnerUseJobs")
+  let g:pyTestRunnerUseJobs = has("job") || has("nvim")
+endif
+if !exists("g:pyTestRunnerStatus")
+  let g:pyTestRunnerStatus = ""
+endif
+if !exists("g:pyTestRunnerRecordCoverage")
+  let g:pyTestRunnerRecordCoverage = 0
+endif
+if !exists("g:pyTestRunnerResultCache")
+  let g:pyTestRunnerResultCache = 0
+endif
+if !exists("g:pyTestRunnerProfile")
+  let g:pyTestRunnerProfile = 0
+endif
+if !exists("g:pyTestRunnerWatchDelay")
+  let g:pyTestRunnerWatchDelay = 300
+endif
+if !exists("g:pyTestRunnerSchedule")
+  let g:pyTestRunnerSchedule = 0
+endif
+if !exists("g:pyTestRunnerRecordDurations")
+  " Scheduling is no use without them
+  let g:pyTestRunnerRecordDurations = g:pyTestRunnerSchedule
+endif
+if !exists("g:pyTestRunnerFailFast")
+  let g:pyTestRunnerFailFast = 0
+endif
+if !exists("g:pyTestLastScope")
+  let g:pyTestLastScope = []
+endif
+
+let s:job_states = []
+let s:job_id = 0
+let s:watch_timer = -1
 
 function pytestrunner#use(runner, ...)
   let g:pyTestRunner = a:runner
   let g:pyTestRunnerCommand = join(a:000, " ")
 endf
 
+function pytestrunner#reload_config()
+  pyx import py_test_runner
+  pyx py_test_runner.reload_config()
+endf
+
+function pytestrunner#prewarm(...)
+  " Imports py_test_runner and reads the configuration ahead of the first
+  " test run; called from a timer (see plugin/py-test-runner.vim)
+  pyx import py_test_runner, vim
+  pyx py_test_runner.prewarm(vim.current.buffer.name)
+endf
+
+function pytestrunner#cache_stats()
+  pyx import py_test_runner
+  return pyxeval("py_test_runner.get_cache_stats()")
+endf
+
 function pytestrunner#get_run_command()
   if g:pyVimRunCommand != ""
     return g:pyVimRunCommand
   elseif exists(":Make")
     return "Make"
+  elseif g:pyTestRunnerUseJobs
+    return ""
   else
     return "make"
   endif
 endf
 
-function pytestrunner#get_test_command()
+function pytestrunner#get_test_command(...)
+  " Optional arguments: use the coverage_command; stop at the first failure
+  " (defaults to g:pyTestRunnerFailFast); report test durations
+  let l:coverage = a:0 && a:1
+  let l:fail_fast = a:0 > 1 ? a:2 : g:pyTestRunnerFailFast
+  let l:durations = a:0 > 2 && a:3
   pyx import py_test_runner, vim
-  return pyxeval("py_test_runner.get_test_command(vim.current.buffer.name)")
+  return pyxeval("py_test_runner.get_test_command(vim.current.buffer.name, bool(int(vim.eval('l:coverage'))), bool(int(vim.eval('l:fail_fast'))), bool(int(vim.eval('l:durations'))))")
 endf
 
 function pytestrunner#get_tag_under_cursor()
-  if exists("*taghelper#curtag()")
+  if g:pyTestRunnerBuiltinTags && &filetype == "python"
+    pyx import py_test_runner, vim
+    return pyxeval("py_test_runner.get_tag_under_cursor()")
+  elseif exists("*taghelper#curtag()")
     " defined by https://github.com/mgedmin/taghelper.vim
     return taghelper#curtag()
   elseif exists("*TagInStatusLine")
@@ -57,41 +122,551 @@ function pytestrunner#get_test_from_tag(tag)
   return pyxeval("py_test_runner.get_test(vim.current.buffer.name, vim.eval('a:tag'))")
 endf
 
+function pytestrunner#get_tests(tags)
+  " Command-line arguments for running all the tests in a list of tags of
+  " the current file
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_tests(vim.current.buffer.name, vim.eval('a:tags'))")
+endf
+
+function pytestrunner#get_output_format()
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_output_format(vim.current.buffer.name)")
+endf
+
+function pytestrunner#get_failed_tests()
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_failed_tests(vim.current.buffer.name)")
+endf
+
+function pytestrunner#get_test_shards(test)
+  " test is a [filename, tag] pair
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_test_shards(*vim.eval('a:test'), schedule=bool(int(vim.eval('g:pyTestRunnerSchedule'))))")
+endf
+
+function pytestrunner#get_scheduled_tests(test)
+  " test is a [filename, tag] pair
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_scheduled_tests(*vim.eval('a:test'))")
+endf
+
+function pytestrunner#get_tests_covering_cursor()
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_tests_covering_cursor()")
+endf
+
+function pytestrunner#complete_test(arglead, cmdline, cursorpos)
+  " Completion for :RunTest
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.complete_test(vim.current.buffer.name, vim.eval('a:arglead'))")
+endf
+
+function pytestrunner#find_tests(pattern)
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.find_tests(vim.current.buffer.name, vim.eval('a:pattern'))")
+endf
+
+function pytestrunner#complete_project_test(arglead, cmdline, cursorpos)
+  " Completion for :RunMatchingTests
+  return pytestrunner#find_tests(a:arglead).names
+endf
+
+function pytestrunner#get_tests_in_range(first, last)
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_tests_in_range(int(vim.eval('a:first')), int(vim.eval('a:last')))")
+endf
+
+function pytestrunner#get_quickfix_tests()
+  let l:locations = []
+  let l:tests = []
+  for l:item in getqflist()
+    if !l:item.valid || !l:item.bufnr
+      continue
+    endif
+    " Failures we parsed know their test, even if they point at a helper
+    let l:test = get(l:item, "user_data", "")
+    if type(l:test) == v:t_dict && has_key(l:test, "test_file")
+      call add(l:tests, [l:test.test_file, l:test.tag])
+    else
+      call add(l:locations, [fnamemodify(bufname(l:item.bufnr), ":p"),
+            \                l:item.lnum])
+    endif
+  endfor
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_tests_at_lines(vim.current.buffer.name, vim.eval('l:locations'), vim.eval('l:tests'))")
+endf
+
+function pytestrunner#get_affected_tests()
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_affected_tests(vim.current.buffer.name)")
+endf
+
+function pytestrunner#get_cached_result(command, scope)
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_cached_result(vim.current.buffer.name, vim.eval('a:command'), vim.eval('a:scope'))")
+endf
+
+function pytestrunner#get_slow_tests(count)
+  let tag = pytestrunner#get_tag_under_cursor()
+  pyx import py_test_runner, vim
+  return pyxeval("py_test_runner.get_slow_tests(vim.current.buffer.name, vim.eval('l:tag'), int(vim.eval('a:count')))")
+endf
+
 function pytestrunner#get_clipboard_command()
   let tag = pytestrunner#get_tag_under_cursor()
   pyx import py_test_runner, vim
   return pyxeval("py_test_runner.get_clipboard_command(vim.current.buffer.name, vim.eval('l:tag'))")
 endf
 
-function pytestrunner#run(test)
+function s:set_status(status)
+  let g:pyTestRunnerStatus = a:status
+  let l:group = {
+        \ "running": "StatusLineRunning",
+        \ "success": "StatusLineSuccess",
+        \ "failure": "StatusLineFailure",
+        \ "stopped": "StatusLineNeutral",
+        \ }[a:status]
+  if hlexists(l:group)
+    exec "hi! link StatusLine" l:group
+    redrawstatus!
+  endif
+endf
+
+function s:job_running(job)
+  if has("nvim")
+    return a:job > 0 && jobwait([a:job], 0)[0] == -1
+  else
+    return type(a:job) == v:t_job && job_status(a:job) == "run"
+  endif
+endf
+
+function pytestrunner#stop_job()
+  let l:running = 0
+  for l:state in s:job_states
+    call s:stop_output_parser(l:state, 0)
+    if s:job_running(l:state.job)
+      let l:running = 1
+      if has("nvim")
+        call jobstop(l:state.job)
+      else
+        call job_stop(l:state.job, "kill")
+      endif
+    endif
+  endfor
+  if l:running
+    " Make sure callbacks from the old jobs get ignored
+    let s:job_id += 1
+    call s:set_status("stopped")
+    echo "Test run stopped"
+  endif
+  let s:job_states = []
+endf
+
+function pytestrunner#start_job(command, ...)
+  " Optional arguments: output format for py_test_runner's output parsers,
+  " otherwise the output is parsed with 'errorformat'; the [filename, tag]
+  " pairs of the tests being run, for remembering which tests failed
+  call pytestrunner#start_jobs([a:command], a:0 ? a:1 : "",
+        \                      [a:0 > 1 ? a:2 : []])
+endf
+
+function pytestrunner#start_jobs(commands, format, scopes, ...)
+  " Runs several commands in parallel, collecting their output in one
+  " quickfix list; scopes has the [filename, tag] pairs for each command.
+  " Optional argument: a dictionary of options
+  "   coverage -- the commands record coverage
+  "   cache_key -- store the output in the result cache under this key
+  let l:options = a:0 ? a:1 : {}
+  let l:coverage = get(l:options, "coverage", 0)
+  let l:cache_key = get(l:options, "cache_key", "")
+  call pytestrunner#stop_job()
+  let s:job_id += 1
+  let l:run = {"id": s:job_id, "pending": len(a:commands), "success": 1,
+        \ "title": join(a:commands, " & "), "started": reltime(),
+        \ "launch": 0.0}
+  call setqflist([], " ", {"title": l:run.title})
+  let l:qfid = getqflist({"id": 0}).id
+  for l:i in range(len(a:commands))
+    let l:state = {"id": s:job_id, "run": l:run, "exit_status": -1,
+          \ "closed": 0, "partial": {}, "efm": &errorformat, "parser": 0,
+          \ "qfid": l:qfid, "job": 0}
+    if a:format != ""
+      let l:scope = a:scopes[l:i]
+      pyx import py_test_runner, vim
+      let l:state.parser = pyxeval("py_test_runner.start_output_parser(vim.eval('a:format'), vim.current.buffer.name, vim.eval('l:scope'), bool(int(vim.eval('l:coverage'))), vim.eval('l:cache_key'))")
+    endif
+    call add(s:job_states, l:state)
+    let l:argv = [&shell, &shellcmdflag, a:commands[l:i]]
+    let l:launch = reltime()
+    if has("nvim")
+      let l:state.job = jobstart(l:argv, {
+            \ "on_stdout": function("s:nvim_on_output", [l:state]),
+            \ "on_stderr": function("s:nvim_on_output", [l:state]),
+            \ "on_exit": function("s:nvim_on_exit", [l:state]),
+            \ })
+    else
+      let l:state.job = job_start(l:argv, {
+            \ "mode": "nl",
+            \ "in_io": "null",
+            \ "out_cb": function("s:vim_on_output", [l:state]),
+            \ "err_cb": function("s:vim_on_output", [l:state]),
+            \ "close_cb": function("s:vim_on_close", [l:state]),
+            \ "exit_cb": function("s:vim_on_exit", [l:state]),
+            \ })
+    endif
+    let l:run.launch += reltimefloat(reltime(l:launch))
+  endfor
+  call s:set_status("running")
+endf
+
+function s:add_output(state, lines)
+  if a:state.id != s:job_id || empty(a:lines)
+    return
+  endif
+  if a:state.parser
+    let l:items = pyxeval("py_test_runner.parse_output(int(vim.eval('a:state.parser')), vim.eval('a:lines'))")
+    call setqflist([], "a", {"id": a:state.qfid, "items": l:items})
+    " The test runner stops by itself (see fail_fast_flag), but when it
+    " reports failures as they happen this also stops the other shards.
+    if g:pyTestRunnerFailFast
+          \ && !empty(filter(l:items, 'get(v:val, "type", "") == "E"'))
+      call s:stop_at_failure()
+    endif
+  else
+    call setqflist([], "a", {"id": a:state.qfid, "lines": a:lines,
+          \                  "efm": a:state.efm})
+  endif
+endf
+
+function s:stop_at_failure()
+  " For g:pyTestRunnerFailFast
+  call pytestrunner#stop_job()
+  call s:set_status("failure")
+  echo "Tests failed (stopped at the first failure)"
+endf
+
+function s:stop_output_parser(state, completed)
+  if a:state.parser
+    let l:items = pyxeval("py_test_runner.stop_output_parser(int(vim.eval('a:state.parser')), bool(int(vim.eval('a:completed'))), int(vim.eval('a:state.exit_status')))")
+    let a:state.parser = 0
+    if a:state.id == s:job_id && !empty(l:items)
+      call setqflist([], "a", {"id": a:state.qfid, "items": l:items})
+    endif
+  endif
+endf
+
+function s:finish(state)
+  if a:state.id != s:job_id
+    return
+  endif
+  call s:stop_output_parser(a:state, 1)
+  let a:state.job = 0
+  let l:run = a:state.run
+  let l:run.pending -= 1
+  if a:state.exit_status != 0
+    let l:run.success = 0
+  endif
+  if l:run.pending == 0
+    let s:job_states = []
+    if g:pyTestRunnerProfile
+      call s:end_profiled_run(l:run.title, {"launch": l:run.launch,
+            \ "process": reltimefloat(reltime(l:run.started))})
+    endif
+    call s:set_status(l:run.success ? "success" : "failure")
+    echo "Tests" (l:run.success ? "passed" : "failed")
+  endif
+endf
+
+function s:replay_result(title, result)
+  call pytestrunner#stop_job()
+  call setqflist([], " ", {"title": a:title . " (cached)",
+        \                  "items": a:result.items})
+  let l:success = a:result.exit_status == 0
+  call s:set_status(l:success ? "success" : "failure")
+  echo "Tests" (l:success ? "passed" : "failed") "(cached result)"
+endf
+
+function s:end_profiled_run(command, spans)
+  pyx import py_test_runner, vim
+  pyx py_test_runner.end_profiled_run(vim.eval('a:command'), vim.eval('a:spans'))
+endf
+
+function s:vim_on_output(state, channel, msg)
+  call s:add_output(a:state, [a:msg])
+endf
+
+function s:vim_on_close(state, channel)
+  " exit_cb can be called before all the output is read
+  let a:state.closed = 1
+  if a:state.exit_status != -1
+    call s:finish(a:state)
+  endif
+endf
+
+function s:vim_on_exit(state, job, exit_status)
+  let a:state.exit_status = a:exit_status
+  if a:state.closed
+    call s:finish(a:state)
+  endif
+endf
+
+function s:nvim_on_output(state, job, data, event)
+  " Neovim delivers chunks: the first item continues the last partial line,
+  " and the last item is an incomplete line (or "" at a line boundary)
+  let l:lines = copy(a:data)
+  let l:lines[0] = get(a:state.partial, a:event, "") . l:lines[0]
+  let a:state.partial[a:event] = remove(l:lines, -1)
+  call s:add_output(a:state, l:lines)
+endf
+
+function s:nvim_on_exit(state, job, exit_status, event)
+  call s:add_output(a:state, filter(values(a:state.partial), 'v:val != ""'))
+  let a:state.exit_status = a:exit_status
+  call s:finish(a:state)
+endf
+
+function pytestrunner#run(test, ...)
+  " Optional arguments: a list of [filename, tag] pairs describing the tests
+  " that will be run ("" matches everything); ignore the result cache and
+  " run the tests even if nothing changed
   if a:test != ""
     silent! wall
+    let g:pyTestLastTest = a:test
+    let g:pyTestLastScope = a:0 ? a:1 : []
+    let l:force = a:0 > 1 && a:2
+    if pytestrunner#get_run_command() == ""
+      let l:coverage = g:pyTestRunnerRecordCoverage
+      let l:command = pytestrunner#get_test_command(l:coverage,
+            \ g:pyTestRunnerFailFast, g:pyTestRunnerRecordDurations)
+      let l:cache_key = ""
+      if g:pyTestRunnerResultCache && !l:coverage
+        let l:cached = pytestrunner#get_cached_result(
+              \ l:command . " " . a:test, g:pyTestLastScope)
+        if !l:force && !empty(l:cached.result)
+          call s:replay_result(l:command . " " . a:test, l:cached.result)
+          return
+        endif
+        let l:cache_key = l:cached.key
+      endif
+      let l:shards = len(g:pyTestLastScope) == 1
+            \ ? pytestrunner#get_test_shards(g:pyTestLastScope[0]) : []
+      if len(l:shards) > 1
+        echo l:command a:test "(in" len(l:shards) "shards)"
+        call pytestrunner#start_jobs(
+              \ map(copy(l:shards), 'l:command . " " . v:val.filter'),
+              \ pytestrunner#get_output_format(),
+              \ map(copy(l:shards), 'v:val.scope'), {"coverage": l:coverage})
+        return
+      endif
+      let l:scheduled = g:pyTestRunnerSchedule && len(g:pyTestLastScope) == 1
+            \ ? pytestrunner#get_scheduled_tests(g:pyTestLastScope[0]) : {}
+      if !empty(l:scheduled)
+        echo l:command a:test "(likely failures first)"
+        call pytestrunner#start_jobs([l:command . " " . l:scheduled.filter],
+              \                      pytestrunner#get_output_format(),
+              \                      [l:scheduled.scope],
+              \                      {"coverage": l:coverage,
+              \                       "cache_key": l:cache_key})
+        return
+      endif
+      echo l:command a:test
+      call pytestrunner#start_jobs([l:command . " " . a:test],
+            \                      pytestrunner#get_output_format(),
+            \                      [g:pyTestLastScope],
+            \                      {"coverage": l:coverage,
+            \                       "cache_key": l:cache_key})
+      return
+    endif
+    let l:command = pytestrunner#get_test_command()
+    echo l:command a:test
     if hlexists("StatusLineRunning")
       hi! link StatusLine StatusLineRunning
     endif
-    let g:pyTestLastTest = a:test
     let l:oldmakeprg = &makeprg
-    let l:command = pytestrunner#get_test_command()
-    echo l:command a:test
+    let l:started = reltime()
     try
       let &makeprg = l:command
       exec pytestrunner#get_run_command() a:test
     finally
       let &makeprg = l:oldmakeprg
     endtry
+    if g:pyTestRunnerProfile
+      call s:end_profiled_run(l:command . " " . a:test,
+            \ {"process": reltimefloat(reltime(l:started))})
+    endif
   endif
 endf
 
-function pytestrunner#run_test_under_cursor()
-  call pytestrunner#run(pytestrunner#get_test_under_cursor())
+" The optional argument of the run_* functions means: run the tests even if
+" the result cache has their output (i.e. the command was used with a !)
+
+function pytestrunner#run_test_under_cursor(...)
+  let l:tag = pytestrunner#get_tag_under_cursor()
+  call pytestrunner#run(pytestrunner#get_test_from_tag(l:tag),
+        \               [[bufname("%"), l:tag]], a:0 && a:1)
+endf
+
+function pytestrunner#run_test(tag, ...)
+  call pytestrunner#run(pytestrunner#get_test_from_tag(a:tag),
+        \               [[bufname("%"), a:tag]], a:0 && a:1)
 endf
 
-function pytestrunner#run_test(tag)
-  call pytestrunner#run(pytestrunner#get_test_from_tag(a:tag))
+function pytestrunner#run_last_test_again(...)
+  call pytestrunner#run(g:pyTestLastTest, g:pyTestLastScope, a:0 && a:1)
 endf
 
-function pytestrunner#run_last_test_again()
-  call pytestrunner#run(g:pyTestLastTest)
+function pytestrunner#run_failed_tests(...)
+  let l:failed = pytestrunner#get_failed_tests()
+  if l:failed.filter == ""
+    echo "No failed tests"
+    return
+  endif
+  call pytestrunner#run(l:failed.filter, l:failed.scope, a:0 && a:1)
+endf
+
+function pytestrunner#run_affected_tests(...)
+  " The import graph is built from the files on disk
+  silent! wall
+  let l:affected = pytestrunner#get_affected_tests()
+  if !l:affected.snapshot
+    echo "Saved a snapshot of the project, next time this will run the tests affected by your changes"
+  elseif l:affected.filter == ""
+    echo "No tests affected by changes in" len(l:affected.changed) "files"
+  else
+    call pytestrunner#run(l:affected.filter, l:affected.scope, a:0 && a:1)
+  endif
+endf
+
+function pytestrunner#run_tests_covering_cursor(...)
+  let l:covering = pytestrunner#get_tests_covering_cursor()
+  if l:covering.filter == ""
+    echo "No recorded tests cover this code (see :RecordCoverage)"
+    return
+  endif
+  call pytestrunner#run(l:covering.filter, l:covering.scope, a:0 && a:1)
+endf
+
+function pytestrunner#run_tests_in_range(first, last, ...)
+  let l:tests = pytestrunner#get_tests_in_range(a:first, a:last)
+  if l:tests.filter == ""
+    echo "No tests in lines" a:first "to" a:last
+    return
+  endif
+  call pytestrunner#run(l:tests.filter, l:tests.scope, a:0 && a:1)
+endf
+
+function pytestrunner#run_matching_tests(pattern, ...)
+  " The test index is built from the files on disk
+  silent! wall
+  let l:tests = pytestrunner#find_tests(a:pattern)
+  if l:tests.filter == ""
+    echo "No tests match" a:pattern
+    return
+  endif
+  call pytestrunner#run(l:tests.filter, l:tests.scope, a:0 && a:1)
+endf
+
+function pytestrunner#run_quickfix_tests(...)
+  " The test files are read from disk
+  silent! wall
+  let l:tests = pytestrunner#get_quickfix_tests()
+  if l:tests.filter == ""
+    echo "No tests in the quickfix list"
+    return
+  endif
+  call pytestrunner#run(l:tests.filter, l:tests.scope, a:0 && a:1)
+endf
+
+function pytestrunner#toggle_watch()
+  " Reruns the last test every time a file is saved
+  if exists("#PyTestWatch#BufWritePost")
+    autocmd! PyTestWatch
+    call s:stop_watch_timer()
+    echo "No longer rerunning the tests on save"
+    return
+  endif
+  if pytestrunner#get_run_command() != ""
+    echo "Watching needs Vim with job support"
+    return
+  endif
+  if g:pyTestLastTest == ""
+    echo "Run a test first"
+    return
+  endif
+  pyx import py_test_runner, vim
+  pyx py_test_runner.watch_files([b.name for b in vim.buffers if b.name])
+  augroup PyTestWatch
+    autocmd!
+    autocmd BufWritePost * call s:on_write(expand("<afile>:p"))
+  augroup END
+  echo "Rerunning" g:pyTestLastTest "every time you save a file"
+endf
+
+function s:stop_watch_timer()
+  if s:watch_timer != -1
+    call timer_stop(s:watch_timer)
+    let s:watch_timer = -1
+  endif
+endf
+
+function s:on_write(filename)
+  if !pyxeval("py_test_runner.file_changed(vim.eval('a:filename'))")
+    return
+  endif
+  " The test run in progress is testing old code
+  call pytestrunner#stop_job()
+  " Wait for the writes to stop (e.g. :wall) before running the tests
+  call s:stop_watch_timer()
+  let s:watch_timer = timer_start(g:pyTestRunnerWatchDelay,
+        \                         function("s:watch_run"))
+endf
+
+function s:watch_run(timer)
+  let s:watch_timer = -1
+  call pytestrunner#run_last_test_again()
+endf
+
+function pytestrunner#record_coverage()
+  " Runs all the tests with coverage, to find out which tests cover
+  " which code
+  if pytestrunner#get_run_command() != ""
+    echo "Recording coverage needs Vim with job support"
+    return
+  endif
+  silent! wall
+  let l:command = pytestrunner#get_test_command(1, 0,
+        \ g:pyTestRunnerRecordDurations)
+  echo l:command
+  call pytestrunner#start_jobs([l:command], pytestrunner#get_output_format(),
+        \                      [[["", ""]]], {"coverage": 1})
+endf
+
+function pytestrunner#show_slow_tests(count)
+  let l:tests = pytestrunner#get_slow_tests(a:count == "" ? 10 : a:count)
+  if empty(l:tests)
+    echo "No test durations recorded"
+  else
+    echo join(l:tests, "\n")
+  endif
+endf
+
+function pytestrunner#show_profile(filename)
+  " Shows where the time went in the last few test runs, or saves that as
+  " JSON
+  pyx import py_test_runner, vim
+  if a:filename != ""
+    pyx py_test_runner.save_profile(vim.eval('a:filename'))
+    echo "Saved the profile to" a:filename
+    return
+  endif
+  let l:lines = pyxeval("py_test_runner.get_profile()")
+  if empty(l:lines)
+    echo g:pyTestRunnerProfile ? "No test runs profiled yet"
+          \ : "Profiling is disabled (see g:pyTestRunnerProfile)"
+  else
+    echo join(l:lines, "\n")
+  endif
 endf
 
 function pytestrunner#copy_test_under_cursor()
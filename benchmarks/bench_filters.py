@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Benchmark the code that runs every time you run a test from Vim: finding
+the configuration for a file, looking at its package, and building the
+command-line filter.
+
+Synthetic config files have 10, 100 or 1000 [path:...] sections, and
+synthetic projects have packages nested 1, 3 or 6 deep.  For each entry
+point this reports the time per call and how many filesystem calls (stat,
+listdir, open) one call makes.  The same calls are timed with the code of
+an older revision (by default the one before any of the caches) in the
+same run, so the comparison doesn't depend on how fast the machine is.
+The numbers of filesystem calls don't, so they are compared with the ones
+in baseline.json.
+
+Exits with status 1 if anything got slower than the older revision by
+more than the threshold (50% by default: a few calls are up to 20% slower
+because of the profiling hooks, and timings of single calls vary by about
+10% from run to run), or makes more filesystem calls than baseline.json
+says it should.
+"""
+
+import argparse
+import builtins
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from contextlib import contextmanager
+from functools import partial
+
+from import_time import BASELINE_REVISION, ROOT, checkout
+
+sys.path.insert(0, os.path.join(ROOT, 'pythonx'))
+
+import py_test_runner  # noqa: E402
+
+
+# Filesystem calls per call of each benchmark.
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+SECTIONS = [10, 100, 1000]
+DEPTHS = [1, 3, 6]
+
+# Functions that hit the filesystem, and the modules they're looked up in.
+FS_CALLS = [(os, 'stat'), (os, 'lstat'), (os, 'listdir'), (os, 'scandir'),
+            (builtins, 'open')]
+
+
+class FakeVim(object):
+    """Just enough of Vim's Python interface for get_test_runner()."""
+
+    def __init__(self, config_file):
+        self.variables = {
+            'g:pyTestRunnerConfigFile': config_file,
+            'g:pyTestRunner': '',
+            'g:pyTestRunnerCommand': '',
+            'g:pyTestRunnerProfile': '0',
+        }
+
+    def eval(self, expr):
+        return self.variables[expr]
+
+
+@contextmanager
+def count_fs_calls():
+    counts = []
+    originals = [(module, name, getattr(module, name))
+                 for module, name in FS_CALLS]
+
+    def wrap(fn):
+        def wrapper(*args, **kw):
+            counts.append(fn.__name__)
+            return fn(*args, **kw)
+        return wrapper
+
+    for module, name, fn in originals:
+        setattr(module, name, wrap(fn))
+    try:
+        yield counts
+    finally:
+        for module, name, fn in originals:
+            setattr(module, name, fn)
+
+
+def make_config(dirname, sections, project):
+    # Most sections are for other projects; the last few match ours.
+    filename = os.path.join(dirname, 'py-test-runner-%d.cfg' % sections)
+    with open(filename, 'w') as f:
+        f.write('[default]\nrunner = pytest\n\n')
+        for n in range(sections - 2):
+            f.write('[path:%s/other%d/src]\nrunner = zope\n'
+                    'workdir = %s/other%d\n\n' % (dirname, n, dirname, n))
+        f.write('[path:%s]\nnamespace_packages = yes\n\n' % project)
+        f.write('[path:%s/src]\ncommand = pytest -ra -x\n\n' % project)
+    return filename
+
+
+def make_project(dirname, depth):
+    # project/src/pkg1/pkg2/.../test_mod.py
+    root = os.path.join(dirname, 'project%d' % depth)
+    os.makedirs(root)
+    with open(os.path.join(root, 'setup.py'), 'w'):
+        pass
+    path = os.path.join(root, 'src')
+    for n in range(depth):
+        path = os.path.join(path, 'pkg%d' % (n + 1))
+        os.makedirs(path)
+        with open(os.path.join(path, '__init__.py'), 'w'):
+            pass
+    filename = os.path.join(path, 'test_mod.py')
+    with open(filename, 'w') as f:
+        f.write('class TestFoo:\n    def test_bar(self):\n        pass\n')
+    return filename
+
+
+def make_files(dirname):
+    # Returns (test file, {sections: config file}, {depth: test file}).
+    filename = make_project(dirname, 3)
+    project = os.path.dirname(filename)
+    config_files = {sections: make_config(dirname, sections, project)
+                    for sections in SECTIONS}
+    nested = {depth: make_project(os.path.join(dirname, 'd'), depth)
+              for depth in DEPTHS}
+    return filename, config_files, nested
+
+
+def load_module(dirname):
+    # Imports py_test_runner.py from another directory under another name,
+    # so that both versions can be used side by side.
+    spec = importlib.util.spec_from_file_location(
+        'py_test_runner_old', os.path.join(dirname, 'py_test_runner.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def resolve_test_runner(module, config_file, filename, runner):
+    # Older versions have no cache, and so no resolve_test_runner().
+    if hasattr(module, 'resolve_test_runner'):
+        return module.resolve_test_runner(config_file, filename, runner, '')
+    r = module.PyTestRunner(config_file)
+    if runner:
+        r.use_runner(runner)
+    return r.get_runner(filename)
+
+
+def get_benchmarks(module, files):
+    # Yields (name, function) pairs; the function is None if the module
+    # doesn't have what the benchmark measures.
+    filename, config_files, nested = files
+    for sections in SECTIONS:
+        config_file = config_files[sections]
+        vim = FakeVim(config_file)
+        runner = module.PyTestRunner(config_file)
+
+        def get_test_runner(vim=vim):
+            module.vim = vim
+            return module.get_test_runner(filename)
+
+        def find_overrides(runner=runner):
+            # Older versions return a generator.
+            return list(runner.find_overrides(filename))
+
+        def load_configuration(config_file=config_file):
+            return module.PyTestRunner.load_configuration(config_file)
+
+        suffix = '[sections=%d]' % sections
+        yield 'get_test_runner' + suffix, get_test_runner
+        yield 'resolve_test_runner' + suffix, partial(
+            resolve_test_runner, module, config_file, filename, '')
+        yield 'find_overrides' + suffix, find_overrides
+        yield 'load_configuration' + suffix, load_configuration
+
+    config_file = config_files[SECTIONS[0]]
+    for depth in DEPTHS:
+        filename = nested[depth]
+        rc = resolve_test_runner(module, config_file, filename, '')
+        # zope's filters have the package name in them
+        zope = resolve_test_runner(module, config_file, filename, 'zope')
+
+        def get_package_uncached(rc=rc, filename=filename):
+            module.package_cache.clear()
+            return rc.get_package(filename)
+
+        def get_test(vim=FakeVim(config_file), filename=filename):
+            module.vim = vim
+            return module.get_test(filename, 'TestFoo.test_bar')
+
+        suffix = '[depth=%d]' % depth
+        yield 'get_package' + suffix, partial(rc.get_package, filename)
+        # Without a cache every lookup is uncached, so there is nothing
+        # to compare the timing with.
+        yield 'get_package_uncached' + suffix, (
+            get_package_uncached if hasattr(module, 'package_cache')
+            else None)
+        yield 'construct_filter' + suffix, partial(
+            rc.construct_filter, filename, 'TestFoo.test_bar')
+        yield 'construct_filter_zope' + suffix, partial(
+            zope.construct_filter, filename, 'TestFoo.test_bar')
+        yield 'get_test' + suffix, get_test
+
+
+def measure(fns, repeat):
+    # Returns [(microseconds per call, filesystem calls per call)] for each
+    # function.  The functions take turns, so that they all see the same
+    # system load.
+    fs_calls = []
+    timers = []
+    for fn in fns:
+        fn()  # warm up the caches
+        with count_fs_calls() as counts:
+            fn()
+        fs_calls.append(len(counts))
+        timer = timeit.Timer(fn)
+        timers.append((timer, timer.autorange()[0]))
+    best = [float('inf')] * len(fns)
+    for n in range(repeat):
+        for i, (timer, number) in enumerate(timers):
+            best[i] = min(best[i], timer.timeit(number) / number)
+    return [(round(seconds * 1e6, 2), calls)
+            for seconds, calls in zip(best, fs_calls)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n\n')[0])
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--against', default=BASELINE_REVISION,
+                        help='git revision to compare with'
+                        ' (default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed slowdown, 0.5 means 50%% slower'
+                        ' (default: %(default)s)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='save the filesystem calls as the new'
+                        ' baseline')
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run benchmarks with this in the name')
+    args = parser.parse_args()
+
+    if subprocess.call(['git', 'rev-parse', '-q', '--verify',
+                        args.against + '^{commit}'],
+                       cwd=ROOT, stdout=subprocess.DEVNULL) != 0:
+        parser.error('no such revision: %s' % args.against)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError):
+        baseline = {}
+    results = {}
+    regressions = []
+    dirname = os.path.realpath(tempfile.mkdtemp(prefix='py-test-runner-'))
+    try:
+        files = make_files(dirname)
+        with checkout(args.against) as root:
+            old_module = load_module(os.path.join(root, 'pythonx'))
+            old_benchmarks = get_benchmarks(old_module, files)
+            print('%-36s %10s %9s %10s %9s %9s' % (
+                'benchmark', 'us/call', 'fs calls', args.against[:10],
+                'fs calls', 'change'))
+            for (name, fn), (old_name, old_fn) in zip(
+                    get_benchmarks(py_test_runner, files), old_benchmarks):
+                if args.pattern not in name:
+                    continue
+                if old_fn is None:
+                    [(usec, fs_calls)] = measure([fn], args.repeat)
+                else:
+                    (old_usec, old_fs_calls), (usec, fs_calls) = measure(
+                        [old_fn, fn], args.repeat)
+                results[name] = fs_calls
+                if old_fn is None:
+                    print('%-36s %10.2f %9d %10s %9s %9s' % (
+                        name, usec, fs_calls, '-', '-', '-'))
+                else:
+                    print('%-36s %10.2f %9d %10.2f %9d %+8.0f%%' % (
+                        name, usec, fs_calls, old_usec, old_fs_calls,
+                        (usec - old_usec) / old_usec * 100))
+                if old_fn is not None and (
+                        usec > old_usec * (1 + args.threshold)):
+                    regressions.append('%s: %.2f us, %s takes %.2f us' % (
+                        name, usec, args.against, old_usec))
+                expected = baseline.get(name)
+                if expected is not None and fs_calls > expected:
+                    regressions.append('%s: %d fs calls, baseline.json'
+                                       ' says %d' % (name, fs_calls,
+                                                     expected))
+    finally:
+        shutil.rmtree(dirname)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('saved %s' % args.baseline)
+    elif regressions:
+        print('\nregressions:')
+        for line in regressions:
+            print('  ' + line)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Measure how long the first :RunTestUnderCursor of a Vim session waits for
+py_test_runner to be imported.
+
+Each sample imports it in a fresh Python process, so nothing is cached but
+the .pyc files.  With --vim, the samples are taken in Vim itself (which must
+have Python 3 support), minus the time Vim needs to start Python at all.
+The same number of samples are taken of the code in an older revision
+(by default the one before any of the startup work), so that the budget
+doesn't depend on how fast the machine is.
+
+Exits with status 1 if the median is more than --max-ratio times the
+median of the older revision, or if modules got imported too early.
+"""
+
+import argparse
+import io
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# The last commit before the caches and lazy imports.
+BASELINE_REVISION = '6ef2601'
+
+DEFAULT_MAX_RATIO = 1.5
+
+# Modules that py_test_runner imports only when they're needed.
+DEFERRED = ['configparser', 'sqlite3', 'glob', 'ast', 'json', 'hashlib']
+
+PYTHON_SAMPLE = '''
+import sys, time
+start = time.perf_counter()
+import py_test_runner
+print(time.perf_counter() - start)
+print(' '.join(sorted(set(sys.modules) & set(sys.argv[1:]))))
+'''
+
+
+@contextmanager
+def checkout(revision):
+    # Yields a temporary directory with the pythonx directory of another
+    # revision in it.
+    dirname = tempfile.mkdtemp(prefix='py-test-runner-')
+    try:
+        archive = subprocess.check_output(
+            ['git', 'archive', revision, 'pythonx'], cwd=ROOT)
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(dirname)
+        yield dirname
+    finally:
+        shutil.rmtree(dirname)
+
+
+def python_sample(root):
+    output = subprocess.check_output(
+        [sys.executable, '-c', PYTHON_SAMPLE] + DEFERRED,
+        cwd=os.path.join(root, 'pythonx'), universal_newlines=True)
+    seconds, modules = (output.splitlines() + [''])[:2]
+    return float(seconds), modules.split()
+
+
+def vim_run(vim, root, command):
+    start = time.perf_counter()
+    subprocess.check_call([
+        vim, '-Nu', 'NONE', '-i', 'NONE', '-es',
+        '--cmd', 'set rtp^=' + root.replace(' ', '\\ '),
+        '-c', command, '-c', 'qa!',
+    ])
+    return time.perf_counter() - start
+
+
+def vim_has_python(vim):
+    return subprocess.call([
+        vim, '-Nu', 'NONE', '-i', 'NONE', '-es',
+        '-c', 'if !has("python3") | cq | endif', '-c', 'qa!',
+    ]) == 0
+
+
+def vim_sample(vim, root):
+    baseline = vim_run(vim, root, 'pyx import sys')
+    return vim_run(vim, root, 'pyx import py_test_runner') - baseline, []
+
+
+def measure(args, roots):
+    # Returns a list of samples in ms for each root, and the deferred
+    # modules that got imported in the first one.  The samples of different
+    # roots are taken in turn, so that they all see the same system load.
+    for root in roots:
+        # Make sure the .pyc files exist, like they would in real use.
+        subprocess.check_call([sys.executable, '-m', 'compileall', '-q',
+                               os.path.join(root, 'pythonx')])
+    samples = [[] for root in roots]
+    loaded = set()
+    for n in range(args.samples):
+        for root, root_samples in zip(roots, samples):
+            if args.vim:
+                seconds, modules = vim_sample(args.vim, root)
+            else:
+                seconds, modules = python_sample(root)
+            root_samples.append(seconds * 1000)
+            if root == roots[0]:
+                loaded.update(modules)
+    return samples, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n\n')[0])
+    parser.add_argument('-n', '--samples', type=int, default=20)
+    parser.add_argument('--against', default=BASELINE_REVISION,
+                        help='git revision to compare with'
+                        ' (default: %(default)s)')
+    parser.add_argument('--max-ratio', type=float, default=DEFAULT_MAX_RATIO,
+                        help='maximum median, relative to the median of'
+                        ' --against (default: %(default)s)')
+    parser.add_argument('--vim', nargs='?', const='vim',
+                        help='measure :pyx import in Vim')
+    args = parser.parse_args()
+    if args.vim and not vim_has_python(args.vim):
+        parser.error('%s has no Python 3 support' % args.vim)
+
+    if subprocess.call(['git', 'rev-parse', '-q', '--verify',
+                        args.against + '^{commit}'],
+                       cwd=ROOT, stdout=subprocess.DEVNULL) != 0:
+        parser.error('no such revision: %s' % args.against)
+
+    with checkout(args.against) as root:
+        (samples, baseline), loaded = measure(args, [ROOT, root])
+    median = statistics.median(samples)
+    budget = statistics.median(baseline) * args.max_ratio
+    print('cold import of py_test_runner: median %.1f ms, min %.1f ms,'
+          ' max %.1f ms (%d samples)' % (
+              median, min(samples), max(samples), len(samples)))
+    print('%s: median %.1f ms, so the budget is %.1f ms (%gx)' % (
+        args.against, statistics.median(baseline), budget, args.max_ratio))
+    ok = median <= budget
+    if loaded:
+        print('imported too early: %s' % ', '.join(sorted(loaded)))
+        ok = False
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
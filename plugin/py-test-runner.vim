@@ -11,13 +11,11 @@
 "
 " Installation
 " ------------
-" Make sure you have taghelper.vim or pythonhelper.vim installed.
-" Then copy the three files (plugin/py-test-runner.vim,
+" Copy the three files (plugin/py-test-runner.vim,
 " autoload/pytestrunner.vim and pythonx/py_test_runner.py) into the
 " corresponding directories under $HOME/.vim.
 " Or, better, use a plugin manager like vim-plug:
 "
-"     Plug 'mgedmin/taghelper.vim'
 "     Plug 'mgedmin/py-test-runner.vim'
 "
 " This plugin most likely requires vim 7.0 or maybe even 8.0.  It also needs
@@ -32,15 +30,54 @@
 " :call pytestrunner#use("pytest", "venv/bin/pytest") -- use pytest from venv
 " :call pytestrunner#use("pytest", "pytest -vv")      -- pass extra arguments
 "
+" :call pytestrunner#reload_config() -- forget the cached configuration file
+"
 " :RunTestUnderCursor -- launches the test runner (configured via
-" g:pyTestRunner) with :make
+" g:pyTestRunner) in the background, or with :make if your Vim doesn't
+" support jobs
 "
 " :RunTest [<class>.]<test> -- launches the test runner for a given test
-" in the current file
+" in the current file (with completion)
+"
+" :RunMatchingTests <pattern> -- runs all the tests in the project whose
+" file::[class.]test names fuzzy-match the pattern (with completion)
 "
 " :RunLastTestAgain -- runs the last test again (useful when you've moved the
 " cursor away while editing)
 "
+" :'<,'>RunTests -- runs all the tests defined in the selected lines (or
+" the one containing them) with a single command
+"
+" :RunQuickfixTests -- runs the tests that contain the locations in the
+" quickfix list with a single command
+"
+" :RunFailedTests -- runs the tests that failed the last time they were run
+" in the background (across Vim sessions)
+"
+" :RunAffectedTests -- runs the test modules that import (directly or
+" indirectly) any Python file changed since the last :RunAffectedTests
+"
+" :RecordCoverage -- runs all the tests in the background with coverage, to
+" record which tests execute which lines of code
+"
+" :RunTestsCoveringCursor -- runs the tests that executed the function under
+" the cursor when coverage was recorded
+"
+" :RunTestUnderCursor! (or any other :Run command with a !) -- runs the
+" tests even if g:pyTestRunnerResultCache has the output of an earlier run
+" with the same inputs
+"
+" :PyTestWatch -- reruns the last test every time you save a file that
+" changed; use it again to stop
+"
+" :StopTest -- stops the test run that is running in the background
+"
+" :SlowTests [N] -- lists the N slowest tests of the current class or file
+" (needs a test runner that reports test durations, e.g. pytest --durations=0)
+"
+" :PyTestRunnerProfile [file.json] -- shows where the time went in the last
+" few test runs (if g:pyTestRunnerProfile is set), or saves that as JSON
+"
 " :CopyTestUnderCursor -- copies the command line to run the test into the
 " X11 selection
 "
@@ -70,7 +107,30 @@ function! UseNoseTestRunner(...)
   call pytestrunner#use("nose", join(a:000, " "))
 endfunction
 
-command! -bar RunTestUnderCursor  call pytestrunner#run_test_under_cursor()
-command! -bar -nargs=1 RunTest    call pytestrunner#run_test(<q-args>)
-command! -bar RunLastTestAgain    call pytestrunner#run_last_test_again()
+" Loading Python and the configuration takes a moment; optionally do it
+" in the background, before the first test run needs it
+if get(g:, "pyTestRunnerPrewarm", "") != "" && has("timers")
+  augroup PyTestRunnerPrewarm
+    autocmd!
+    exec "autocmd" (g:pyTestRunnerPrewarm ==? "VimEnter" ? "VimEnter *"
+          \ : "FileType python")
+          \ "call timer_start(200, 'pytestrunner#prewarm')"
+          \ "| autocmd! PyTestRunnerPrewarm"
+  augroup END
+endif
+
+command! -bar -bang RunTestUnderCursor  call pytestrunner#run_test_under_cursor(<bang>0)
+command! -bar -bang -nargs=1 -complete=customlist,pytestrunner#complete_test RunTest call pytestrunner#run_test(<q-args>, <bang>0)
+command! -bar -bang -nargs=1 -complete=customlist,pytestrunner#complete_project_test RunMatchingTests call pytestrunner#run_matching_tests(<q-args>, <bang>0)
+command! -bar -bang RunLastTestAgain    call pytestrunner#run_last_test_again(<bang>0)
+command! -bar -bang RunFailedTests      call pytestrunner#run_failed_tests(<bang>0)
+command! -bar -bang RunAffectedTests    call pytestrunner#run_affected_tests(<bang>0)
+command! -bar -bang RunTestsCoveringCursor call pytestrunner#run_tests_covering_cursor(<bang>0)
+command! -bar -bang -range RunTests call pytestrunner#run_tests_in_range(<line1>, <line2>, <bang>0)
+command! -bar -bang RunQuickfixTests call pytestrunner#run_quickfix_tests(<bang>0)
+command! -bar RecordCoverage      call pytestrunner#record_coverage()
 command! -bar CopyTestUnderCursor call pytestrunner#copy_test_under_cursor()
+command! -bar PyTestWatch         call pytestrunner#toggle_watch()
+command! -bar StopTest            call pytestrunner#stop_job()
+command! -bar -nargs=? SlowTests  call pytestrunner#show_slow_tests(<q-args>)
+command! -bar -nargs=? -complete=file PyTestRunnerProfile call pytestrunner#show_profile(<q-args>)
@@ -4,16 +4,21 @@ pyx import sys; sys.modules.pop("py_test_runner", None); import py_test_runner
 finish
 """
 
-import os
+# Modules that are slow to import and not needed for most things (e.g.
+# configparser, sqlite3, ast, json) are imported where they're used, so that
+# loading the plugin in a Vim session doesn't have to wait for them.
+# test_import_is_lazy checks this.
 
-try:
-    # Python 3
-    from io import StringIO
-    from configparser import ConfigParser
-except ImportError:  # pragma: nocover
-    # Python 2
-    from cStringIO import StringIO
-    from ConfigParser import SafeConfigParser as ConfigParser
+import bisect
+import functools
+import heapq
+import itertools
+import os
+import re
+import shlex
+import sys
+import time
+from collections import OrderedDict, deque, namedtuple
 
 try:
     import vim
@@ -23,6 +28,31 @@ except ImportError:
 
 CONFIG_FILE = '~/.vim/py-test-runner.cfg'
 
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or '~/.cache',
+                         'py-test-runner')
+
+# For recording which tests execute which lines of code.
+COVERAGE_RC = """\
+[run]
+data_file = {data_file}
+parallel = true
+dynamic_context = test_function
+source = {source}
+omit =
+    */site-packages/*
+    */.tox/*
+"""
+
+# Files that can change how the tests run, besides the Python code
+RESULT_CACHE_CONFIG_FILES = ('pytest.ini', 'setup.cfg', 'tox.ini',
+                             'pyproject.toml')
+
+PYTEST_DAEMON = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'pytest_daemon.py')
+
+WATCHDOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'py_test_watchdog.py')
+
 
 DEFAULT_CONFIGURATION = """
 [default]
@@ -35,6 +65,11 @@ ignore_functions_and_methods =
 
 [runner:pytest]
 command = pytest -ra
+coverage_command = coverage run --rcfile={coverage_rcfile} -m pytest -ra
+output_format = pytest
+fail_fast_flag = -x
+durations_flag = --durations=0 --durations-min=0
+keeps_test_order = yes
 filter_for_file         = {filename}
 filter_for_doctest_file = -k {function}
 filter_for_doctest      = {filename}::{full_module}.{function}
@@ -43,8 +78,27 @@ filter_for_class        = {filename}::{class}
 filter_for_method       = {filename}::{class}::{method}
 #absolute_filenames = yes
 
+[runner:pytest-daemon]
+command = python {pytest_daemon} -ra
+coverage_command = coverage run --rcfile={coverage_rcfile} -m pytest -ra
+output_format = pytest
+fail_fast_flag = -x
+durations_flag = --durations=0 --durations-min=0
+keeps_test_order = yes
+filter_for_file         = {filename}
+filter_for_doctest_file = -k {function}
+filter_for_doctest      = {filename}::{full_module}.{function}
+filter_for_function     = {filename}::{function}
+filter_for_class        = {filename}::{class}
+filter_for_method       = {filename}::{class}::{method}
+
 [runner:unittest]
 command = python -m unittest discover
+coverage_command = coverage run --rcfile={coverage_rcfile} -m unittest discover
+output_format = unittest
+fail_fast_flag = --failfast
+# Python 3.12 or newer
+#durations_flag = --durations=0
 #filter_for_module       = -k {module}
 filter_for_class        = -k {class}
 filter_for_method       = -k '{method} [(].*[.]{class}[)]'
@@ -52,6 +106,9 @@ filter_for_method       = -k '{method} [(].*[.]{class}[)]'
 
 [runner:nose]
 command = nosetests
+coverage_command = coverage run --rcfile={coverage_rcfile} -m nose
+output_format = unittest
+fail_fast_flag = -x
 filter_for_file     = {filename}
 filter_for_function = {filename}:{function}
 filter_for_class    = {filename}:{class}
@@ -60,6 +117,9 @@ filter_for_method   = {filename}:{class}.{method}
 
 [runner:django]
 command = bin/django test
+coverage_command = coverage run --rcfile={coverage_rcfile} bin/django test
+output_format = unittest
+fail_fast_flag = --failfast
 filter_for_file     = {filename}
 filter_for_function = {filename}:{function}
 filter_for_class    = {filename}:{class}
@@ -68,6 +128,10 @@ filter_for_method   = {filename}:{class}.{method}
 
 [runner:zope]
 command = bin/test
+coverage_command = coverage run --rcfile={coverage_rcfile} bin/test
+output_format = zope
+fail_fast_flag = --stop-on-error
+#durations_flag = -vvv
 filter_for_package  = -s {package}
 filter_for_module   = -m {module}
 filter_for_function = -t {function}
@@ -77,28 +141,240 @@ clipboard_extras = -pvc
 """
 
 
+def new_config_parser():
+    try:
+        # Python 3
+        from configparser import ConfigParser
+    except ImportError:  # pragma: nocover
+        # Python 2
+        from ConfigParser import SafeConfigParser as ConfigParser
+    return ConfigParser()
+
+
+class Profiler(object):
+    """How long things took in the last few test runs.
+
+    Spans are (name, seconds) pairs.  They're collected while profiling is
+    enabled (g:pyTestRunnerProfile), and grouped into a run when the test
+    run finishes.
+    """
+
+    def __init__(self, maxruns=20, maxspans=1000):
+        self.enabled = False
+        self.spans = deque(maxlen=maxspans)
+        self.runs = deque(maxlen=maxruns)
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    def end_run(self, command, spans=None):
+        # spans are measured by Vim: starting the processes, running them.
+        for name, seconds in sorted((spans or {}).items()):
+            self.add(name, float(seconds))
+        self.runs.append(dict(command=command, time=time.time(),
+                              spans=list(self.spans)))
+        self.spans.clear()
+
+    @staticmethod
+    def summarize(spans):
+        # Returns {name: [count, total seconds]}, slowest first.  Spans can
+        # nest (get_runner calls find_overrides), so they don't add up.
+        totals = OrderedDict()
+        for name, seconds in spans:
+            total = totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+        return OrderedDict(sorted(totals.items(), key=lambda t: -t[1][1]))
+
+    def format(self):
+        lines = []
+        for run in self.runs:
+            lines.append('%s  %s' % (time.strftime(
+                '%H:%M:%S', time.localtime(run['time'])), run['command']))
+            for name, (count, total) in self.summarize(run['spans']).items():
+                lines.append('  %10.3f ms  %-20s (%dx)' % (
+                    total * 1000, name, count))
+        return lines
+
+    def save(self, filename):
+        import json
+        with open(filename, 'w') as f:
+            json.dump(list(self.runs), f, indent=2)
+
+
+def profiled(name):
+    # Adds a span to the profiler every time the function is called, if
+    # profiling is enabled; otherwise this costs an attribute lookup.
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            if not profiler.enabled:
+                return fn(*args, **kw)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kw)
+            finally:
+                profiler.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class FilterTemplate(object):
+    """A filter_for_* option split into literal text and placeholders."""
+
+    # Not {2}, which is more likely a regex quantifier.
+    PLACEHOLDER_RX = re.compile(r'[{]([A-Za-z_]\w*)[}]')
+
+    # Placeholders that are Python keywords, and the keyword arguments
+    # that render() takes for them instead.
+    KEYWORDS = {'class': 'class_'}
+
+    # Placeholders that construct_filter() knows how to fill in.
+    PLACEHOLDERS = frozenset([
+        'filename', 'directory', 'package', 'module', 'full_module',
+        'function', 'class', 'method',
+    ])
+
+    def __init__(self, template):
+        self.template = template
+        # List of (literal text, placeholder name or None) pairs.
+        self.segments = []
+        pos = 0
+        for m in self.PLACEHOLDER_RX.finditer(template):
+            self.segments.append((template[pos:m.start()], m.group(1)))
+            pos = m.end()
+        if pos < len(template) or not self.segments:
+            self.segments.append((template[pos:], None))
+        self.names = set(name for text, name in self.segments if name)
+        # What render() needs: (literal text, keyword argument, default)
+        # triples.  Placeholders without a value are left alone, so
+        # {filename} can be filled in later.
+        self.parts = [
+            (text, self.KEYWORDS.get(name, name), '{%s}' % name)
+            if name else (text, None, '')
+            for text, name in self.segments]
+
+    def unknown_placeholders(self):
+        return sorted(self.names - self.PLACEHOLDERS)
+
+    def render(self, values):
+        # values maps keyword arguments (see KEYWORDS) to their values.
+        get = values.get
+        return ''.join([text + get(key, default)
+                        for text, key, default in self.parts])
+
+
+# There are only ever a few distinct templates (one per filter_for_* option
+# per section), so each one is parsed just once.
+compile_template = functools.lru_cache(maxsize=256)(FilterTemplate)
+
+
+def check_filter_templates(config):
+    # Returns warnings about placeholders construct_filter() can't fill in.
+    warnings = []
+    for section in config.sections():
+        for option in config.options(section):
+            if not option.startswith('filter_for_'):
+                continue
+            template = compile_template(
+                config.get(section, option, raw=True))
+            for name in template.unknown_placeholders():
+                warnings.append('Unknown placeholder {%s} in %s in [%s]' % (
+                    name, option, section))
+    return warnings
+
+
 class RunnerConfiguration(object):
+    """How to run the tests of a file.
 
-    workdir = ''
-    command = ''
-    filter_for_file = ''
-    filter_for_directory = ''
-    filter_for_package = ''
-    filter_for_module = ''
-    filter_for_doctest_file = ''
-    filter_for_doctest = ''
-    filter_for_function = ''
-    filter_for_class = ''
-    filter_for_method = ''
-    absolute_filenames = False
-    relative_filenames = False
-    relative_to = ''
-    clipboard_extras = ''
-    clipboard_extras_suffix = ''
-    ignore_functions_and_methods = (
-        '__init__', 'setUp', 'tearDown', 'test_suite',
+    These are immutable, so files that end up with the same options can
+    share one object, and it can be used as a dictionary key.  Use replace()
+    to get a modified copy.
+    """
+
+    # Options and their default values.
+    DEFAULTS = (
+        ('workdir', ''),
+        ('command', ''),
+        ('filter_for_file', ''),
+        ('filter_for_directory', ''),
+        ('filter_for_package', ''),
+        ('filter_for_module', ''),
+        ('filter_for_doctest_file', ''),
+        ('filter_for_doctest', ''),
+        ('filter_for_function', ''),
+        ('filter_for_class', ''),
+        ('filter_for_method', ''),
+        ('absolute_filenames', False),
+        ('relative_filenames', False),
+        ('relative_to', ''),
+        ('clipboard_extras', ''),
+        ('clipboard_extras_suffix', ''),
+        ('namespace_packages', False),
+        ('keeps_test_order', False),
+        ('output_format', ''),
+        ('shards', '1'),
+        ('coverage_command', ''),
+        ('fail_fast_flag', ''),
+        ('durations_flag', ''),
+        ('timeout', ''),
+        ('per_test_timeout', ''),
+        ('ignore_functions_and_methods', (
+            '__init__', 'setUp', 'tearDown', 'test_suite',
+        )),
     )
 
+    BOOLEAN_OPTIONS = frozenset([
+        'absolute_filenames', 'relative_filenames', 'namespace_packages',
+        'keeps_test_order',
+    ])
+
+    LIST_OPTIONS = frozenset(['ignore_functions_and_methods'])
+
+    __slots__ = tuple(name for name, default in DEFAULTS)
+
+    def __init__(self, **options):
+        for name, default in self.DEFAULTS:
+            object.__setattr__(self, name, options.pop(name, default))
+        if options:
+            raise TypeError('unknown options: %s' % ', '.join(
+                sorted(options)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RunnerConfiguration is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('RunnerConfiguration is immutable')
+
+    def __repr__(self):
+        return 'RunnerConfiguration(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name))
+            for name, default in self.DEFAULTS
+            if getattr(self, name) != default)
+
+    def __eq__(self, other):
+        if not isinstance(other, RunnerConfiguration):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __ne__(self, other):
+        if not isinstance(other, RunnerConfiguration):
+            return NotImplemented
+        return self.values() != other.values()
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def replace(self, **changes):
+        if not changes:
+            return self
+        options = dict(zip(self.__slots__, self.values()))
+        options.update(changes)
+        return RunnerConfiguration(**options)
+
     @staticmethod
     def clean_tag(tag):
         # Older versions of pythonhelper.vim return [fulltagname]
@@ -113,10 +389,7 @@ class RunnerConfiguration(object):
 
     @staticmethod
     def expand(template, **kwargs):
-        s = template
-        for k, v in kwargs.items():
-            s = s.replace('{%s}' % k.strip('_'), v)
-        return s
+        return compile_template(template).render(kwargs)
 
     @staticmethod
     def join(*bits):
@@ -161,6 +434,134 @@ class RunnerConfiguration(object):
     def is_ignored(self, name):
         return name in self.ignore_functions_and_methods
 
+    def is_test(self, tag):
+        # Test functions, doctest functions, and test methods of classes, but
+        # not inner functions.
+        if self.is_inner_function(tag) or tag.count('.') > 1:
+            return False
+        name = tag.rpartition('.')[2]
+        return (name.startswith(('test', 'doctest_'))
+                and not self.is_ignored(name))
+
+    def list_tests(self, source, tag=''):
+        # Tests defined in the source code, limited to a class if tag is
+        # the name of a class.
+        tests = []
+        for test in TagIndex(source).tags:
+            if tag and not test.startswith(tag + '.'):
+                continue
+            if test not in tests and self.is_test(test):
+                tests.append(test)
+        return tests
+
+    def has_hidden_tests(self, source, tag=''):
+        # Can the test runner find tests in the source code (or in the class
+        # named by tag) that list_tests() doesn't see?  E.g. inherited from
+        # a base class or a mixin, imported, or assigned to a test_* name.
+        import ast
+        for node in ast.parse(source).body:
+            if isinstance(node, ast.ClassDef):
+                if tag and node.name != tag:
+                    continue
+                if any(get_dotted_name(base).rpartition('.')[2]
+                       not in PLAIN_BASES for base in node.bases):
+                    return True
+                prefix = node.name + '.'
+                body = node.body
+            elif tag:
+                continue
+            else:
+                prefix = ''
+                body = [node]
+            for stmt in body:
+                for name in get_bound_names(stmt):
+                    if self.is_test(prefix + name):
+                        return True
+                    if (not prefix and name.startswith('Test')
+                            and name not in PLAIN_BASES):
+                        # A test class
+                        return True
+        return False
+
+    def get_test_scope(self, tag):
+        # The test construct_tag_filter() would select for this tag.
+        if self.is_inner_function(tag):
+            return self.strip_inner_function(tag)
+        if self.is_method(tag):
+            class_, method = self.split_class_method(tag)
+            if self.is_ignored(method):
+                return class_
+            return '%s.%s' % (class_, method)
+        return tag
+
+    def merge_tags(self, tags):
+        # Drops the tags selected by other tags too, e.g. a method of a
+        # class that is also in the list.  Doctests are selected by their
+        # full name (see construct_tag_filter()), so they stay as they are.
+        tags = [self.clean_tag(tag) for tag in tags]
+        if not tags or '' in tags:
+            return ['']
+        merged = []
+        scopes = set()
+        for tag in tags:
+            if not (self.is_doctest(tag) and self.filter_for_doctest):
+                tag = self.get_test_scope(tag)
+                scopes.add(tag)
+            if tag not in merged:
+                merged.append(tag)
+        return [tag for tag in merged
+                if tag not in scopes
+                or not any(tag.startswith(other + '.') for other in scopes)]
+
+    def filter_tests(self, tags):
+        # The tests that contain these tags, skipping the rest (e.g. helper
+        # functions).
+        tests = []
+        for tag in tags:
+            test = self.get_test_scope(self.clean_tag(tag))
+            if test and self.is_test(test) and test not in tests:
+                tests.append(test)
+        return tests
+
+    def get_shard_count(self):
+        if self.shards == 'auto':
+            return os.cpu_count() or 1
+        try:
+            return int(self.shards)
+        except ValueError:
+            return 1
+
+    @staticmethod
+    def parse_seconds(value):
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def get_python(command):
+        # The Python to run our scripts with: the one that runs the command
+        # (e.g. .venv/bin/python), the one Vim uses (unless that's Vim
+        # itself), or python3 from $PATH.
+        python = (command.split(None, 1) or [''])[0]
+        if re.match(r'python[\d.]*$', os.path.basename(python)):
+            return python
+        if re.match(r'python[\d.]*$', os.path.basename(sys.executable or '')):
+            return shlex.quote(sys.executable)
+        return 'python3'
+
+    def add_watchdog(self, command):
+        # Runs the command under py_test_watchdog.py if it has a time limit.
+        timeout = self.parse_seconds(self.timeout)
+        per_test_timeout = self.parse_seconds(self.per_test_timeout)
+        if not timeout and not per_test_timeout:
+            return command
+        return self.join(
+            self.get_python(command), shlex.quote(WATCHDOG),
+            timeout and '--timeout %g' % timeout,
+            per_test_timeout and '--per-test-timeout %g' % per_test_timeout,
+            command)
+
     def construct_tag_filter(self, filename, tag):
         tag = self.clean_tag(tag)
         if not tag:
@@ -213,18 +614,62 @@ class RunnerConfiguration(object):
         return module
 
     def is_package_directory(self, dirname):
-        return os.path.exists(os.path.join(dirname, '__init__.py'))
+        return package_cache.get(dirname).is_package
+
+    def is_source_root(self, dirname, seen):
+        seen.append(dirname)
+        if package_cache.get(dirname).is_project_root:
+            return True
+        # src layout: ~/src/project/src/namespace/package/module.py
+        head, tail = os.path.split(dirname)
+        if tail != 'src':
+            return False
+        seen.append(head)
+        return package_cache.get(head).is_project_root
+
+    def get_namespace_package(self, dirname, seen):
+        # PEP 420 namespace packages have no __init__.py, so the only way to
+        # tell where they start is to look for the root of the project.
+        # Appends the directories it looks at to seen.
+        pkg = []
+        while not self.is_source_root(dirname, seen):
+            head, tail = os.path.split(dirname)
+            if head == dirname or not tail.isidentifier():
+                return []
+            pkg.append(tail)
+            dirname = head
+        return pkg
 
+    @profiled('get_package')
     def get_package(self, filename):
         dirname = os.path.dirname(os.path.abspath(filename))
+        package = package_cache.get_package(dirname, self.namespace_packages)
+        if package is None:
+            package = self.find_package(dirname)
+        return package
+
+    def find_package(self, dirname):
+        # Walks up the directory tree, and remembers the package name of
+        # every directory on the way in the package_cache.
+        dirnames = []
         pkg = []
         while self.is_package_directory(dirname):
+            dirnames.append(dirname)
             head, tail = os.path.split(dirname)
             pkg.append(tail)
             if head == dirname:
                 # Who puts a __init__.py in the root directory???
                 break
             dirname = head
+        else:
+            # We stopped at a directory without an __init__.py.
+            dirnames.append(dirname)
+        # The directories that the package names depend on.
+        seen = list(dirnames)
+        if self.namespace_packages and len(dirnames) > len(pkg):
+            pkg.extend(self.get_namespace_package(dirname, seen))
+        package_cache.put_packages(dirnames, pkg, seen,
+                                   self.namespace_packages)
         return '.'.join(reversed(pkg))
 
     def construct_doctest_file_filter(self, filename):
@@ -235,26 +680,47 @@ class RunnerConfiguration(object):
         )
 
     def construct_filter(self, filename, tag):
+        return self.construct_filters(filename, [tag])
+
+    @profiled('construct_filter')
+    def construct_filters(self, filename, tags):
+        # Selects all the tests in one command line.  Filters that don't
+        # mention {filename} share the file/package/module prefix.
         filename = self.prepare_filename(filename)
         if self.is_doctest_file(filename):
-            tag_filter = self.construct_doctest_file_filter(filename)
-        else:
-            tag_filter = self.construct_tag_filter(filename, tag)
-        if '{filename}' in tag_filter:
-            return self.expand(tag_filter, filename=filename)
+            tag_filters = [self.construct_doctest_file_filter(filename)]
+        elif len(tags) == 1:
+            tag_filters = [self.construct_tag_filter(filename, tags[0])]
         else:
+            tag_filters = []
+            for tag in self.merge_tags(tags):
+                tag_filter = self.construct_tag_filter(filename, tag)
+                if tag_filter not in tag_filters:
+                    tag_filters.append(tag_filter)
+            if '' in tag_filters:
+                # No filter selects the whole file (e.g. unittest, which has
+                # no filter_for_function), and so does the union.
+                tag_filters = ['']
+        # Tag filters are already expanded, so no need to compile them.
+        filters = [tag_filter.replace('{filename}', filename)
+                   for tag_filter in tag_filters
+                   if '{filename}' in tag_filter]
+        tag_filters = [tag_filter for tag_filter in tag_filters
+                       if '{filename}' not in tag_filter]
+        if tag_filters:
             directory = os.path.dirname(filename)
             module = self.get_module(filename)
             package = self.get_package(filename)
-            return self.join(
+            filters.append(self.join(
                 self.expand(self.filter_for_file, filename=filename),
                 directory and self.expand(self.filter_for_directory,
                                           directory=directory),
                 package and self.expand(self.filter_for_package,
                                         package=package),
                 module and self.expand(self.filter_for_module, module=module),
-                tag_filter,
-            )
+                *tag_filters
+            ))
+        return ' '.join(filters)
 
     def construct_command(self, filename, tag):
         # This is not actually used because we're using Vim's :make or
@@ -276,20 +742,31 @@ class RunnerConfiguration(object):
         return command
 
 
+def intern_configuration(rc):
+    # Returns the one shared RunnerConfiguration that is equal to rc.
+    return configurations.setdefault(rc, rc)
+
+
 class PyTestRunner(object):
 
     def __init__(self, config_file=CONFIG_FILE):
         self.config_file = config_file
-        self.config = self.load_configuration(config_file)
+        entry = config_cache.lookup(config_file)
+        self.config = entry.config
+        self.path_index = entry.path_index
+        self.deltas = entry.deltas
+        self.configurations = entry.configurations
         self.use_runner(self.config.get('default', 'runner'),
                         is_default=True)
 
     @staticmethod
+    @profiled('load_configuration')
     def load_configuration(filename):
-        cp = ConfigParser()
+        cp = new_config_parser()
         if hasattr(cp, 'read_string'):  # Python 3.2+
             cp.read_string(DEFAULT_CONFIGURATION)
         else:  # pragma: nocover -- Python 2.7 compat, dropped in 3.12
+            from cStringIO import StringIO
             cp.readfp(StringIO(DEFAULT_CONFIGURATION))
         cp.read([os.path.expanduser(filename)])
         return cp
@@ -308,108 +785,1942 @@ class PyTestRunner(object):
         else:
             return default
 
-    def get_option_bool(self, section, option, default=False):
-        if self.config.has_option(section, option):
-            return self.config.getboolean(section, option)
-        else:
-            return default
-
+    @profiled('find_overrides')
     def find_overrides(self, filename):
-        filename = os.path.abspath(filename)
-        for section in self.config.sections():
-            if section.startswith('path:'):
-                sec_path = os.path.expanduser(section[len('path:'):])
-                sec_path = os.path.abspath(sec_path)
-                if os.path.commonprefix([sec_path, filename]) == sec_path:
-                    yield section
-
-    def get_default_runner(self, filename):
+        return self.path_index.find(filename)
+
+    def get_default_runner(self, filename, overrides=None):
+        if overrides is None:
+            overrides = self.find_overrides(filename)
         runner = self.runner
-        for section in self.find_overrides(filename):
+        for section in overrides:
             runner = self.get_option(section, 'runner', runner)
         return runner
 
-    def apply_overrides(self, rc, filename):
-        for section in self.find_overrides(filename):
-            self.apply_config(rc, section)
+    def get_delta(self, section):
+        # The options set in this section, as (name, value) pairs.
+        delta = self.deltas.get(section)
+        if delta is not None:
+            return delta
+        delta = []
+        for name, default in RunnerConfiguration.DEFAULTS:
+            if not self.config.has_option(section, name):
+                continue
+            if name in RunnerConfiguration.BOOLEAN_OPTIONS:
+                value = self.config.getboolean(section, name)
+            elif name in RunnerConfiguration.LIST_OPTIONS:
+                value = tuple(self.config.get(section, name).split())
+            else:
+                value = self.config.get(section, name)
+            delta.append((name, value))
+        delta = self.deltas[section] = tuple(delta)
+        return delta
 
     def apply_config(self, rc, section):
-        rc.workdir = self.get_option(
-            section, 'workdir', rc.workdir)
-        rc.command = self.get_option(
-            section, 'command', rc.command)
-        rc.filter_for_file = self.get_option(
-            section, 'filter_for_file', rc.filter_for_file)
-        rc.filter_for_directory = self.get_option(
-            section, 'filter_for_directory', rc.filter_for_directory)
-        rc.filter_for_package = self.get_option(
-            section, 'filter_for_package', rc.filter_for_package)
-        rc.filter_for_module = self.get_option(
-            section, 'filter_for_module', rc.filter_for_module)
-        rc.filter_for_doctest_file = self.get_option(
-            section, 'filter_for_doctest_file', rc.filter_for_doctest_file)
-        rc.filter_for_doctest = self.get_option(
-            section, 'filter_for_doctest', rc.filter_for_doctest)
-        rc.filter_for_function = self.get_option(
-            section, 'filter_for_function', rc.filter_for_function)
-        rc.filter_for_class = self.get_option(
-            section, 'filter_for_class', rc.filter_for_class)
-        rc.filter_for_method = self.get_option(
-            section, 'filter_for_method', rc.filter_for_method)
-        rc.absolute_filenames = self.get_option_bool(
-            section, 'absolute_filenames', rc.absolute_filenames)
-        rc.relative_filenames = self.get_option_bool(
-            section, 'relative_filenames', rc.relative_filenames)
-        rc.relative_to = self.get_option(
-            section, 'relative_to', rc.relative_to)
-        rc.clipboard_extras = self.get_option(
-            section, 'clipboard_extras', rc.clipboard_extras)
-        rc.clipboard_extras_suffix = self.get_option(
-            section, 'clipboard_extras_suffix', rc.clipboard_extras_suffix)
-        rc.ignore_functions_and_methods = self.get_option(
-            section, 'ignore_functions_and_methods',
-            ' '.join(rc.ignore_functions_and_methods)).split()
+        return rc.replace(**dict(self.get_delta(section)))
 
+    @profiled('get_runner')
     def get_runner(self, filename):
-        rc = RunnerConfiguration()
-        rc.ignore_functions_and_methods = self.config.get(
-            'default', 'ignore_functions_and_methods').split()
-        runner = self.get_default_runner(filename)
-        self.apply_config(rc, 'runner:%s' % runner)
-        # maybe I should do this only when runner_is_default is set?
-        self.apply_config(rc, 'default')
-        self.apply_overrides(rc, filename)
+        overrides = self.find_overrides(filename)
+        runner = self.get_default_runner(filename, overrides)
+        # maybe I should apply [default] only when runner_is_default is set?
+        sections = ['runner:%s' % runner, 'default']
+        sections += overrides
+        deltas = tuple(self.get_delta(section) for section in sections)
+        # Files with the same overrides share one configuration.
+        rc = self.configurations.get(deltas)
+        if rc is None:
+            rc = RunnerConfiguration(ignore_functions_and_methods=tuple(
+                self.config.get('default',
+                                'ignore_functions_and_methods').split()))
+            for section in sections:
+                rc = self.apply_config(rc, section)
+            rc = self.configurations[deltas] = intern_configuration(rc)
+        return rc
+
+
+class PathIndex(object):
+    """A trie of [path:...] sections keyed by path components."""
+
+    class Node(object):
+
+        def __init__(self):
+            self.children = {}
+            self.sections = []
+
+    def __init__(self, config):
+        self.root = self.Node()
+        # Relative paths depend on the current working directory at lookup
+        # time, so they can't be put in the trie.
+        self.relative = []
+        for n, section in enumerate(config.sections()):
+            if not section.startswith('path:'):
+                continue
+            sec_path = os.path.expanduser(section[len('path:'):])
+            if not os.path.isabs(sec_path):
+                self.relative.append((n, section, sec_path))
+                continue
+            node = self.root
+            for part in self.split(sec_path):
+                node = node.children.setdefault(part, self.Node())
+            node.sections.append((n, section))
+
+    @staticmethod
+    def split(path):
+        return [part for part in os.path.abspath(path).split(os.path.sep)
+                if part]
+
+    def find(self, filename):
+        parts = self.split(filename)
+        node = self.root
+        matches = list(node.sections)
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                break
+            matches.extend(node.sections)
+        for n, section, sec_path in self.relative:
+            sec_parts = self.split(sec_path)
+            if parts[:len(sec_parts)] == sec_parts:
+                matches.append((n, section))
+        # Sections are applied in the order they appear in the config file.
+        return [section for n, section in sorted(matches)]
+
+
+# Base classes that don't add any tests.
+PLAIN_BASES = frozenset(['object', 'TestCase'])
+
+
+def get_dotted_name(node):
+    # 'unittest.TestCase' for the expression unittest.TestCase.
+    import ast
+    if isinstance(node, ast.Attribute):
+        return '%s.%s' % (get_dotted_name(node.value), node.attr)
+    return getattr(node, 'id', '')
+
+
+def get_bound_names(stmt):
+    # Names that a class or module body statement (other than def or class)
+    # defines.
+    import ast
+    if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+        return [alias.asname or alias.name for alias in stmt.names]
+    if isinstance(stmt, ast.Assign):
+        targets = stmt.targets
+    elif isinstance(stmt, ast.AnnAssign):
+        targets = [stmt.target]
+    else:
+        return []
+    return [target.id for target in targets
+            if isinstance(target, ast.Name)]
+
+
+class TagIndex(object):
+    """Which function/class/method encloses a given line of Python source."""
+
+    # Names of the ast node types that start a new scope, so that ast
+    # doesn't have to be imported before it's used.
+    SCOPES = frozenset(['FunctionDef', 'AsyncFunctionDef', 'ClassDef'])
+
+    def __init__(self, source):
+        import ast
+        # Sorted list of (first line, tag) pairs: each tag applies to the
+        # lines between its first line and the first line of the next pair.
+        self.starts = []
+        self.tags = []
+        self.add_scopes(ast.parse(source), '')
+
+    def add_scopes(self, node, prefix):
+        import ast
+        for child in ast.iter_child_nodes(node):
+            if type(child).__name__ in self.SCOPES:
+                tag = prefix + child.name
+                first = min([child.lineno] + [
+                    d.lineno for d in child.decorator_list])
+                self.add(first, tag)
+                self.add_scopes(child, tag + '.')
+                self.add(child.end_lineno + 1, prefix[:-1])
+            else:
+                self.add_scopes(child, prefix)
+
+    def add(self, lineno, tag):
+        self.starts.append(lineno)
+        self.tags.append(tag)
+
+    def find(self, lineno):
+        idx = bisect.bisect_right(self.starts, lineno)
+        if idx == 0:
+            return ''
+        return self.tags[idx - 1]
+
+    def find_all(self, first, last):
+        # Tags of all the lines between first and last (inclusive).
+        tags = [self.find(first)]
+        for tag in self.tags[bisect.bisect_right(self.starts, first):
+                             bisect.bisect_right(self.starts, last)]:
+            if tag not in tags:
+                tags.append(tag)
+        return tags
+
+    def find_range(self, tag):
+        # Returns (first line, last line) of a function or class, or None.
+        first = None
+        for lineno, t in zip(self.starts, self.tags):
+            if t == tag or t.startswith(tag + '.'):
+                if first is None:
+                    first = lineno
+            elif first is not None:
+                return (first, lineno - 1)
+        return None
+
+
+class TagCache(object):
+    """TagIndexes of recently seen buffers, rebuilt when they change."""
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get_index(self, bufnr, changedtick, get_source):
+        entry = self.entries.pop(bufnr, None)
+        if entry is None or entry[0] != changedtick:
+            try:
+                index = TagIndex(get_source())
+            except (SyntaxError, ValueError):
+                # You're in the middle of editing something, so keep using
+                # the last index that worked (if any).
+                index = entry[1] if entry is not None else None
+            entry = (changedtick, index)
+        self.entries[bufnr] = entry
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry[1]
+
+    def get_tag(self, bufnr, changedtick, get_source, lineno):
+        index = self.get_index(bufnr, changedtick, get_source)
+        if index is None:
+            return ''
+        return index.find(lineno)
+
+
+DirectoryInfo = namedtuple('DirectoryInfo', 'mtime is_package is_project_root')
+
+
+class PackageCache(object):
+    """What we know about directories, until their mtime changes.
+
+    The package name of a directory depends on the directories above it
+    too, so a cached package name is only used if none of them changed,
+    which takes one stat() per level.  The first lookup in a directory also
+    lists it, but the directories above it are listed only once for all
+    their subdirectories.
+    """
+
+    PROJECT_MARKERS = frozenset([
+        'setup.py', 'setup.cfg', 'pyproject.toml', 'tox.ini', '.git',
+    ])
+
+    def __init__(self):
+        self.entries = {}
+        # Maps (dirname, namespace_packages) to (package name, ((dirname,
+        # mtime), ...)) with the directories the package name depends on.
+        self.packages = {}
+
+    @staticmethod
+    def get_mtime(dirname):
+        try:
+            return os.stat(dirname).st_mtime
+        except OSError:
+            return None
+
+    def get(self, dirname):
+        mtime = self.get_mtime(dirname)
+        if mtime is None:
+            self.entries.pop(dirname, None)
+            return DirectoryInfo(None, False, False)
+        info = self.entries.get(dirname)
+        if info is not None and info.mtime == mtime:
+            return info
+        try:
+            names = set(os.listdir(dirname))
+        except OSError:
+            names = set()
+        info = DirectoryInfo(
+            mtime,
+            '__init__.py' in names,
+            not self.PROJECT_MARKERS.isdisjoint(names),
+        )
+        self.entries[dirname] = info
+        return info
+
+    def get_package(self, dirname, namespace_packages):
+        # Returns None if the package of dirname needs to be looked up.
+        entry = self.packages.get((dirname, namespace_packages))
+        if entry is None:
+            return None
+        pkg, stamps = entry
+        for dep, mtime in stamps:
+            if self.get_mtime(dep) != mtime:
+                return None
+        return pkg
+
+    def put_packages(self, dirnames, pkg, seen, namespace_packages):
+        # dirnames are a directory and its parents, as far as find_package()
+        # looked for __init__.py files, and reversed(pkg) is the package
+        # name of the first one.  seen are all the directories it looked
+        # at, in the same order.
+        stamps = []
+        for dirname in seen:
+            info = self.entries.get(dirname)
+            if not stamps or stamps[-1][0] != dirname:
+                stamps.append((dirname, info and info.mtime))
+        for i, dirname in enumerate(dirnames):
+            self.packages[dirname, namespace_packages] = (
+                '.'.join(reversed(pkg[i:])), tuple(stamps[i:]))
+
+    def clear(self):
+        self.entries.clear()
+        self.packages.clear()
+
+
+# deltas maps section names to PyTestRunner.get_delta() results, and
+# configurations maps tuples of deltas to RunnerConfigurations.
+ConfigEntry = namedtuple('ConfigEntry',
+                         'stamp config path_index deltas configurations')
+
+
+class ConfigCache(object):
+    """Parsed configuration files, reloaded when they change on disk."""
+
+    def __init__(self):
+        self.entries = {}
+        # Bumped every time any cached configuration is (re)loaded or
+        # dropped, so derived caches know when to throw away their results.
+        self.generation = 0
+
+    @staticmethod
+    def get_stamp(filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def lookup(self, config_file):
+        filename = os.path.expanduser(config_file)
+        stamp = self.get_stamp(filename)
+        entry = self.entries.get(filename)
+        if entry is not None and entry.stamp == stamp:
+            return entry
+        config = PyTestRunner.load_configuration(config_file)
+        for warning in check_filter_templates(config):
+            print('%s: %s' % (config_file, warning))
+        entry = ConfigEntry(stamp, config, PathIndex(config), {}, {})
+        self.entries[filename] = entry
+        self.generation += 1
+        return entry
+
+    def get(self, config_file):
+        return self.lookup(config_file).config
+
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+
+class RunnerCache(object):
+    """Fully resolved RunnerConfigurations, least recently used first."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        if generation != self.generation:
+            # The configuration file changed, everything we have is stale.
+            self.entries.clear()
+            self.generation = generation
+        try:
+            rc = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = rc
+        self.hits += 1
         return rc
 
+    def put(self, key, rc):
+        self.entries[key] = rc
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self.entries), maxsize=self.maxsize)
+
+
+Failure = namedtuple('Failure', 'filename lineno test message test_file tag')
+
+
+class OutputParser(object):
+    """Extracts test failures from test runner output, one line at a time.
+
+    Only the failure that is currently being parsed is kept in memory, so
+    this can handle arbitrarily long test runs.
+    """
+
+    DURATION = None
+
+    def __init__(self):
+        # Seconds per (test file, tag), for test runners that report them.
+        self.durations = OrderedDict()
+
+    def parse_duration(self, line):
+        m = self.DURATION.match(line) if self.DURATION else None
+        if m:
+            key = self.get_duration_key(m)
+            self.durations[key] = (
+                self.durations.get(key, 0) + float(m.group('seconds')))
+        return m
+
+    def feed(self, line):
+        """Parse a line of output, return a list of completed failures."""
+        return []
+
+    def close(self):
+        """Return any failures still pending at the end of the output."""
+        return []
+
+    @staticmethod
+    def as_quickfix_item(failure):
+        item = dict(filename=failure.filename, lnum=failure.lineno,
+                    text=failure.message, type='E')
+        if failure.test:
+            item['text'] = '%s: %s' % (failure.test, failure.message)
+        return item
+
+
+class PytestOutputParser(OutputParser):
+
+    SECTION = re.compile(r'^_{3,} (?:ERROR at \w+ of )?(.+?) _{3,}$')
+    ERROR = re.compile(r'^E\s+(.*)$')
+    FRAME = re.compile(r'^(?P<filename>\S+?\.py):(?P<lineno>\d+):(?: |$)')
+    # --tb=long (the default) ends with the location of the error
+    LOCATION = re.compile(
+        r'^(?P<filename>\S.*?):(?P<lineno>\d+): (?P<error>[A-Za-z_][\w.]*)$')
+    # --tb=short has a line for each frame, and no location at the end
+    SHORT_FRAME = re.compile(
+        r'^(?P<filename>\S+?\.py):(?P<lineno>\d+): in (?P<name>\S+)$')
+    # --tb=native prints Python's own tracebacks, without the "E" lines
+    NATIVE_FRAME = re.compile(
+        r'^  File "(?P<filename>.+)", line (?P<lineno>\d+), in (?P<name>\S+)$')
+    SUMMARY = re.compile(
+        r'^(?:FAILED|ERROR) (?P<filename>[^\s:]+)(?:::(?P<test>\S+))?'
+        r'(?: - (?P<message>.*))?$')
+    # pytest --durations=N prints the setup, call and teardown times
+    DURATION = re.compile(
+        r'^(?P<seconds>\d+\.\d+)s (?:setup|call|teardown) +'
+        r'(?P<filename>[^\s:]+)::(?P<test>\S+)$')
+
+    def __init__(self):
+        super(PytestOutputParser, self).__init__()
+        self.test = None
+        self.test_file = None
+        self.first_frame = None
+        self.location = None
+        self.message = None
+        self.in_error = False
+        self.native = False
+        # Tests that had their own section in the output, so we can skip them
+        # in the short test summary.
+        self.reported = set()
+        # Failures that need the short test summary to tell us their test
+        # file, by test.
+        self.pending = OrderedDict()
+
+    @staticmethod
+    def get_tag(test):
+        # Drop the parameters of parametrized tests
+        return test.partition('[')[0]
+
+    @property
+    def method(self):
+        return self.get_tag(self.test).rpartition('.')[2]
+
+    def feed(self, line):
+        m = self.SECTION.match(line)
+        if m:
+            failures = self.end_section()
+            self.test = m.group(1)
+            return failures
+        if self.test is None:
+            return self.parse_summary(line)
+        if line.startswith('=' * 3):
+            # End of the failures section
+            return self.end_section() + self.parse_summary(line)
+        m = self.ERROR.match(line)
+        if m:
+            # Chained exceptions: the first line of the last "E" block is
+            # the interesting one.
+            if not self.in_error:
+                self.message = m.group(1)
+                self.in_error = True
+            return []
+        self.in_error = False
+        m = self.SHORT_FRAME.match(line) or self.NATIVE_FRAME.match(line)
+        if m:
+            self.location = (m.group('filename'), int(m.group('lineno')))
+            if m.group('name') == self.method:
+                self.test_file = m.group('filename')
+            self.native = m.re is self.NATIVE_FRAME
+            return []
+        if line and not line[0].isspace() and self.native:
+            # The exception after a --tb=native traceback
+            self.native = False
+            if not line.startswith(('Traceback ', 'During handling ',
+                                    'The above exception ')):
+                self.message = line
+            return []
+        m = self.FRAME.match(line)
+        if m and self.first_frame is None:
+            # The first frame of a --tb=long traceback is the test itself.
+            self.first_frame = m.group('filename')
+        m = self.LOCATION.match(line)
+        if m:
+            self.location = (m.group('filename'), int(m.group('lineno')))
+            self.message = self.message or m.group('error')
+        return []
+
+    def end_section(self):
+        if self.test is None:
+            return []
+        filename, lineno = self.location or ('', 0)
+        failure = Failure(filename, lineno, self.test, self.message or '',
+                          self.test_file or self.first_frame,
+                          self.get_tag(self.test))
+        self.test = self.test_file = self.first_frame = None
+        self.location = self.message = None
+        self.in_error = self.native = False
+        if failure.test_file is None:
+            # E.g. --tb=line has no frames, or a fixture of a --tb=native
+            # setup error is in another file.
+            self.pending[failure.test] = failure
+            return []
+        self.reported.add(failure.test)
+        return [failure]
+
+    def close(self):
+        # Without a short test summary, the best guess is where the error
+        # was.
+        failures = self.end_section() + [
+            failure._replace(test_file=failure.filename)
+            for failure in self.pending.values()]
+        self.pending.clear()
+        return failures
+
+    def get_duration_key(self, m):
+        return (m.group('filename'),
+                self.get_tag(m.group('test').replace('::', '.')))
+
+    def parse_summary(self, line):
+        if self.parse_duration(line):
+            return []
+        m = self.SUMMARY.match(line)
+        if not m:
+            return []
+        test = (m.group('test') or '').replace('::', '.')
+        if test in self.reported:
+            return []
+        filename = m.group('filename')
+        failure = self.pending.pop(test, None)
+        if failure is not None:
+            return [failure._replace(
+                filename=failure.filename or filename, test_file=filename,
+                message=failure.message or m.group('message') or '')]
+        return [Failure(filename, 0, test, m.group('message') or '',
+                        filename, self.get_tag(test))]
+
+
+class UnittestOutputParser(OutputParser):
+
+    HEADER = re.compile(r'^(?:FAIL|ERROR): (.+)$')
+    # Tracebacks end at the separator line before the next failure or
+    # before the "Ran N tests" line (or "Slowest test durations").
+    END = re.compile(r'^(?:={20,}|-{20,}|Slowest test durations)$')
+    FRAME = re.compile(
+        r'^  File "(?P<filename>.+)", line (?P<lineno>\d+)'
+        r'(?:, in (?P<name>\S+))?')
+    TEST = re.compile(r'^(?P<method>\S+) \((?P<dotted>\S+)\)$')
+    # python -m unittest --durations=N (Python 3.12+)
+    DURATION = re.compile(r'^(?P<seconds>\d+\.\d+)s +(?P<test>\S+ \(\S+\))$')
+
+    def __init__(self):
+        super(UnittestOutputParser, self).__init__()
+        self.test = None
+        self.test_file = None
+        self.location = None
+        self.message = None
+
+    @classmethod
+    def split_test(cls, test):
+        # test_foo (pkg.tests.TestFoo), or since Python 3.11
+        # test_foo (pkg.tests.TestFoo.test_foo)
+        # Returns (module, class, method).
+        m = cls.TEST.match(test)
+        if not m:
+            return ('', '', '')
+        method, dotted = m.group('method', 'dotted')
+        if dotted.endswith('.' + method):
+            dotted = dotted[:-len(method) - 1]
+        module, _, class_ = dotted.rpartition('.')
+        if class_[:1].isupper():
+            return (module, class_, method)
+        return (dotted, '', method)
+
+    @classmethod
+    def get_tag(cls, test):
+        module, class_, method = cls.split_test(test)
+        if class_:
+            return '%s.%s' % (class_, method)
+        return method
+
+    def get_duration_key(self, m):
+        # The test runner doesn't tell us the filename, so we'll have to
+        # hope the module is relative to the working directory.
+        test = m.group('test')
+        module = self.split_test(test)[0]
+        return (module.replace('.', os.path.sep) + '.py', self.get_tag(test))
+
+    def feed(self, line):
+        m = self.HEADER.match(line)
+        if m:
+            failures = self.close()
+            self.test = m.group(1)
+            return failures
+        if self.test is None:
+            self.parse_duration(line)
+            return []
+        if self.END.match(line):
+            if self.location is None and self.message is None:
+                # This is the separator after the header.
+                return []
+            return self.close()
+        m = self.FRAME.match(line)
+        if m:
+            self.location = (m.group('filename'), int(m.group('lineno')))
+            if self.test_file is None or m.group('name') == self.method:
+                self.test_file = m.group('filename')
+        elif line and not line[0].isspace() and self.location is not None:
+            if not line.startswith(('Traceback ', 'During handling ',
+                                    'The above exception ')):
+                self.message = line
+        return []
+
+    @property
+    def method(self):
+        return self.get_tag(self.test).rpartition('.')[2]
+
+    def close(self):
+        if self.test is None:
+            return []
+        filename, lineno = self.location or ('', 0)
+        failure = Failure(filename, lineno, self.test, self.message or '',
+                          self.test_file or filename, self.get_tag(self.test))
+        self.test = self.test_file = self.location = self.message = None
+        return [failure]
+
+
+class ZopeOutputParser(UnittestOutputParser):
+
+    HEADER = re.compile(r'^(?:Failure|Error) in test (.+)$')
+    # Tracebacks are followed by a blank line, then the next failure or
+    # the summary.
+    END = re.compile(r'^$|^  Ran \d+ tests')
+    # bin/test -vvv
+    DURATION = re.compile(
+        r'^ (?P<test>\S+ \(\S+\)) \((?P<seconds>\d+\.\d+) s\)$')
+
+
+class StackDumpParser(object):
+    """Notices py_test_watchdog.py killing a test run that took too long.
+
+    The stack dump faulthandler prints before that shows where the test run
+    was stuck: the most recent call in a test module.
+    """
+
+    # faulthandler prints the most recent call first
+    FRAME = re.compile(
+        r'^\s+File "(?P<filename>.+)", line (?P<lineno>\d+) in \S+$')
+    KILLED = re.compile(r'^py-test-runner: (?P<message>test run killed after'
+                        r' (?P<seconds>[0-9.]+) seconds.*)$')
+
+    def __init__(self, workdir=''):
+        self.workdir = workdir
+        self.frames = []
+        # The Failure for the stuck test, once we know about it.
+        self.killed = None
+        self.seconds = 0
+
+    def feed(self, line):
+        m = self.FRAME.match(line)
+        if m:
+            self.frames.append((m.group('filename'), int(m.group('lineno'))))
+            return []
+        m = self.KILLED.match(line)
+        if not m:
+            return []
+        self.seconds = float(m.group('seconds'))
+        self.killed = self.get_failure(m.group('message'))
+        return [self.killed]
+
+    def get_failure(self, message):
+        for filename, lineno in self.frames:
+            if ImportGraph.is_test_file(filename):
+                tag = self.get_tag(filename, lineno)
+                return Failure(filename, lineno, tag, message,
+                               filename if tag else '', tag)
+        return Failure('', 0, '', message, '', '')
+
+    def get_tag(self, filename, lineno):
+        try:
+            with open(os.path.join(self.workdir, filename), 'rb') as f:
+                tag = TagIndex(f.read()).find(lineno)
+        except (IOError, OSError, SyntaxError, ValueError):
+            return ''
+        # e.g. an inner function of a test
+        return RunnerConfiguration().get_test_scope(tag)
+
+
+def split_into_shards(tests, n, weights=None):
+    # Greedy longest-first assignment to the least loaded shard.  Tests
+    # without a known weight count as 1.  Each shard keeps the original
+    # test order.
+    weights = weights or {}
+    order = {test: i for i, test in enumerate(tests)}
+    heap = [(0, i, []) for i in range(min(n, len(tests)))]
+    for test in sorted(tests, key=lambda t: -weights.get(t, 1)):
+        load, i, shard = heapq.heappop(heap)
+        shard.append(test)
+        heapq.heappush(heap, (load + weights.get(test, 1), i, shard))
+    return [sorted(shard, key=order.get) for load, i, shard in sorted(
+        heap, key=lambda item: item[1])]
+
+
+def schedule_tests(tests, failed, durations):
+    # Tests that failed last time go first, then the fastest ones, so that
+    # a failure shows up as soon as possible.  Tests that never ran count
+    # as fast.  Ties keep the original order.
+    return sorted(tests, key=lambda test: (test not in failed,
+                                           durations.get(test, 0)))
+
+
+def get_cache_dir(workdir):
+    import hashlib
+    workdir = os.path.abspath(workdir)
+    digest = hashlib.sha1(workdir.encode('UTF-8')).hexdigest()[:12]
+    name = '%s-%s' % (os.path.basename(workdir) or 'root', digest)
+    return os.path.join(os.path.expanduser(CACHE_DIR), name)
+
+
+def load_json(filename, default):
+    import json
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def save_json(filename, data):
+    # Atomically, so a crash can't leave a half-written file behind.
+    import json
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(filename + '.tmp', filename)
+
+
+class FailureIndex(object):
+    """Tests that failed the last time they ran, saved between Vim sessions.
+
+    Tests are identified by (absolute filename, tag) pairs.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.failures = self.load(filename)
+
+    @classmethod
+    def for_workdir(cls, workdir):
+        return cls(os.path.join(get_cache_dir(workdir), 'failures.json'))
+
+    @staticmethod
+    def load(filename):
+        return [tuple(test) for test in load_json(filename, [])]
+
+    def save(self):
+        save_json(self.filename, self.failures)
+
+    @staticmethod
+    def covers(scope, test):
+        filename, tag = scope
+        if not filename:
+            return True
+        if filename != test[0]:
+            return False
+        return (not tag or tag == test[1] or test[1].startswith(tag + '.')
+                # e.g. the cursor was in an inner function of the test
+                or tag.startswith(test[1] + '.'))
+
+    def update(self, scope, failures):
+        # Forget the tests that were run, unless they failed again.
+        tests = [test for test in self.failures
+                 if not any(self.covers(s, test) for s in scope)]
+        for test in failures:
+            if test not in tests:
+                tests.append(test)
+        self.failures = tests
+
+
+class DurationDB(object):
+    """How long each test took in recent runs, saved between Vim sessions.
+
+    This is an append-only file with one JSON list per line:
+    [timestamp, filename, tag, seconds, outcome].  When it grows too large
+    it gets rewritten, keeping only the last few runs of each test.
+    """
+
+    MAX_SIZE = 1024 * 1024
+    HISTORY = 10
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @classmethod
+    def for_workdir(cls, workdir):
+        return cls(os.path.join(get_cache_dir(workdir), 'durations.jsonl'))
+
+    def load(self):
+        # Returns {(filename, tag): [(timestamp, seconds, outcome), ...]}
+        # with the oldest entries first.
+        import json
+        history = OrderedDict()
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        when, filename, tag, seconds, outcome = (
+                            json.loads(line))
+                    except ValueError:
+                        # Partially written line, maybe.
+                        continue
+                    history.setdefault((filename, tag), []).append(
+                        (when, seconds, outcome))
+        except (IOError, OSError):
+            pass
+        return history
+
+    def get_durations(self, filename):
+        # Latest duration of each test in the given file, by tag.
+        return {tag: runs[-1][1]
+                for (fn, tag), runs in self.load().items() if fn == filename}
+
+    def record(self, entries, when=None):
+        # entries is a list of (filename, tag, seconds, outcome) tuples.
+        import json
+        if not entries:
+            return
+        when = int(time.time() if when is None else when)
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.filename, 'a') as f:
+            for filename, tag, seconds, outcome in entries:
+                f.write(json.dumps([when, filename, tag, seconds, outcome])
+                        + '\n')
+        if os.path.getsize(self.filename) > self.MAX_SIZE:
+            self.compact()
+
+    def compact(self):
+        import json
+        with open(self.filename + '.tmp', 'w') as f:
+            for (filename, tag), runs in self.load().items():
+                for when, seconds, outcome in runs[-self.HISTORY:]:
+                    f.write(json.dumps([when, filename, tag, seconds,
+                                        outcome]) + '\n')
+        os.rename(self.filename + '.tmp', self.filename)
+
+    def get_slowest(self, filename, tag='', count=10):
+        # Returns [(tag, [seconds, ...])] for the slowest tests in a file
+        # (or a class), by their latest duration, with older durations
+        # first.
+        tests = [
+            (test_tag, [seconds for when, seconds, outcome in runs])
+            for (fn, test_tag), runs in self.load().items()
+            if fn == filename
+            and (not tag or test_tag == tag or test_tag.startswith(tag + '.'))
+        ]
+        tests.sort(key=lambda test: -test[1][-1])
+        return tests[:count]
+
+
+class FileIndex(object):
+    """Something we learn from each Python file of a project by reading it.
+
+    Subclasses set Info to a namedtuple that starts with mtime, size and
+    digest, and define analyze(filename, source) to compute the rest.  The
+    results are cached on disk, so only files with a new mtime or size need
+    to be read again.
+    """
+
+    SKIP_DIRS = frozenset(['__pycache__', 'node_modules', 'build', 'dist'])
+
+    Info = None
+
+    def __init__(self, root, rc, cache_file):
+        self.root = root
+        self.rc = rc
+        self.cache_file = cache_file
+        # filename -> self.Info
+        self.files = {}
+        # dirname -> mtime, for update()
+        self.dirs = {}
+
+    def find_files(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            try:
+                self.dirs[dirpath] = os.stat(dirpath).st_mtime
+            except OSError:
+                continue
+            if 'pyvenv.cfg' in filenames:
+                # A virtualenv
+                dirnames[:] = []
+                continue
+            dirnames[:] = sorted(d for d in dirnames
+                                 if not d.startswith('.')
+                                 and d not in self.SKIP_DIRS)
+            for name in sorted(filenames):
+                if name.endswith('.py'):
+                    yield os.path.join(dirpath, name)
+
+    def scan(self):
+        cache = {filename: self.Info(*info) for filename, info
+                 in load_json(self.cache_file, {}).items()}
+        files = {}
+        self.dirs = {}
+        for filename in self.find_files():
+            try:
+                st = os.stat(filename)
+                info = cache.get(filename)
+                if info is None or (info.mtime, info.size) != (
+                        st.st_mtime, st.st_size):
+                    info = self.parse(filename, st, info)
+            except (IOError, OSError):
+                continue
+            files[filename] = info
+        self.files = files
+        if files != cache:
+            save_json(self.cache_file, files)
+
+    def update(self, filenames, dirnames):
+        # Like scan(), but only looks at these files (which must have been
+        # scanned), and at these directories (to notice new or removed
+        # files).  Returns None if a full scan() is needed, otherwise
+        # whether any of the files changed.
+        changed = False
+        try:
+            for dirname in dirnames:
+                if os.stat(dirname).st_mtime != self.dirs.get(dirname):
+                    return None
+            for filename in filenames:
+                st = os.stat(filename)
+                info = self.files[filename]
+                if (info.mtime, info.size) != (st.st_mtime, st.st_size):
+                    self.files[filename] = self.parse(filename, st, info)
+                    changed = True
+        except (IOError, OSError):
+            return None
+        if changed:
+            save_json(self.cache_file, self.files)
+        return changed
+
+    def parse(self, filename, st, cached=None):
+        import hashlib
+        with open(filename, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha1(source).hexdigest()
+        if cached is not None and cached.digest == digest:
+            # Touched, but not changed (e.g. by git checkout)
+            return cached._replace(mtime=st.st_mtime, size=st.st_size)
+        return self.Info(st.st_mtime, st.st_size, digest,
+                         self.analyze(filename, source))
+
+    def get_snapshot(self):
+        return {filename: info.digest for filename, info in self.files.items()}
+
+    def get_changed(self, snapshot):
+        # Files that were added, modified or removed since the snapshot.
+        current = self.get_snapshot()
+        return sorted(filename for filename in set(snapshot) | set(current)
+                      if snapshot.get(filename) != current.get(filename))
+
+    @staticmethod
+    def is_test_file(filename):
+        name = os.path.basename(filename)
+        return name.startswith('test') or name.endswith('_test.py')
+
+
+ModuleInfo = namedtuple('ModuleInfo', 'mtime size digest imports')
+
+
+class ImportGraph(FileIndex):
+    """Which Python files of a project import which modules.
+
+    Files are parsed with ast and the results are cached on disk, so only
+    files with a new mtime or size need to be parsed again.
+    """
+
+    Info = ModuleInfo
+
+    def __init__(self, root, rc, cache_file):
+        super(ImportGraph, self).__init__(root, rc, cache_file)
+        # filename -> dotted module name
+        self.module_names = {}
+
+    def scan(self):
+        self.module_names = {}
+        super(ImportGraph, self).scan()
+
+    def refresh(self, filenames):
+        # Like scan(), but only looks at the files that these files import
+        # (directly or indirectly), and at the directories they're in (to
+        # notice new or removed files).  Returns False if a full scan() is
+        # needed.
+        if not all(filename in self.files for filename in filenames):
+            return False
+        deps = self.get_dependencies(filenames)
+        dirs = set()
+        for filename in deps:
+            dirname = os.path.dirname(filename)
+            while dirname not in dirs and dirname.startswith(self.root):
+                dirs.add(dirname)
+                dirname = os.path.dirname(dirname)
+        changed = self.update(deps, dirs)
+        if changed:
+            # The imports might be different now.
+            return self.refresh(filenames)
+        return changed is not None
+
+    def get_module_name(self, filename):
+        name = self.module_names.get(filename)
+        if name is None:
+            name = '.'.join(filter(None, [self.rc.get_package(filename),
+                                          self.rc.get_module(filename)]))
+            self.module_names[filename] = name
+        return name
+
+    def analyze(self, filename, source):
+        import ast
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):
+            return []
+        return sorted(self.get_imports(
+            tree, self.get_module_name(filename),
+            os.path.basename(filename) == '__init__.py'))
+
+    @staticmethod
+    def get_imports(tree, module, is_package):
+        import ast
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                prefix = node.module or ''
+                if node.level:
+                    base = module.split('.')
+                    if not is_package:
+                        base.pop()
+                    base = base[:len(base) - node.level + 1]
+                    prefix = '.'.join(filter(None, base + [prefix]))
+                # from pkg import name can import the module pkg.name
+                names.add(prefix)
+                names.update('%s.%s' % (prefix, alias.name)
+                             for alias in node.names if alias.name != '*')
+        names.discard('')
+        return names
+
+    def get_importers(self):
+        # Importing a.b.c also runs a/__init__.py and a/b/__init__.py
+        importers = {}
+        for filename, info in self.files.items():
+            for name in info.imports:
+                parts = name.split('.')
+                for n in range(1, len(parts) + 1):
+                    importers.setdefault('.'.join(parts[:n]), set()).add(
+                        filename)
+        return importers
+
+    def get_dependencies(self, filenames):
+        # Project files that the given files import, directly or indirectly,
+        # including the conftest.py files pytest loads for them.
+        modules = {}
+        for filename in self.files:
+            modules.setdefault(self.get_module_name(filename), []).append(
+                filename)
+        conftests = [f for f in self.files
+                     if os.path.basename(f) == 'conftest.py']
+        deps = set()
+        todo = list(filenames)
+        while todo:
+            filename = todo.pop()
+            if filename in deps or filename not in self.files:
+                continue
+            deps.add(filename)
+            # Importing a.b.c also runs a/__init__.py and a/b/__init__.py
+            for name in self.files[filename].imports + [
+                    self.get_module_name(filename)]:
+                parts = name.split('.')
+                for n in range(1, len(parts) + 1):
+                    todo.extend(modules.get('.'.join(parts[:n]), ()))
+            todo.extend(f for f in conftests if filename.startswith(
+                os.path.join(os.path.dirname(f), '')))
+        return sorted(deps)
+
+    def get_affected(self, changed):
+        # Test files that import any of the changed files, directly or
+        # indirectly.
+        importers = self.get_importers()
+        affected = set()
+        todo = list(changed)
+        while todo:
+            filename = todo.pop()
+            if filename in affected:
+                continue
+            affected.add(filename)
+            if os.path.basename(filename) == 'conftest.py':
+                prefix = os.path.join(os.path.dirname(filename), '')
+                todo.extend(f for f in self.files if f.startswith(prefix))
+            todo.extend(importers.get(self.get_module_name(filename), ()))
+        return sorted(f for f in affected
+                      if f in self.files and self.is_test_file(f))
+
+
+TestFileInfo = namedtuple('TestFileInfo', 'mtime size digest tests')
+
+
+class TestIndex(FileIndex):
+    """All the tests of a project, found without running the test runner.
+
+    Test files are parsed with ast and the tests picked out by
+    RunnerConfiguration.list_tests().  Like with the ImportGraph, the
+    results are cached on disk and only changed files get parsed again.
+    """
+
+    Info = TestFileInfo
+
+    @classmethod
+    def for_workdir(cls, workdir, rc):
+        return cls(workdir, rc,
+                   os.path.join(get_cache_dir(workdir), 'tests.json'))
+
+    def find_files(self):
+        return filter(self.is_test_file, super(TestIndex, self).find_files())
+
+    def refresh(self):
+        # Like scan(), but only looks at the test files it found and at the
+        # directories it walked, instead of walking them again.  Returns
+        # False if a full scan() is needed.
+        return self.update(list(self.files), list(self.dirs)) is not None
+
+    def analyze(self, filename, source):
+        try:
+            return self.rc.list_tests(source)
+        except (SyntaxError, ValueError):
+            return []
+
+    def get_tests(self):
+        # (filename, tag) pairs, sorted by filename.
+        return [(filename, tag) for filename in sorted(self.files)
+                for tag in self.files[filename].tests]
+
+
+def fuzzy_score(pattern, text):
+    # Returns None if the characters of pattern don't appear in text in the
+    # same order; otherwise a sort key that puts substring matches first,
+    # then the matches where those characters are closer together.
+    pattern = pattern.lower()
+    text = text.lower()
+    if pattern in text:
+        return (0, len(text))
+    start = pos = -1
+    for ch in pattern:
+        pos = text.find(ch, pos + 1)
+        if pos == -1:
+            return None
+        if start == -1:
+            start = pos
+    return (1, pos - start, len(text))
+
+
+def fuzzy_filter(pattern, candidates):
+    # Best matches first.
+    matches = []
+    for text in candidates:
+        score = fuzzy_score(pattern, text)
+        if score is not None:
+            matches.append((score, text))
+    return [text for score, text in sorted(matches)]
+
+
+class ResultCache(object):
+    """Output of earlier test runs, for replaying when nothing changed.
+
+    Each result is a JSON file named after its key.  When the cache grows
+    over MAX_SIZE bytes, the least recently used results are removed.
+    """
+
+    MAX_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    @classmethod
+    def for_workdir(cls, workdir):
+        return cls(os.path.join(get_cache_dir(workdir), 'results'))
+
+    def get_filename(self, key):
+        return os.path.join(self.dirname, key + '.json')
+
+    def get(self, key):
+        filename = self.get_filename(key)
+        result = load_json(filename, None)
+        if result is not None:
+            # The mtime tells evict() when the result was last used.
+            os.utime(filename, None)
+        return result
+
+    def put(self, key, result):
+        save_json(self.get_filename(key), result)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.dirname):
+            filename = os.path.join(self.dirname, name)
+            st = os.stat(filename)
+            entries.append((st.st_mtime, filename, st.st_size))
+        total = sum(size for mtime, filename, size in entries)
+        for mtime, filename, size in sorted(entries):
+            if total <= self.MAX_SIZE:
+                break
+            os.unlink(filename)
+            total -= size
+
+
+def numbits_to_ranges(numbits):
+    # coverage.py stores the set of executed line numbers as a bitmap.
+    ranges = []
+    for i, byte in enumerate(bytearray(numbits)):
+        for bit in range(8):
+            if byte & (1 << bit):
+                lineno = i * 8 + bit
+                if ranges and ranges[-1][1] == lineno - 1:
+                    ranges[-1][1] = lineno
+                else:
+                    ranges.append([lineno, lineno])
+    return ranges
+
+
+class CoverageMap(object):
+    """Which tests execute which lines of code.
+
+    Built from coverage.py data files recorded with
+    dynamic_context = test_function.  Tests are identified by (absolute
+    filename, tag) pairs, and the lines each test executed in each file
+    are stored as a list of [first, last] ranges.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        data = load_json(filename, {})
+        self.tests = [tuple(test) for test in data.get('tests', [])]
+        # {filename: {test index: ranges}}
+        self.files = {
+            filename: {idx: ranges for idx, ranges in tests}
+            for filename, tests in data.get('files', {}).items()}
+
+    @classmethod
+    def for_workdir(cls, workdir):
+        return cls(os.path.join(get_cache_dir(workdir), 'coverage.json'))
+
+    def save(self):
+        save_json(self.filename, dict(
+            tests=self.tests,
+            files={filename: sorted(tests.items())
+                   for filename, tests in self.files.items()}))
+
+    @staticmethod
+    def get_test(context, filenames):
+        # Contexts look like pkg.tests.test_foo.TestFoo.test_bar; the test
+        # module is one of the files the test executed.
+        parts = context.split('.')
+        n = len(parts) - 1
+        for i, part in enumerate(parts):
+            if part[:1].isupper():
+                n = i
+                break
+        if n == 0:
+            # No module name, e.g. Tests.TestFoo.test_bar
+            return None
+        suffix = os.path.sep + os.path.join(*parts[:n]) + '.py'
+        for filename in filenames:
+            if (os.path.sep + filename).endswith(suffix):
+                return (filename, '.'.join(parts[n:]))
+        return None
+
+    def update(self, data_file):
+        # Returns False if the file couldn't be read.
+        import sqlite3
+        try:
+            conn = sqlite3.connect(data_file)
+            try:
+                paths = dict(conn.execute('SELECT id, path FROM file'))
+                contexts = dict(conn.execute(
+                    'SELECT id, context FROM context'))
+                rows = conn.execute(
+                    'SELECT file_id, context_id, numbits FROM line_bits'
+                ).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return False
+        lines = {}
+        for file_id, context_id, numbits in rows:
+            if contexts[context_id]:
+                lines.setdefault(contexts[context_id], {})[
+                    paths[file_id]] = numbits_to_ranges(numbits)
+        for context, files in sorted(lines.items()):
+            test = self.get_test(context, files)
+            if test is not None:
+                self.set_coverage(test, files)
+        return True
+
+    def set_coverage(self, test, files):
+        if test in self.tests:
+            idx = self.tests.index(test)
+        else:
+            idx = len(self.tests)
+            self.tests.append(test)
+        for tests in self.files.values():
+            tests.pop(idx, None)
+        for filename, ranges in files.items():
+            self.files.setdefault(filename, {})[idx] = ranges
+
+    def find_tests(self, filename, first, last):
+        # Tests that executed any of the given lines.
+        return [self.tests[idx]
+                for idx, ranges in sorted(self.files.get(filename, {}).items())
+                if any(a <= last and b >= first for a, b in ranges)]
+
+
+def get_coverage_rcfile(workdir):
+    cache_dir = get_cache_dir(workdir)
+    rcfile = os.path.join(cache_dir, 'coveragerc')
+    text = COVERAGE_RC.format(data_file=os.path.join(cache_dir, 'coverage.db'),
+                              source=workdir)
+    try:
+        with open(rcfile) as f:
+            if f.read() == text:
+                return rcfile
+    except (IOError, OSError):
+        pass
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(rcfile, 'w') as f:
+        f.write(text)
+    return rcfile
+
+
+def update_coverage_map(workdir):
+    import glob
+    data_files = glob.glob(
+        os.path.join(get_cache_dir(workdir), 'coverage.db.*'))
+    if not data_files:
+        return
+    coverage_map = CoverageMap.for_workdir(workdir)
+    for data_file in sorted(data_files):
+        if coverage_map.update(data_file):
+            os.unlink(data_file)
+    coverage_map.save()
+
+
+class TestRun(object):
+    """Output parsing and bookkeeping for a test run in the background."""
+
+    def __init__(self, parser, workdir, scope, coverage=False, cache_key=''):
+        self.parser = parser
+        self.workdir = workdir
+        self.coverage = coverage
+        self.cache_key = cache_key
+        # Quickfix items for ResultCache
+        self.items = []
+        self.scope = [
+            (os.path.abspath(filename) if filename else '',
+             RunnerConfiguration.clean_tag(tag))
+            for filename, tag in scope]
+        self.failed = []
+        self.stack_dump = StackDumpParser(workdir)
+
+    def record(self, failures):
+        for failure in failures:
+            if failure.test_file:
+                test = (os.path.join(self.workdir, failure.test_file),
+                        failure.tag)
+                if test not in self.failed:
+                    self.failed.append(test)
+        return failures
+
+    def feed(self, line):
+        return self.record(self.parser.feed(line)
+                           + self.stack_dump.feed(line))
+
+    def close(self):
+        return self.record(self.parser.close())
+
+    def as_quickfix_item(self, failure):
+        item = self.parser.as_quickfix_item(failure)
+        if failure.test_file and failure.tag:
+            # The item points at where the exception was raised, which may
+            # be a helper outside of the test; get_tests_at_lines() needs
+            # the test itself.
+            item['user_data'] = dict(
+                test_file=os.path.join(self.workdir, failure.test_file),
+                tag=failure.tag)
+        return item
+
+    def keep(self, items):
+        if self.cache_key:
+            self.items.extend(items)
+        return items
+
+    def finish(self, completed, exit_status=None):
+        if self.stack_dump.killed:
+            # The tests after the one that got stuck didn't run.
+            completed = False
+        self.record_durations()
+        if self.coverage:
+            update_coverage_map(self.workdir)
+        if self.cache_key and completed and exit_status is not None:
+            ResultCache.for_workdir(self.workdir).put(self.cache_key, dict(
+                items=self.items, exit_status=exit_status))
+        if not completed and not self.failed:
+            return
+        index = FailureIndex.for_workdir(self.workdir)
+        # If the run was interrupted, we can't tell which of the tests that
+        # failed last time pass now.
+        index.update(self.scope if completed else [], self.failed)
+        index.save()
+
+    def record_durations(self):
+        entries = []
+        for (test_file, tag), seconds in self.parser.durations.items():
+            test = (os.path.join(self.workdir, test_file), tag)
+            outcome = 'failed' if test in self.failed else 'passed'
+            entries.append(test + (round(seconds, 3), outcome))
+        killed = self.stack_dump.killed
+        if killed and killed.test_file:
+            entries.append((os.path.join(self.workdir, killed.test_file),
+                            killed.tag, self.stack_dump.seconds, 'timeout'))
+        DurationDB.for_workdir(self.workdir).record(entries)
+
+
+OUTPUT_PARSERS = {
+    'pytest': PytestOutputParser,
+    'unittest': UnittestOutputParser,
+    'zope': ZopeOutputParser,
+}
+
+
+config_cache = ConfigCache()
+runner_cache = RunnerCache()
+# Every distinct RunnerConfiguration, see intern_configuration().
+configurations = {}
+package_cache = PackageCache()
+tag_cache = TagCache()
+output_parsers = {}
+output_parser_ids = itertools.count(1)
+# Content hashes of files, so :PyTestWatch can ignore writes that don't
+# change anything.
+file_digests = {}
+# ImportGraphs by workdir, so get_result_key() doesn't have to look at every
+# file of the project every time.
+import_graphs = {}
+# TestIndexes by workdir, so completing test names doesn't have to walk the
+# whole project on every keypress.
+test_indexes = {}
+profiler = Profiler()
+
 
 #
 # Vim interface
 #
 
-def get_test_runner(filename):
-    config_file = vim.eval('g:pyTestRunnerConfigFile') or CONFIG_FILE
+def resolve_test_runner(config_file, filename, runner, command):
     r = PyTestRunner(config_file)
-    runner = vim.eval('g:pyTestRunner')
     if runner:
         r.use_runner(runner)
     rr = r.get_runner(filename)
+    rr = rr.replace(command=rr.expand(
+        command or rr.command, pytest_daemon=shlex.quote(PYTEST_DAEMON)))
+    return intern_configuration(rr)
+
+
+def get_test_runner(filename):
+    config_file = vim.eval('g:pyTestRunnerConfigFile') or CONFIG_FILE
+    runner = vim.eval('g:pyTestRunner')
     command = vim.eval('g:pyTestRunnerCommand')
-    if command:
-        rr.command = command
+    # Every command starts here, so this is where profiling gets turned on.
+    profiler.enabled = vim.eval('g:pyTestRunnerProfile') not in ('', '0')
+    # This stats the config file so runner_cache notices when it changes.
+    config_cache.get(config_file)
+    key = (config_file, os.path.abspath(filename), runner, command)
+    rr = runner_cache.get(key, config_cache.generation)
+    if rr is None:
+        rr = resolve_test_runner(config_file, filename, runner, command)
+        runner_cache.put(key, rr)
     return rr
 
 
-def get_test_command(filename):
+def get_test_command(filename, coverage=False, fail_fast=False,
+                     durations=False):
     rr = get_test_runner(filename)
+    command = rr.command
+    if coverage and rr.coverage_command:
+        command = rr.expand(rr.coverage_command, coverage_rcfile=(
+            get_coverage_rcfile(get_workdir(filename))))
+    if fail_fast:
+        command = rr.join(command, rr.fail_fast_flag)
+    if durations:
+        command = rr.join(command, rr.durations_flag)
+    command = rr.add_watchdog(command)
     if rr.workdir:
-        return 'cd %s && %s' % (rr.workdir, rr.command)
+        return 'cd %s && %s' % (rr.workdir, command)
     else:
-        return rr.command
+        return command
 
 
 def get_test(filename, tag):
     return get_test_runner(filename).construct_filter(filename, tag)
 
 
+def get_tests(filename, tags):
+    return get_test_runner(filename).construct_filters(filename, tags)
+
+
+def get_filter_for_tests(rc, tests):
+    # Command-line arguments for running (filename, tag) pairs from any
+    # number of files.
+    files = OrderedDict()
+    for test_file, tag in tests:
+        files.setdefault(test_file, []).append(tag)
+    return ' '.join(rc.construct_filters(get_display_filename(test_file), tags)
+                    for test_file, tags in files.items())
+
+
 def get_clipboard_command(filename, tag):
     return get_test_runner(filename).construct_clipboard_command(filename, tag)
+
+
+def get_tag_under_cursor():
+    buf = vim.current.buffer
+    changedtick = int(vim.eval('b:changedtick'))
+    lineno = vim.current.window.cursor[0]
+    return tag_cache.get_tag(buf.number, changedtick,
+                             lambda: '\n'.join(buf), lineno)
+
+
+def get_output_format(filename):
+    return get_test_runner(filename).output_format
+
+
+def list_tests_in_scope(rc, filename, tag):
+    # The tests in a file or a class, or [] if tag is something else.
+    if (tag and not rc.is_class(tag)) or rc.is_doctest_file(filename):
+        return []
+    try:
+        with open(filename, 'rb') as f:
+            source = f.read()
+        if rc.has_hidden_tests(source, tag):
+            # Let the test runner find them with the usual filter.
+            return []
+        return rc.list_tests(source, tag)
+    except (IOError, OSError, SyntaxError, ValueError):
+        return []
+
+
+def get_schedule(filename, tests):
+    # Reorders the tests of a file with schedule_tests().
+    workdir = get_workdir(filename)
+    filename = os.path.abspath(filename)
+    failed = set(tag for test_file, tag
+                 in FailureIndex.for_workdir(workdir).failures
+                 if test_file == filename)
+    durations = DurationDB.for_workdir(workdir).get_durations(filename)
+    return schedule_tests(tests, failed, durations)
+
+
+def get_test_shards(filename, tag, schedule=False):
+    # Returns a list of {filter, scope} dicts for running the tests in a
+    # file or a class in parallel, or [] if they shouldn't be split up.
+    # With schedule, each shard runs the tests likely to fail first.
+    rc = get_test_runner(filename)
+    tag = rc.clean_tag(tag)
+    n = rc.get_shard_count()
+    tests = list_tests_in_scope(rc, filename, tag) if n > 1 else []
+    if not tests:
+        return []
+    durations = DurationDB.for_workdir(get_workdir(filename)).get_durations(
+        os.path.abspath(filename))
+    shards = split_into_shards(tests, n, durations)
+    if len(shards) < 2:
+        return []
+    if schedule and rc.keeps_test_order:
+        shards = [get_schedule(filename, shard) for shard in shards]
+    filters = [rc.construct_filters(filename, shard) for shard in shards]
+    if rc.construct_filters(filename, []) in filters:
+        # The runner can't select some of the tests (e.g. functions with
+        # unittest), so every shard would run the whole file.
+        return []
+    return [dict(filter=filter, scope=[[filename, test] for test in shard])
+            for filter, shard in zip(filters, shards)]
+
+
+def get_scheduled_tests(filename, tag):
+    # Returns {filter, scope} for running the tests in a file or a class
+    # with the ones likely to fail first, or {} if the order stays the same.
+    rc = get_test_runner(filename)
+    if not rc.keeps_test_order:
+        # E.g. unittest -k runs the tests in its own order.
+        return {}
+    tag = rc.clean_tag(tag)
+    tests = list_tests_in_scope(rc, filename, tag)
+    scheduled = get_schedule(filename, tests)
+    if scheduled == tests:
+        return {}
+    return dict(filter=rc.construct_filters(filename, scheduled),
+                scope=[[filename, test] for test in scheduled])
+
+
+def format_durations(tag, durations):
+    line = '%8.3fs  %s' % (durations[-1], tag)
+    if len(durations) > 1:
+        recent = durations[-5:]
+        previous = sum(recent[:-1]) / (len(recent) - 1)
+        history = ' '.join('%.3f' % seconds for seconds in recent)
+        if previous:
+            change = (recent[-1] - previous) / previous
+            history += ', %+d%%' % round(change * 100)
+        line += '  (%s)' % history
+    return line
+
+
+def get_slow_tests(filename, tag, count=10):
+    # Slowest tests of the class the cursor is in, or of the whole file.
+    tag = RunnerConfiguration.clean_tag(tag)
+    class_ = tag.partition('.')[0] if tag[:1].isupper() else ''
+    db = DurationDB.for_workdir(get_workdir(filename))
+    return [format_durations(test, durations) for test, durations
+            in db.get_slowest(os.path.abspath(filename), class_, count)]
+
+
+def get_workdir(filename):
+    return os.path.abspath(get_test_runner(filename).workdir or os.curdir)
+
+
+def get_result_key(filename, command, scope):
+    # A hash of the command line and of the project files the tests
+    # import, or '' if the output of this test run can't be cached.
+    import hashlib
+    rc = get_test_runner(filename)
+    if rc.output_format not in OUTPUT_PARSERS or not scope or not all(
+            test_file for test_file, tag in scope):
+        return ''
+    workdir = get_workdir(filename)
+    test_files = [os.path.abspath(test_file) for test_file, tag in scope]
+    graph = import_graphs.get(workdir)
+    if graph is None or graph.rc != rc or not graph.refresh(test_files):
+        graph = ImportGraph(workdir, rc, os.path.join(get_cache_dir(workdir),
+                                                      'imports.json'))
+        graph.scan()
+        import_graphs[workdir] = graph
+    if not all(test_file in graph.files for test_file in test_files):
+        return ''
+    h = hashlib.sha1()
+    h.update(('%s\0%s\0' % (workdir, command)).encode('UTF-8'))
+    for dep in graph.get_dependencies(test_files):
+        h.update(('%s\0%s\0' % (dep, graph.files[dep].digest)).encode(
+            'UTF-8'))
+    for name in RESULT_CACHE_CONFIG_FILES:
+        try:
+            with open(os.path.join(workdir, name), 'rb') as f:
+                h.update(f.read())
+        except (IOError, OSError):
+            pass
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def get_cached_result(filename, command, scope):
+    # Returns {key, result}, where result is {items, exit_status} from the
+    # last time these tests ran with the same inputs, or {} if there's none.
+    key = get_result_key(filename, command, scope)
+    result = None
+    if key:
+        result = ResultCache.for_workdir(get_workdir(filename)).get(key)
+    return dict(key=key, result=result or {})
+
+
+def start_output_parser(output_format, filename='', scope=(),
+                        coverage=False, cache_key=''):
+    # scope is a list of (filename, tag) pairs that describe what tests
+    # are being run.  coverage means the tests are run with the
+    # coverage_command.  cache_key means the output of a completed run
+    # should be stored in the ResultCache.
+    if output_format not in OUTPUT_PARSERS:
+        return 0
+    parser_id = next(output_parser_ids)
+    output_parsers[parser_id] = TestRun(
+        OUTPUT_PARSERS[output_format](),
+        get_workdir(filename) if filename else os.path.abspath(os.curdir),
+        scope, coverage, cache_key)
+    return parser_id
+
+
+@profiled('parse_output')
+def parse_output(parser_id, lines):
+    # Returns quickfix items for all the lines, with the failures we
+    # recognize in the right places.
+    run = output_parsers[parser_id]
+    items = []
+    for line in lines:
+        items.append(dict(text=line, valid=0))
+        items.extend(map(run.as_quickfix_item, run.feed(line)))
+    return run.keep(items)
+
+
+@profiled('stop_output_parser')
+def stop_output_parser(parser_id, completed=False, exit_status=None):
+    run = output_parsers.pop(parser_id, None)
+    if run is None:
+        return []
+    items = run.keep(list(map(run.as_quickfix_item, run.close())))
+    run.finish(completed, exit_status)
+    return items
+
+
+def get_display_filename(filename):
+    # Relative to the current directory, like Vim's buffer names.
+    if filename.startswith(os.path.join(os.path.abspath(os.curdir), '')):
+        return os.path.relpath(filename)
+    return filename
+
+
+def get_failed_tests(filename):
+    rc = get_test_runner(filename)
+    index = FailureIndex.for_workdir(get_workdir(filename))
+    return dict(filter=get_filter_for_tests(rc, index.failures),
+                scope=[list(test) for test in index.failures])
+
+
+def get_tests_covering_cursor():
+    # Tests that executed the function/class under the cursor (or the
+    # cursor line, if it's not in a function) when coverage was recorded.
+    buf = vim.current.buffer
+    changedtick = int(vim.eval('b:changedtick'))
+    lineno = vim.current.window.cursor[0]
+    index = tag_cache.get_index(buf.number, changedtick,
+                                lambda: '\n'.join(buf))
+    tag = index.find(lineno) if index is not None else ''
+    first, last = (index.find_range(tag) if tag else None) or (lineno, lineno)
+    rc = get_test_runner(buf.name)
+    coverage_map = CoverageMap.for_workdir(get_workdir(buf.name))
+    tests = coverage_map.find_tests(os.path.abspath(buf.name), first, last)
+    return dict(filter=get_filter_for_tests(rc, tests),
+                scope=[list(t) for t in tests])
+
+
+def complete_test(filename, arglead):
+    # Completion for :RunTest: the tests and test classes of the current
+    # buffer.
+    rc = get_test_runner(filename)
+    try:
+        tests = rc.list_tests('\n'.join(vim.current.buffer))
+    except (SyntaxError, ValueError):
+        tests = []
+    names = []
+    for test in tests:
+        if rc.is_method(test):
+            class_ = rc.split_class_method(test)[0]
+            if class_ not in names:
+                names.append(class_)
+        names.append(test)
+    return fuzzy_filter(arglead, names)
+
+
+def find_tests(filename, pattern):
+    # Tests anywhere in the project whose file::tag matches the pattern.
+    # Returns {filter, scope, names}, where names are sorted by how well
+    # they match.
+    rc = get_test_runner(filename)
+    workdir = get_workdir(filename)
+    index = test_indexes.get(workdir)
+    if index is None or index.rc != rc or not index.refresh():
+        index = TestIndex.for_workdir(workdir, rc)
+        index.scan()
+        test_indexes[workdir] = index
+    tests = OrderedDict(
+        ('%s::%s' % (os.path.relpath(test_file, workdir), tag),
+         (test_file, tag))
+        for test_file, tag in index.get_tests())
+    names = fuzzy_filter(pattern, tests)
+    matches = set(names)
+    tests = [test for name, test in tests.items() if name in matches]
+    return dict(filter=get_filter_for_tests(rc, tests),
+                scope=[list(t) for t in tests], names=names)
+
+
+def get_tests_in_range(first, last):
+    # Tests defined in or around the given lines of the current buffer.
+    buf = vim.current.buffer
+    changedtick = int(vim.eval('b:changedtick'))
+    index = tag_cache.get_index(buf.number, changedtick,
+                                lambda: '\n'.join(buf))
+    rc = get_test_runner(buf.name)
+    tags = index.find_all(first, last) if index is not None else []
+    tests = [(buf.name, test) for test in rc.filter_tests(tags)]
+    return dict(filter=get_filter_for_tests(rc, tests),
+                scope=[list(t) for t in tests])
+
+
+def get_tests_at_lines(filename, locations, known_tests=()):
+    # Tests that contain the given [filename, lineno] pairs, e.g. from the
+    # quickfix list, plus the [filename, tag] pairs of known_tests, for
+    # quickfix items that know which test they belong to.  filename is the
+    # current buffer, for the runner configuration.
+    rc = get_test_runner(filename)
+    indexes = {}
+    tests = []
+    for test_file, tag in known_tests:
+        if (test_file, tag) not in tests:
+            tests.append((test_file, tag))
+    for test_file, lineno in locations:
+        if rc.is_doctest_file(test_file):
+            tags = ['']
+        else:
+            if test_file not in indexes:
+                try:
+                    with open(test_file, 'rb') as f:
+                        indexes[test_file] = TagIndex(f.read())
+                except (IOError, OSError, SyntaxError, ValueError):
+                    indexes[test_file] = None
+            index = indexes[test_file]
+            if index is None:
+                continue
+            tags = rc.filter_tests([index.find(int(lineno))])
+        for tag in tags:
+            if (test_file, tag) not in tests:
+                tests.append((test_file, tag))
+    return dict(filter=get_filter_for_tests(rc, tests),
+                scope=[list(t) for t in tests])
+
+
+def get_affected_tests(filename):
+    # Finds the tests affected by changes since the last time this was
+    # called, and the tests that were still failing then.
+    rc = get_test_runner(filename)
+    workdir = get_workdir(filename)
+    cache_dir = get_cache_dir(workdir)
+    graph = ImportGraph(workdir, rc, os.path.join(cache_dir, 'imports.json'))
+    graph.scan()
+    snapshot_file = os.path.join(cache_dir, 'snapshot.json')
+    snapshot = load_json(snapshot_file, None)
+    save_json(snapshot_file, graph.get_snapshot())
+    if snapshot is None:
+        return dict(filter='', scope=[], changed=[], snapshot=0)
+    changed = graph.get_changed(snapshot)
+    tests = graph.get_affected(changed)
+    for test_file, tag in FailureIndex.for_workdir(workdir).failures:
+        if test_file not in tests and os.path.exists(test_file):
+            tests.append(test_file)
+    return dict(filter=get_filter_for_tests(rc, [(f, '') for f in tests]),
+                scope=[[test_file, ''] for test_file in tests],
+                changed=[get_display_filename(f) for f in changed],
+                snapshot=1)
+
+
+def prewarm(filename):
+    # Reads the configuration and resolves the runner ahead of the first
+    # test run (see g:pyTestRunnerPrewarm).
+    get_test_runner(filename)
+
+
+def get_file_digest(filename):
+    import hashlib
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def watch_files(filenames):
+    # Remembers what the files look like now (see file_changed()).
+    file_digests.clear()
+    for filename in filenames:
+        filename = os.path.abspath(filename)
+        file_digests[filename] = get_file_digest(filename)
+
+
+def file_changed(filename):
+    # Has the file changed since the last time we looked at it?  Files we
+    # haven't seen before count as changed.
+    filename = os.path.abspath(filename)
+    digest = get_file_digest(filename)
+    changed = digest != file_digests.get(filename)
+    file_digests[filename] = digest
+    return changed
+
+
+def end_profiled_run(command, spans):
+    profiler.end_run(command, spans)
+
+
+def get_profile():
+    return profiler.format()
+
+
+def save_profile(filename):
+    profiler.save(filename)
+
+
+def reload_config():
+    config_cache.clear()
+    runner_cache.clear()
+    configurations.clear()
+    package_cache.clear()
+    import_graphs.clear()
+    test_indexes.clear()
+
+
+def get_cache_stats():
+    return runner_cache.stats()
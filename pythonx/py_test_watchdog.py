@@ -0,0 +1,165 @@
+"""
+Runs a test runner with a time limit, for py-test-runner.vim.
+
+Usage: python py_test_watchdog.py [--timeout N] [--per-test-timeout N]
+                                  command [arguments]
+
+The command runs in a process group of its own, with PYTHONFAULTHANDLER=1 and
+PYTHONUNBUFFERED=1.  If it runs for longer than --timeout seconds, or prints
+nothing for --per-test-timeout seconds (with a verbose test runner that means
+one test is taking that long), the whole process group gets a SIGABRT, which
+makes Python print the stack of every thread, and a SIGKILL a few seconds
+later.  Then this prints a line saying what happened, and exits with status
+124, like timeout(1).
+
+Signals that would stop this script (SIGTERM, SIGINT, SIGHUP) stop the
+command's process group too, and so does the death of this script's parent
+process (e.g. when Vim kills the shell that started this).
+
+This needs a Unix system (for process groups).
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+# How long to wait for the stack dump before killing the processes.
+GRACE_PERIOD = 5
+
+POLL_INTERVAL = 0.1
+
+TIMED_OUT = 124
+
+ORPHANED = 128 + signal.SIGKILL
+
+KILLED_MESSAGE = 'py-test-runner: test run killed after %g seconds%s'
+
+
+class Watchdog(object):
+
+    def __init__(self, argv, timeout=0, per_test_timeout=0,
+                 output=None, grace_period=GRACE_PERIOD):
+        self.argv = argv
+        self.timeout = timeout
+        self.per_test_timeout = per_test_timeout
+        self.output = output
+        self.grace_period = grace_period
+        self.process = None
+        self.last_output = None
+
+    def start(self):
+        # Output that sits in a buffer would look like a stuck test.
+        env = dict(os.environ, PYTHONFAULTHANDLER='1', PYTHONUNBUFFERED='1')
+        self.process = subprocess.Popen(
+            self.argv, env=env, stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            start_new_session=True)
+        self.last_output = time.monotonic()
+        self.parent = os.getppid()
+        self.reader = threading.Thread(target=self.copy_output)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def copy_output(self):
+        # Whatever is there, not whole lines: a test runner that prints a
+        # dot for every test is making progress too.
+        fd = self.process.stdout.fileno()
+        for data in iter(lambda: os.read(fd, 4096), b''):
+            self.last_output = time.monotonic()
+            self.output.write(data)
+            self.output.flush()
+
+    def signal(self, signum):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signum)
+        except OSError:
+            # Everything in it exited already.
+            pass
+
+    def check(self, started):
+        # Returns a reason for killing the process, or None.
+        now = time.monotonic()
+        if self.timeout and now - started > self.timeout:
+            return KILLED_MESSAGE % (self.timeout, ' (timeout)')
+        if (self.per_test_timeout
+                and now - self.last_output > self.per_test_timeout):
+            return KILLED_MESSAGE % (
+                self.per_test_timeout, ' without output (per_test_timeout)')
+        return None
+
+    def run(self):
+        # Returns the exit status.
+        started = time.monotonic()
+        self.start()
+        while True:
+            try:
+                status = self.process.wait(POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if os.getppid() != self.parent:
+                    # Nobody is waiting for the output any more.
+                    self.signal(signal.SIGKILL)
+                    return ORPHANED
+                reason = self.check(started)
+                if reason:
+                    self.kill()
+                    self.finish()
+                    self.output.write(reason.encode('UTF-8') + b'\n')
+                    self.output.flush()
+                    return TIMED_OUT
+        self.finish()
+        return status
+
+    def kill(self):
+        self.signal(signal.SIGABRT)
+        try:
+            self.process.wait(self.grace_period)
+        except subprocess.TimeoutExpired:
+            pass
+        self.signal(signal.SIGKILL)
+        self.process.wait()
+
+    def finish(self):
+        # Background processes started by the tests might keep the pipe
+        # open, so don't wait for them forever.
+        self.reader.join(self.grace_period)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s [options] command [arguments]',
+        description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--timeout', type=float, default=0,
+                        help='maximum duration of the whole run in seconds')
+    parser.add_argument('--per-test-timeout', type=float, default=0,
+                        help='maximum time without any output in seconds')
+    parser.add_argument('argv', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if not args.argv:
+        parser.error('no command to run')
+    return args
+
+
+def main():  # pragma: nocover -- runs in a separate process
+    args = parse_args()
+    watchdog = Watchdog(args.argv, args.timeout, args.per_test_timeout,
+                        output=sys.stdout.buffer)
+
+    def stop(signum, frame):
+        watchdog.signal(signal.SIGKILL)
+        sys.exit(128 + signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, stop)
+    sys.exit(watchdog.run())
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main()
@@ -0,0 +1,394 @@
+"""
+A warm pytest worker for py-test-runner.vim.
+
+Usage: python pytest_daemon.py [--stop] [pytest arguments]
+
+The first run starts a server in the background.  The server imports pytest,
+collects the tests you asked for (which imports your conftest.py files and
+everything they import), and then waits for requests on a Unix socket.  Each
+request is handled by a freshly forked child, so test runs can't affect each
+other, but they don't have to pay for interpreter startup and imports.
+
+There is one server per working directory.  It restarts when any of the
+project modules it imported change on disk, and exits after an hour of
+inactivity (or when you run this script with --stop).
+
+Each test run gets a process group of its own.  A SIGABRT sent to this script
+(e.g. by py_test_watchdog.py, to see where a test is stuck) is passed on to
+it, so the stack dump shows the test and not this script waiting for it.
+
+This needs a Unix system (for fork() and file descriptor passing).
+"""
+
+import array
+import hashlib
+import json
+import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+
+IDLE_TIMEOUT = 60 * 60
+STARTUP_TIMEOUT = 5 * 60
+
+CONFIG_FILES = (
+    'conftest.py', 'pytest.ini', 'setup.cfg', 'tox.ini', 'pyproject.toml',
+)
+
+
+def get_socket_dir():
+    # Only we should be able to create files here, or someone else could
+    # put a socket where we look for ours and get our stdout and stderr.
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'py-test-runner')
+    return os.path.join(tempfile.gettempdir(),
+                        'py-test-runner-%d' % os.getuid())
+
+
+def get_socket_path(workdir):
+    workdir = os.path.abspath(workdir)
+    digest = hashlib.sha1(workdir.encode('UTF-8')).hexdigest()[:12]
+    return os.path.join(get_socket_dir(), '%s.sock' % digest)
+
+
+def make_private_dir(dirname):
+    # Returns False if the directory exists but isn't ours alone.
+    try:
+        os.mkdir(dirname, 0o700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(dirname)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+            and not st.st_mode & 0o077)
+
+
+def send_message(conn, message, fds=()):
+    data = json.dumps(message).encode('UTF-8') + b'\n'
+    if fds:
+        conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               array.array('i', fds))])
+    else:
+        conn.sendall(data)
+
+
+def recv_message(conn, maxfds=0):
+    # Returns (message, fds), or (None, []) if the connection was closed.
+    fds = array.array('i')
+    data = b''
+    while not data.endswith(b'\n'):
+        if maxfds and not data:
+            chunk, ancdata, flags, addr = conn.recvmsg(
+                65536, socket.CMSG_LEN(maxfds * fds.itemsize))
+            for level, type, cmsg_data in ancdata:
+                if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg_data[:len(cmsg_data)
+                                            - len(cmsg_data) % fds.itemsize])
+        else:
+            chunk = conn.recv(65536)
+        if not chunk:
+            for fd in fds:
+                os.close(fd)
+            return None, []
+        data += chunk
+    return json.loads(data.decode('UTF-8')), list(fds)
+
+
+class ModuleWatcher(object):
+    """Notices when project modules imported by the server change."""
+
+    def __init__(self, root):
+        self.root = os.path.join(os.path.abspath(root), '')
+        self.mtimes = {}
+
+    @staticmethod
+    def get_mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def watch(self, filename):
+        self.mtimes[filename] = self.get_mtime(filename)
+
+    def snapshot(self):
+        for name in CONFIG_FILES:
+            self.watch(os.path.join(self.root, name))
+        for module in list(sys.modules.values()):
+            filename = getattr(module, '__file__', None)
+            if filename and os.path.abspath(filename).startswith(self.root):
+                self.watch(filename)
+
+    def changed(self):
+        return any(self.get_mtime(filename) != mtime
+                   for filename, mtime in self.mtimes.items())
+
+
+class Server(object):  # pragma: nocover -- runs in a separate process
+
+    def __init__(self, socket_path, workdir, idle_timeout=IDLE_TIMEOUT):
+        self.socket_path = socket_path
+        self.workdir = os.path.abspath(workdir)
+        self.idle_timeout = idle_timeout
+        self.watcher = ModuleWatcher(self.workdir)
+        self.children = set()
+
+    def warm_up(self, args):
+        import pytest
+        try:
+            pytest.main(['--collect-only', '-q'] + list(args))
+        except BaseException:
+            traceback.print_exc()
+        self.watcher.snapshot()
+
+    def listen(self):
+        conn = connect(self.socket_path)
+        if conn is not None:
+            # Another client started another server at the same time.
+            conn.close()
+            sys.exit(0)
+        if os.path.exists(self.socket_path):
+            # Left behind by a server that crashed.
+            os.unlink(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(5)
+        self.listener.settimeout(60)
+
+    def serve(self):
+        last_request = time.time()
+        try:
+            while time.time() - last_request < self.idle_timeout:
+                self.reap_children()
+                try:
+                    conn, addr = self.listener.accept()
+                except socket.timeout:
+                    continue
+                last_request = time.time()
+                conn.settimeout(None)
+                if not self.handle(conn):
+                    break
+        finally:
+            self.listener.close()
+            os.unlink(self.socket_path)
+
+    def reap_children(self):
+        for pid in list(self.children):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                self.children.discard(pid)
+
+    def handle(self, conn):
+        # Returns False when the server should exit.
+        request, fds = recv_message(conn, maxfds=2)
+        try:
+            if request is None:
+                return True
+            if request.get('stop'):
+                send_message(conn, {'stopped': True})
+                return False
+            if self.watcher.changed():
+                send_message(conn, {'restart': True})
+                return False
+            pid = os.fork()
+            if pid == 0:
+                self.listener.close()
+                self.run_child(conn, request, fds)
+            self.children.add(pid)
+            return True
+        finally:
+            conn.close()
+            for fd in fds:
+                os.close(fd)
+
+    def run_child(self, conn, request, fds):
+        status = 1
+        try:
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.dup2(fds[0], 1)
+            os.dup2(fds[1], 2)
+            # For SIGABRTs that the client passes on
+            import faulthandler
+            faulthandler.enable()
+            send_message(conn, {'pid': os.getpid()})
+            os.chdir(request['cwd'])
+            watcher = threading.Thread(target=self.kill_when_closed,
+                                       args=(conn, ))
+            watcher.daemon = True
+            watcher.start()
+            import pytest
+            status = pytest.main(request['args'])
+        except SystemExit as e:
+            status = e.code
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                send_message(conn, {'status': int(status or 0)})
+            finally:
+                os._exit(0)
+
+    @staticmethod
+    def kill_when_closed(conn):
+        # The client sends nothing more, so this returns only when the client
+        # goes away (e.g. because you started another test run in Vim).
+        conn.recv(1)
+        os.killpg(0, signal.SIGKILL)
+
+
+def serve(socket_path, args):  # pragma: nocover -- runs in the server
+    server = Server(socket_path, os.getcwd())
+    server.listen()
+    server.warm_up(args)
+    server.serve()
+
+
+def connect(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except (OSError, socket.error):
+        conn.close()
+        return None
+    return conn
+
+
+def start_server(socket_path, args):
+    with open(socket_path + '.log', 'wb') as log:
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__),
+             '--serve', socket_path, '--'] + list(args),
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            close_fds=True, start_new_session=True)
+
+
+def wait_for_server(socket_path, process, timeout=STARTUP_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        conn = connect(socket_path)
+        if conn is not None:
+            return conn
+        if process.poll() is not None:
+            break
+        time.sleep(0.05)
+    return None
+
+
+def wait_for_exit(socket_path, timeout=5):
+    deadline = time.time() + timeout
+    while os.path.exists(socket_path):
+        if time.time() > deadline:
+            os.unlink(socket_path)
+            break
+        time.sleep(0.05)
+
+
+@contextmanager
+def forward_signal(signum, pgid):
+    # Sends the signal on to a process group while in the with block.
+    # Yields a list of the signals that were forwarded.
+    forwarded = []
+
+    def handler(signum, frame):
+        forwarded.append(signum)
+        try:
+            os.killpg(pgid, signum)
+        except OSError:
+            # It's gone already
+            pass
+
+    old_handler = signal.signal(signum, handler)
+    try:
+        yield forwarded
+    finally:
+        # None means a handler that wasn't set from Python (faulthandler's)
+        signal.signal(signum, signal.SIG_DFL if old_handler is None
+                      else old_handler)
+
+
+def run_without_server(args):
+    return subprocess.call([sys.executable, '-m', 'pytest'] + list(args))
+
+
+def run(args, workdir=None):
+    workdir = workdir or os.getcwd()
+    socket_path = get_socket_path(workdir)
+    if not make_private_dir(os.path.dirname(socket_path)):
+        sys.stderr.write('pytest daemon not started: %s is not private\n'
+                         % os.path.dirname(socket_path))
+        return run_without_server(args)
+    request = {'cwd': os.getcwd(), 'args': list(args)}
+    for attempt in range(2):
+        conn = connect(socket_path)
+        if conn is None:
+            process = start_server(socket_path, args)
+            conn = wait_for_server(socket_path, process)
+        if conn is None:
+            sys.stderr.write('pytest daemon failed to start, see %s.log\n'
+                             % socket_path)
+            return run_without_server(args)
+        with conn:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            send_message(conn, request, fds=[1, 2])
+            reply, fds = recv_message(conn)
+            forwarded = []
+            if reply is not None and 'pid' in reply:
+                # The test run started, in a process group of its own
+                with forward_signal(signal.SIGABRT,
+                                    reply['pid']) as forwarded:
+                    reply, fds = recv_message(conn)
+        if reply is None and forwarded:
+            # Python dumped the stack of the test run and aborted it.
+            return 128 + forwarded[0]
+        if reply is None:
+            sys.stderr.write('pytest daemon crashed, see %s.log\n'
+                             % socket_path)
+            return 1
+        if not reply.get('restart'):
+            return reply['status']
+        # The server noticed changed source files and is about to exit.
+        wait_for_exit(socket_path)
+    # The server restarted twice in a row?
+    return run_without_server(args)  # pragma: nocover
+
+
+def stop(workdir=None):
+    socket_path = get_socket_path(workdir or os.getcwd())
+    conn = connect(socket_path)
+    if conn is None:
+        return False
+    with conn:
+        send_message(conn, {'stop': True})
+        recv_message(conn)
+    wait_for_exit(socket_path)
+    return True
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]  # pragma: nocover
+    if argv[:1] == ['--serve']:  # pragma: nocover -- runs in the server
+        serve(argv[1], argv[3:])
+        return 0
+    if argv[:1] == ['--stop']:
+        stop()
+        return 0
+    return run(argv)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    sys.exit(main())
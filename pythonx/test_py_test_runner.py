@@ -1,11 +1,35 @@
+import ast
+import json
 import os
+import sqlite3
+import subprocess
+import sys
 import textwrap
+import time
+from collections import OrderedDict
 from functools import partial
 
+import pytest
+
 import py_test_runner
 from py_test_runner import PyTestRunner, RunnerConfiguration
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+@pytest.fixture(autouse=True)
+def package_cache(monkeypatch):
+    # Some tests fake is_package_directory(), so don't let get_package()
+    # remember the results.
+    cache = py_test_runner.PackageCache()
+    monkeypatch.setattr(py_test_runner, 'package_cache', cache)
+    return cache
+
+
 def test_RunnerConfiguration_clean_tag():
     clean_tag = RunnerConfiguration.clean_tag
     assert clean_tag('foo') == 'foo'
@@ -24,6 +48,52 @@ def test_RunnerConfiguration_expand():
                   class_='Foo', method='bar') == '{filename}::Foo::bar'
 
 
+def test_RunnerConfiguration_expand_single_pass():
+    expand = RunnerConfiguration.expand
+    # Values are not expanded again
+    assert expand('{class}::{method}',
+                  class_='{method}', method='bar') == '{method}::bar'
+    assert expand('-k {method}[0-9]{2}', method='x') == '-k x[0-9]{2}'
+    assert expand('', method='x') == ''
+
+
+def test_FilterTemplate():
+    template = py_test_runner.FilterTemplate('{filename}::{class}.{foo}')
+    assert template.segments == [
+        ('', 'filename'), ('::', 'class'), ('.', 'foo'),
+    ]
+    assert template.unknown_placeholders() == ['foo']
+    assert template.render({'class_': 'Foo'}) == '{filename}::Foo.{foo}'
+
+
+def test_compile_template_is_cached():
+    compile_template = py_test_runner.compile_template
+    assert compile_template('-k {method}') is compile_template('-k {method}')
+
+
+def test_check_filter_templates():
+    assert py_test_runner.check_filter_templates(make_config('''
+        [runner:foo]
+        command = foo {pytest_daemon}
+        filter_for_class = {filename}::{klass}
+        filter_for_method = 100% {method}
+        filter_for_function = -k '{function}_[0-9]{2}'
+    ''')) == [
+        'Unknown placeholder {klass} in filter_for_class in [runner:foo]',
+    ]
+    config = PyTestRunner.load_configuration('/dev/null')
+    assert py_test_runner.check_filter_templates(config) == []
+
+
+def test_config_cache_warns_about_unknown_placeholders(tmp_path, capsys):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nfilter_for_file = {file}\n')
+    py_test_runner.ConfigCache().get(configfile)
+    assert capsys.readouterr().out == (
+        '%s: Unknown placeholder {file} in filter_for_file in [default]\n'
+        % configfile)
+
+
 def test_RunnerConfiguration_join():
     join = RunnerConfiguration.join
     assert join() == ''
@@ -90,19 +160,60 @@ def test_RunnerConfiguration_split_class_method():
 
 
 def test_RunnerConfiguration_is_ignored():
-    rc = RunnerConfiguration()
-    rc.ignore_functions_and_methods = ['bad', 'beef']
+    rc = RunnerConfiguration(ignore_functions_and_methods=('bad', 'beef'))
     is_ignored = rc.is_ignored
     assert is_ignored('bad')
     assert not is_ignored('good')
 
 
+def test_RunnerConfiguration_is_immutable():
+    rc = RunnerConfiguration(filter_for_file='{filename}')
+    with pytest.raises(AttributeError):
+        rc.filter_for_file = ''
+    with pytest.raises(AttributeError):
+        del rc.filter_for_file
+    with pytest.raises(AttributeError):
+        rc.foo = 'bar'
+    with pytest.raises(TypeError):
+        RunnerConfiguration(filter_for_foo='{filename}')
+
+
+def test_RunnerConfiguration_replace():
+    rc = RunnerConfiguration(filter_for_file='{filename}')
+    assert rc.replace() is rc
+    new = rc.replace(shards='2')
+    assert new.filter_for_file == '{filename}'
+    assert new.shards == '2'
+    assert rc.shards == '1'
+    assert repr(new) == (
+        "RunnerConfiguration(filter_for_file='{filename}', shards='2')")
+
+
+def test_RunnerConfiguration_is_hashable():
+    rc = RunnerConfiguration(shards='2')
+    assert rc == RunnerConfiguration().replace(shards='2')
+    assert not rc != RunnerConfiguration().replace(shards='2')
+    assert rc != RunnerConfiguration()
+    assert rc != 'shards=2'
+    assert not rc == 'shards=2'
+    assert {rc: 1}[RunnerConfiguration(shards='2')] == 1
+
+
+def test_intern_configuration(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'configurations', {})
+    rc = RunnerConfiguration(shards='2')
+    assert py_test_runner.intern_configuration(rc) is rc
+    assert py_test_runner.intern_configuration(
+        RunnerConfiguration(shards='2')) is rc
+
+
 def test_construct_tag_filter():
-    rc = RunnerConfiguration()
-    rc.filter_for_doctest = '-d {function}'
-    rc.filter_for_function = '-f {function}'
-    rc.filter_for_class = '-c {class}'
-    rc.filter_for_method = '-m {class}::{method}'
+    rc = RunnerConfiguration(
+        filter_for_doctest='-d {function}',
+        filter_for_function='-f {function}',
+        filter_for_class='-c {class}',
+        filter_for_method='-m {class}::{method}',
+    )
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('test_foo') == '-f test_foo'
     assert ctf('doctest_foo') == '-d doctest_foo'
@@ -111,80 +222,78 @@ def test_construct_tag_filter():
 
 
 def test_construct_tag_filter_cleans_the_tag():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(filter_for_function='-f {function}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('[in test_foo (function)]') == '-f test_foo'
 
 
-def test_construct_tag_filter_doctest_full_module():
-    rc = RunnerConfiguration()
-    rc.is_package_directory = lambda d: (
-        os.path.relpath(d).replace(os.path.sep, '/') in (
-            'src/pkg',
-        )
-    )
-    rc.filter_for_doctest = '-m {full_module} -f {function}'
+def test_construct_tag_filter_doctest_full_module(monkeypatch):
+    monkeypatch.setattr(
+        RunnerConfiguration, 'is_package_directory', lambda self, d: (
+            os.path.relpath(d).replace(os.path.sep, '/') in (
+                'src/pkg',
+            )
+        ))
+    rc = RunnerConfiguration(
+        filter_for_doctest='-m {full_module} -f {function}')
     ctf = partial(rc.construct_tag_filter, 'src/pkg/filename.py')
     assert ctf('doctest_foo') == '-m pkg.filename -f doctest_foo'
 
 
 def test_construct_tag_filter_no_doctest_specialization():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(filter_for_function='-f {function}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('doctest_foo') == '-f doctest_foo'
 
 
 def test_construct_tag_filter_no_class_specialization():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(filter_for_function='-f {function}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('TestFoo') == '-f TestFoo'
 
 
 def test_construct_tag_filter_no_method_specialization():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(filter_for_function='-f {function}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('TestFoo.test_foo') == '-f test_foo'
 
 
 def test_construct_tag_filter_inner_function_in_method():
-    rc = RunnerConfiguration()
-    rc.filter_for_method = '-m {class}::{method}'
+    rc = RunnerConfiguration(filter_for_method='-m {class}::{method}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('TestFoo.test_bar.inner') == '-m TestFoo::test_bar'
 
 
 def test_construct_tag_filter_inner_function_in_function():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
-    rc.filter_for_method = '-m {class}::{method}'
+    rc = RunnerConfiguration(
+        filter_for_function='-f {function}',
+        filter_for_method='-m {class}::{method}',
+    )
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('test_bar.inner') == '-f test_bar'
 
 
 def test_construct_tag_filter_ignored_method():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
-    rc.filter_for_class = '-c {class}'
-    rc.filter_for_method = '-m {class}::{method}'
+    rc = RunnerConfiguration(
+        filter_for_function='-f {function}',
+        filter_for_class='-c {class}',
+        filter_for_method='-m {class}::{method}',
+    )
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('TestFoo.__init__') == '-c TestFoo'
 
 
 def test_construct_tag_filter_ignored_method_no_class_specialization():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
-    rc.filter_for_method = '-m {class}::{method}'
+    rc = RunnerConfiguration(
+        filter_for_function='-f {function}',
+        filter_for_method='-m {class}::{method}',
+    )
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('TestFoo.__init__') == '-f TestFoo'
 
 
 def test_construct_tag_filter_ignored_function():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(filter_for_function='-f {function}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('setUp') == ''
 
@@ -196,8 +305,7 @@ def test_construct_tag_filter_no_configuration():
 
 
 def test_construct_tag_filter_no_tag():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(filter_for_function='-f {function}')
     ctf = partial(rc.construct_tag_filter, 'filename.py')
     assert ctf('') == ''
     assert ctf('[]') == ''
@@ -206,7 +314,7 @@ def test_construct_tag_filter_no_tag():
 def test_prepare_filename():
     rc = RunnerConfiguration()
     assert rc.prepare_filename('foo.py') == 'foo.py'
-    rc.absolute_filenames = True
+    rc = rc.replace(absolute_filenames=True)
     assert rc.prepare_filename('foo.py') == os.path.abspath('foo.py')
 
 
@@ -220,83 +328,227 @@ def test_get_module():
     assert rc.get_module('foo/__init__.py') == ''
 
 
-def test_get_package():
+def test_get_package(monkeypatch):
+    monkeypatch.setattr(
+        RunnerConfiguration, 'is_package_directory', lambda self, d: (
+            os.path.relpath(d).replace(os.path.sep, '/') in (
+                'src/pkg',
+                'src/pkg/sub',
+            )
+        ))
     rc = RunnerConfiguration()
-    rc.is_package_directory = lambda d: (
-        os.path.relpath(d).replace(os.path.sep, '/') in (
-            'src/pkg',
-            'src/pkg/sub',
-        )
-    )
     assert rc.get_package('src/foo.py') == ''
     assert rc.get_package('src/pkg/foo.py') == 'pkg'
     assert rc.get_package('src/pkg/sub/foo.py') == 'pkg.sub'
     assert rc.get_package('src/pkg/sub/__init__.py') == 'pkg.sub'
 
 
-def test_get_package_no_infinite_loop_in_perverse_configs():
+def test_get_package_no_infinite_loop_in_perverse_configs(monkeypatch):
+    monkeypatch.setattr(RunnerConfiguration, 'is_package_directory',
+                        lambda self, d: True)
     rc = RunnerConfiguration()
-    rc.is_package_directory = lambda d: True
     rc.get_package('foo.py')
 
 
-def test_construct_filter_no_tag():
+def test_get_package_real_directories(tmp_path):
+    (tmp_path / 'pkg' / 'sub').mkdir(parents=True)
+    (tmp_path / 'pkg' / '__init__.py').write_text('')
+    (tmp_path / 'pkg' / 'sub' / '__init__.py').write_text('')
     rc = RunnerConfiguration()
-    rc.filter_for_file = '-F {filename}'
-    rc.filter_for_function = '-f {function}'
+    assert rc.get_package(str(tmp_path / 'pkg' / 'sub' / 'foo.py')) == (
+        'pkg.sub'
+    )
+    assert rc.get_package(str(tmp_path / 'foo.py')) == ''
+
+
+def test_get_package_notices_new_init_py(tmp_path):
+    (tmp_path / 'pkg').mkdir()
+    rc = RunnerConfiguration()
+    assert rc.get_package(str(tmp_path / 'pkg' / 'foo.py')) == ''
+    (tmp_path / 'pkg' / '__init__.py').write_text('')
+    os.utime(str(tmp_path / 'pkg'), (0, 0))
+    assert rc.get_package(str(tmp_path / 'pkg' / 'foo.py')) == 'pkg'
+
+
+def test_get_package_namespace_packages(tmp_path):
+    (tmp_path / 'setup.py').write_text('')
+    (tmp_path / 'ns' / 'pkg').mkdir(parents=True)
+    (tmp_path / 'ns' / 'pkg' / '__init__.py').write_text('')
+    rc = RunnerConfiguration()
+    filename = str(tmp_path / 'ns' / 'pkg' / 'foo.py')
+    assert rc.get_package(filename) == 'pkg'
+    rc = rc.replace(namespace_packages=True)
+    assert rc.get_package(filename) == 'ns.pkg'
+    assert rc.get_package(str(tmp_path / 'ns' / 'foo.py')) == 'ns'
+    assert rc.get_package(str(tmp_path / 'foo.py')) == ''
+
+
+def test_get_package_namespace_packages_src_layout(tmp_path):
+    (tmp_path / 'pyproject.toml').write_text('')
+    (tmp_path / 'src' / 'ns' / 'pkg').mkdir(parents=True)
+    rc = RunnerConfiguration(namespace_packages=True)
+    filename = str(tmp_path / 'src' / 'ns' / 'pkg' / 'foo.py')
+    assert rc.get_package(filename) == 'ns.pkg'
+
+
+def test_get_package_namespace_packages_outside_projects(tmp_path):
+    (tmp_path / 'ns').mkdir()
+    (tmp_path / 'not-a-package' / 'ns').mkdir(parents=True)
+    (tmp_path / 'not-a-package' / 'setup.py').write_text('')
+    rc = RunnerConfiguration(namespace_packages=True)
+    assert rc.get_package(str(tmp_path / 'ns' / 'foo.py')) == ''
+    (tmp_path / 'setup.py').write_text('')
+    filename = str(tmp_path / 'not-a-package' / 'ns' / 'foo.py')
+    assert rc.get_package(filename) == 'ns'
+
+
+def test_PackageCache(tmp_path):
+    cache = py_test_runner.PackageCache()
+    (tmp_path / '__init__.py').write_text('')
+    info = cache.get(str(tmp_path))
+    assert info.is_package
+    assert not info.is_project_root
+    assert cache.get(str(tmp_path)) is info
+    cache.clear()
+    assert cache.get(str(tmp_path)) is not info
+
+
+def test_PackageCache_missing_directory(tmp_path):
+    cache = py_test_runner.PackageCache()
+    info = cache.get(str(tmp_path / 'nosuchdir'))
+    assert not info.is_package
+    assert cache.entries == {}
+
+
+def test_PackageCache_unreadable_directory(tmp_path, monkeypatch):
+    def listdir(dirname):
+        raise OSError('permission denied')
+    monkeypatch.setattr(os, 'listdir', listdir)
+    cache = py_test_runner.PackageCache()
+    assert not cache.get(str(tmp_path)).is_package
+
+
+def test_get_package_caches_leaf_and_parents(tmp_path, monkeypatch,
+                                             package_cache):
+    (tmp_path / 'a' / 'b' / 'c').mkdir(parents=True)
+    for subdir in ['a', 'a/b', 'a/b/c']:
+        (tmp_path / subdir / '__init__.py').write_text('')
+    rc = RunnerConfiguration()
+    assert rc.get_package(str(tmp_path / 'a' / 'b' / 'c' / 'x.py')) == (
+        'a.b.c')
+    packages = package_cache.packages
+    assert packages[str(tmp_path / 'a' / 'b'), False][0] == 'a.b'
+    assert packages[str(tmp_path), False][0] == ''
+    stats = []
+    real_stat = os.stat
+
+    def stat(*args, **kw):
+        stats.append(args[0])
+        return real_stat(*args, **kw)
+
+    monkeypatch.setattr(os, 'stat', stat)
+    monkeypatch.setattr(os, 'listdir', None)
+    filename = str(tmp_path / 'a' / 'b' / 'y.py')
+    assert rc.get_package(filename) == 'a.b'
+    # One stat() per level, and no listdir()
+    assert stats == [str(tmp_path / 'a' / 'b'), str(tmp_path / 'a'),
+                     str(tmp_path)]
+    monkeypatch.undo()
+    # Changes further up are noticed too.
+    (tmp_path / 'a' / '__init__.py').unlink()
+    os.utime(str(tmp_path / 'a'), (0, 0))
+    assert rc.get_package(filename) == 'b'
+    (tmp_path / 'a' / 'b' / '__init__.py').unlink()
+    os.utime(str(tmp_path / 'a' / 'b'), (0, 0))
+    assert rc.get_package(filename) == ''
+    (tmp_path / 'a' / 'b' / 'c' / '__init__.py').unlink()
+    (tmp_path / 'a' / 'b' / 'c').rmdir()
+    assert rc.get_package(str(tmp_path / 'a' / 'b' / 'c' / 'x.py')) == ''
+
+
+def test_get_package_namespace_packages_depend_on_project_root(
+        tmp_path, package_cache):
+    (tmp_path / 'src' / 'ns' / 'pkg').mkdir(parents=True)
+    (tmp_path / 'src' / 'ns' / 'pkg' / '__init__.py').write_text('')
+    (tmp_path / 'setup.py').write_text('')
+    rc = RunnerConfiguration(namespace_packages=True)
+    filename = str(tmp_path / 'src' / 'ns' / 'pkg' / 'x.py')
+    assert rc.get_package(filename) == 'ns.pkg'
+    assert [dirname for dirname, mtime in package_cache.packages[
+        str(tmp_path / 'src' / 'ns'), True][1]] == [
+            str(tmp_path / 'src' / 'ns'), str(tmp_path / 'src'),
+            str(tmp_path)]
+    assert rc.get_package(filename) == 'ns.pkg'
+    (tmp_path / 'setup.py').unlink()
+    os.utime(str(tmp_path), (0, 0))
+    assert rc.get_package(filename) == 'pkg'
+
+
+def test_construct_filter_no_tag():
+    rc = RunnerConfiguration(
+        filter_for_file='-F {filename}',
+        filter_for_function='-f {function}',
+    )
     cf = rc.construct_filter
     assert cf('test_foo.py', '') == '-F test_foo.py'
     assert cf('test_foo.py', 'setUp') == '-F test_foo.py'
 
 
 def test_construct_filter_with_tag():
-    rc = RunnerConfiguration()
-    rc.filter_for_file = '-F {filename}'
-    rc.filter_for_function = '-f {function}'
+    rc = RunnerConfiguration(
+        filter_for_file='-F {filename}',
+        filter_for_function='-f {function}',
+    )
     cf = rc.construct_filter
     assert cf('test_foo.py', 'test_bar') == '-F test_foo.py -f test_bar'
 
 
 def test_construct_filter_with_tag_combined():
-    rc = RunnerConfiguration()
-    rc.filter_for_file = '-F {filename}'
-    rc.filter_for_function = '{filename}::{function}'
+    rc = RunnerConfiguration(
+        filter_for_file='-F {filename}',
+        filter_for_function='{filename}::{function}',
+    )
     cf = rc.construct_filter
     assert cf('test_foo.py', 'test_bar') == 'test_foo.py::test_bar'
 
 
 def test_construct_filter_absolute_filename():
-    rc = RunnerConfiguration()
-    rc.filter_for_file = '-F {filename}'
-    rc.absolute_filenames = True
+    rc = RunnerConfiguration(
+        filter_for_file='-F {filename}',
+        absolute_filenames=True,
+    )
     cf = rc.construct_filter
     assert cf('test_foo.py', '') == '-F ' + os.path.abspath('test_foo.py')
 
 
 def test_construct_filter_with_module():
-    rc = RunnerConfiguration()
-    rc.filter_for_module = '-m {module}'
-    rc.filter_for_function = '-t {function}'
+    rc = RunnerConfiguration(
+        filter_for_module='-m {module}',
+        filter_for_function='-t {function}',
+    )
     cf = rc.construct_filter
     assert cf('pkg/test_foo.py', 'test_bar') == '-m test_foo -t test_bar'
 
 
 def test_construct_filter_with_module_ignores_init():
-    rc = RunnerConfiguration()
-    rc.filter_for_module = '-m {module}'
-    rc.filter_for_function = '-t {function}'
+    rc = RunnerConfiguration(
+        filter_for_module='-m {module}',
+        filter_for_function='-t {function}',
+    )
     cf = rc.construct_filter
     assert cf('pkg/__init__.py', 'test_bar') == '-t test_bar'
 
 
-def test_construct_filter_with_package():
-    rc = RunnerConfiguration()
-    rc.filter_for_package = '-p {package}'
-    rc.filter_for_module = '-m {module}'
-    rc.filter_for_function = '-t {function}'
-    rc.is_package_directory = lambda d: (
-        os.path.relpath(d).replace(os.path.sep, '/') == 'pkg'
+def test_construct_filter_with_package(monkeypatch):
+    rc = RunnerConfiguration(
+        filter_for_package='-p {package}',
+        filter_for_module='-m {module}',
+        filter_for_function='-t {function}',
     )
+    monkeypatch.setattr(
+        RunnerConfiguration, 'is_package_directory', lambda self, d: (
+            os.path.relpath(d).replace(os.path.sep, '/') == 'pkg'
+        ))
     cf = rc.construct_filter
     assert cf('pkg/test_foo.py', 'test_bar') == (
         '-p pkg -m test_foo -t test_bar'
@@ -304,10 +556,11 @@ def test_construct_filter_with_package():
 
 
 def test_construct_filter_with_directory():
-    rc = RunnerConfiguration()
-    rc.filter_for_directory = '-d {directory}'
-    rc.filter_for_module = '-m {module}'
-    rc.filter_for_function = '-t {function}'
+    rc = RunnerConfiguration(
+        filter_for_directory='-d {directory}',
+        filter_for_module='-m {module}',
+        filter_for_function='-t {function}',
+    )
     cf = rc.construct_filter
     assert cf('pkg/test_foo.py', 'test_bar') == (
         '-d pkg -m test_foo -t test_bar'
@@ -318,11 +571,12 @@ def test_construct_filter_with_directory():
 
 
 def test_construct_filter_with_directory_when_using_absolute_filenames():
-    rc = RunnerConfiguration()
-    rc.filter_for_directory = '-d {directory}'
-    rc.filter_for_module = '-m {module}'
-    rc.filter_for_function = '-t {function}'
-    rc.absolute_filenames = True
+    rc = RunnerConfiguration(
+        filter_for_directory='-d {directory}',
+        filter_for_module='-m {module}',
+        filter_for_function='-t {function}',
+        absolute_filenames=True,
+    )
     cf = rc.construct_filter
     assert cf('pkg/test_foo.py', 'test_bar') == (
         '-d %s -m test_foo -t test_bar' % os.path.abspath('pkg')
@@ -330,34 +584,113 @@ def test_construct_filter_with_directory_when_using_absolute_filenames():
 
 
 def test_construct_filter_doctest_file():
-    rc = RunnerConfiguration()
-    rc.filter_for_doctest = '-d {function}'
-    rc.filter_for_function = '-t {function}'
+    rc = RunnerConfiguration(
+        filter_for_doctest='-d {function}',
+        filter_for_function='-t {function}',
+    )
     cf = rc.construct_filter
     assert cf('doctests/test.txt', '') == '-d test.txt'
 
 
 def test_construct_filter_doctest_file_no_explicit_doctest_config():
-    rc = RunnerConfiguration()
-    rc.filter_for_function = '-t {function}'
+    rc = RunnerConfiguration(filter_for_function='-t {function}')
     cf = rc.construct_filter
     assert cf('doctests/test.txt', '') == '-t test.txt'
 
 
-def test_construct_command():
+def test_construct_filters():
+    rc = RunnerConfiguration(
+        filter_for_module='-m {module}',
+        filter_for_function='-t {function}',
+        filter_for_class='-t {class}',
+        filter_for_method='-t {method}',
+        filter_for_doctest='{filename}::{function}',
+    )
+    cf = rc.construct_filters
+    assert cf('test_foo.py', ['test_a', 'TestFoo.test_b', 'TestBar.test_c']
+              ) == '-m test_foo -t test_a -t test_b -t test_c'
+    assert cf('test_foo.py', ['doctest_a', 'test_b']) == (
+        'test_foo.py::doctest_a -m test_foo -t test_b')
+    assert cf('test_foo.py', ['doctest_a']) == 'test_foo.py::doctest_a'
+    assert cf('test_foo.py', ['test_suite', 'test_b']) == (
+        '-m test_foo')
+    assert cf('test_foo.py', []) == '-m test_foo'
+    assert cf('test.txt', ['test_b']) == 'test.txt::test.txt'
+
+
+def test_construct_filters_one_tag_same_as_construct_filter():
+    rc = RunnerConfiguration(
+        ignore_functions_and_methods=('__init__', 'setUp', 'test_suite'),
+        filter_for_file='{filename}',
+        filter_for_doctest='{filename}::{full_module}.{function}',
+        filter_for_function='{filename}::{function}',
+        filter_for_class='{filename}::{class}',
+        filter_for_method='{filename}::{class}::{method}',
+    )
+    cf = rc.construct_filters
+    assert cf('test_a.py', ['Foo.__init__']) == (
+        'test_a.py::test_a.Foo.__init__')
+    assert cf('test_a.py', ['Foo.__init__', 'Foo']) == (
+        'test_a.py::test_a.Foo.__init__ test_a.py::test_a.Foo')
+    assert cf('test_a.py', ['doctest_a.inner', 'doctest_a']) == (
+        'test_a.py::test_a.doctest_a.inner test_a.py::test_a.doctest_a')
+    assert cf('test_a.py', ['TestFoo.setUp']) == 'test_a.py::TestFoo'
+    assert cf('test_a.py', ['test_suite']) == 'test_a.py'
+
+
+def test_construct_filters_whole_file():
+    # A tag that the runner can't select means the whole file, so the other
+    # tags don't narrow it down.
+    rc = RunnerConfiguration(
+        ignore_functions_and_methods=('setUp',),
+        filter_for_class='-k {class}',
+        filter_for_method="-k '{method} [(].*[.]{class}[)]'",
+    )
+    cf = rc.construct_filters
+    assert cf('test_a.py', ['test_a']) == ''
+    assert cf('test_a.py', ['test_a', 'TestFoo.test_b']) == ''
+    assert cf('test_a.py', ['TestFoo.test_b', 'TestBar']) == (
+        "-k 'test_b [(].*[.]TestFoo[)]' -k TestBar")
+    rc = rc.replace(filter_for_module='-m {module}',
+                    filter_for_function='-t {function}')
+    assert rc.construct_filters('test_a.py', ['setUp', 'test_b']) == (
+        '-m test_a')
+
+
+def test_merge_tags():
     rc = RunnerConfiguration()
-    rc.command = 'pytest -ra'
-    rc.filter_for_function = '{filename}::{function}'
+    assert rc.merge_tags([
+        'TestFoo.test_a', 'TestFoo', 'TestBar.test_b', 'test_c.inner',
+        'test_c', '[TestBar.test_b]', 'TestBaz.setUp', 'TestBaz.test_d',
+    ]) == ['TestFoo', 'TestBar.test_b', 'test_c', 'TestBaz']
+    assert rc.merge_tags(['TestFoo.test_a', '']) == ['']
+    assert rc.merge_tags([]) == ['']
+
+
+def test_filter_tests():
+    rc = RunnerConfiguration()
+    assert rc.filter_tests([
+        '', 'TestFoo', 'TestFoo.setUp', 'TestFoo.test_bar',
+        'TestFoo.test_bar.inner', 'doctest_foo', 'helper', '[test_baz]',
+    ]) == ['TestFoo.test_bar', 'doctest_foo', 'test_baz']
+
+
+def test_construct_command():
+    rc = RunnerConfiguration(
+        command='pytest -ra',
+        filter_for_function='{filename}::{function}',
+    )
     cc = rc.construct_command
     assert cc('test_foo.py', 'test_bar') == 'pytest -ra test_foo.py::test_bar'
 
 
 def test_construct_clipboard_command():
-    rc = RunnerConfiguration()
-    rc.command = 'pytest -ra'
-    rc.filter_for_function = '{filename}::{function}'
-    rc.clipboard_extras = '--color=auto'
-    rc.clipboard_extras_suffix = '2>&1 | less -R'
+    rc = RunnerConfiguration(
+        command='pytest -ra',
+        filter_for_function='{filename}::{function}',
+        clipboard_extras='--color=auto',
+        clipboard_extras_suffix='2>&1 | less -R',
+    )
     ccc = rc.construct_clipboard_command
     assert ccc('test_foo.py', 'test_bar') == (
         'pytest -ra --color=auto test_foo.py::test_bar 2>&1 | less -R'
@@ -365,11 +698,12 @@ def test_construct_clipboard_command():
 
 
 def test_construct_clipboard_command_no_extras():
-    rc = RunnerConfiguration()
-    rc.command = 'pytest -ra'
-    rc.filter_for_function = '{filename}::{function}'
-    rc.clipboard_extras = ''
-    rc.clipboard_extras_suffix = ''
+    rc = RunnerConfiguration(
+        command='pytest -ra',
+        filter_for_function='{filename}::{function}',
+        clipboard_extras='',
+        clipboard_extras_suffix='',
+    )
     ccc = rc.construct_clipboard_command
     assert ccc('test_foo.py', 'test_bar') == (
         'pytest -ra test_foo.py::test_bar'
@@ -377,10 +711,11 @@ def test_construct_clipboard_command_no_extras():
 
 
 def test_construct_clipboard_command_with_workdir():
-    rc = RunnerConfiguration()
-    rc.workdir = 'src'
-    rc.command = 'pytest'
-    rc.filter_for_function = '{filename}::{function}'
+    rc = RunnerConfiguration(
+        workdir='src',
+        command='pytest',
+        filter_for_function='{filename}::{function}',
+    )
     ccc = rc.construct_clipboard_command
     assert ccc('test_foo.py', 'test_bar') == (
         '(cd src && pytest test_foo.py::test_bar)'
@@ -408,8 +743,10 @@ def test_use_runner_bad():
 def test_get_runner():
     ptr = PyTestRunner('/dev/null')
     rc = ptr.get_runner('')
-    rc.filter_for_doctest = '-k {function}'  # makes the output neater
-    rc.absolute_filenames = False  # makes the test easier
+    rc = rc.replace(
+        filter_for_doctest='-k {function}',  # makes the output neater
+        absolute_filenames=False,  # makes the test easier
+    )
     assert rc.construct_command('foo.py', 'doctest_bar') == (
         'pytest -ra foo.py -k doctest_bar'
     )
@@ -451,15 +788,855 @@ def test_overrides(tmp_path):
     )
 
 
+def test_get_runner_shares_configurations(tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text(textwrap.dedent('''
+        [path:/src]
+        namespace_packages = yes
+        ignore_functions_and_methods = setUp tearDown
+
+        [path:/src/foo]
+        shards = 2
+    '''))
+    ptr = PyTestRunner(configfile)
+    rc = ptr.get_runner('/src/a.py')
+    assert rc.namespace_packages is True
+    assert rc.ignore_functions_and_methods == ('setUp', 'tearDown')
+    assert ptr.get_delta('path:/src/foo') == (('shards', '2'),)
+    assert ptr.get_runner('/src/b.py') is rc
+    assert PyTestRunner(configfile).get_runner('/src/bar/c.py') is rc
+    assert ptr.get_runner('/src/foo/d.py') == rc.replace(shards='2')
+
+
+SAMPLE_SOURCE = textwrap.dedent('''\
+    import unittest
+
+
+    def doctest_foo():
+        """
+            >>> 1 + 1
+            2
+        """
+
+
+    class TestFoo(unittest.TestCase):
+
+        def setUp(self):
+            pass
+
+        @unittest.skip('later')
+        def test_bar(self):
+            def inner():
+                pass
+
+            inner()
+
+        async def test_baz(self):
+            pass
+
+    x = 42
+''')
+
+
+def test_TagIndex():
+    index = py_test_runner.TagIndex(SAMPLE_SOURCE)
+    assert index.find(1) == ''
+    assert index.find(4) == 'doctest_foo'
+    assert index.find(8) == 'doctest_foo'
+    assert index.find(9) == ''
+    assert index.find(11) == 'TestFoo'
+    assert index.find(12) == 'TestFoo'
+    assert index.find(13) == 'TestFoo.setUp'
+    assert index.find(15) == 'TestFoo'
+    assert index.find(16) == 'TestFoo.test_bar'
+    assert index.find(18) == 'TestFoo.test_bar.inner'
+    assert index.find(20) == 'TestFoo.test_bar'
+    assert index.find(23) == 'TestFoo.test_baz'
+    assert index.find(26) == ''
+
+
+def test_TagIndex_find_range():
+    index = py_test_runner.TagIndex(SAMPLE_SOURCE)
+    assert index.find_range('doctest_foo') == (4, 8)
+    assert index.find_range('TestFoo') == (11, 24)
+    assert index.find_range('TestFoo.test_bar') == (16, 21)
+    assert index.find_range('TestFoo.test_bar.inner') == (18, 19)
+    assert index.find_range('nope') is None
+
+
+def test_TagIndex_find_all():
+    index = py_test_runner.TagIndex(SAMPLE_SOURCE)
+    assert index.find_all(10, 20) == [
+        '', 'TestFoo', 'TestFoo.setUp', 'TestFoo.test_bar',
+        'TestFoo.test_bar.inner',
+    ]
+    assert index.find_all(17, 19) == [
+        'TestFoo.test_bar', 'TestFoo.test_bar.inner',
+    ]
+
+
+def test_TagCache():
+    cache = py_test_runner.TagCache()
+    sources = [SAMPLE_SOURCE]
+    assert cache.get_tag(1, 1, sources.pop, 4) == 'doctest_foo'
+    # same changedtick, source not needed
+    assert cache.get_tag(1, 1, sources.pop, 13) == 'TestFoo.setUp'
+
+
+def test_TagCache_buffer_changed():
+    cache = py_test_runner.TagCache()
+    cache.get_tag(1, 1, lambda: SAMPLE_SOURCE, 4)
+    assert cache.get_tag(1, 2, lambda: '\n\n\n\n', 4) == ''
+
+
+def test_TagCache_syntax_error():
+    cache = py_test_runner.TagCache()
+    assert cache.get_tag(1, 1, lambda: 'def (', 1) == ''
+    cache.get_tag(1, 2, lambda: SAMPLE_SOURCE, 4)
+    assert cache.get_tag(1, 3, lambda: SAMPLE_SOURCE + 'def (', 4) == (
+        'doctest_foo'
+    )
+
+
+def test_TagCache_eviction():
+    cache = py_test_runner.TagCache(maxsize=2)
+    for bufnr in 1, 2, 3:
+        cache.get_tag(bufnr, 1, lambda: SAMPLE_SOURCE, 4)
+    assert list(cache.entries) == [2, 3]
+
+
+def test_RunnerConfiguration_is_test():
+    rc = RunnerConfiguration()
+    assert rc.is_test('test_foo')
+    assert rc.is_test('doctest_foo')
+    assert rc.is_test('TestFoo.test_foo')
+    assert not rc.is_test('TestFoo')
+    assert not rc.is_test('TestFoo.setUp')
+    assert not rc.is_test('TestFoo.helper')
+    assert not rc.is_test('TestFoo.test_foo.inner')
+    assert not rc.is_test('test_foo.inner')
+    assert not rc.is_test('test_suite')
+
+
+def test_RunnerConfiguration_list_tests():
+    rc = RunnerConfiguration()
+    assert rc.list_tests(SAMPLE_SOURCE) == [
+        'doctest_foo', 'TestFoo.test_bar', 'TestFoo.test_baz',
+    ]
+    assert rc.list_tests(SAMPLE_SOURCE, 'TestFoo') == [
+        'TestFoo.test_bar', 'TestFoo.test_baz',
+    ]
+    assert rc.list_tests(SAMPLE_SOURCE, 'TestBar') == []
+
+
+@pytest.mark.parametrize('source, tag, hidden', [
+    (SAMPLE_SOURCE, '', False),
+    (SAMPLE_SOURCE, 'TestFoo', False),
+    ('class TestFoo(object):\n    x = 1\n', '', False),
+    ('from unittest import TestCase\nclass TestFoo(TestCase): pass\n', '',
+     False),
+    ('class TestFoo(Base): pass\n', '', True),
+    ('class TestFoo(Base): pass\n', 'TestFoo', True),
+    ('class TestFoo(Base): pass\nclass TestBar: pass\n', 'TestBar', False),
+    ('class TestFoo(base.Mixin, TestCase): pass\n', '', True),
+    ('class TestFoo:\n    test_x = make_test()\n', 'TestFoo', True),
+    ('class TestFoo:\n    test_x: int = 1\n', '', True),
+    ('test_x = make_test()\n', '', True),
+    ('test_x = make_test()\nclass TestFoo: pass\n', 'TestFoo', False),
+    ('from .base import test_common\n', '', True),
+    ('from .base import TestCommon\n', '', True),
+    ('import os, json as test_json\na.test_x = 1\n', '', True),
+    ('import os\na.test_x = b = 1\n', '', False),
+])
+def test_RunnerConfiguration_has_hidden_tests(source, tag, hidden):
+    rc = RunnerConfiguration()
+    assert rc.has_hidden_tests(source, tag) == hidden
+
+
+def test_RunnerConfiguration_get_shard_count(monkeypatch):
+    rc = RunnerConfiguration()
+    assert rc.get_shard_count() == 1
+    rc = rc.replace(shards='4')
+    assert rc.get_shard_count() == 4
+    rc = rc.replace(shards='lots')
+    assert rc.get_shard_count() == 1
+    rc = rc.replace(shards='auto')
+    monkeypatch.setattr(os, 'cpu_count', lambda: 32)
+    assert rc.get_shard_count() == 32
+    monkeypatch.setattr(os, 'cpu_count', lambda: None)
+    assert rc.get_shard_count() == 1
+
+
+def test_split_into_shards():
+    split = py_test_runner.split_into_shards
+    assert split(['a', 'b', 'c', 'd', 'e'], 2) == [
+        ['a', 'c', 'e'], ['b', 'd'],
+    ]
+    assert split(['a', 'b'], 4) == [['a'], ['b']]
+    assert split(['a', 'b', 'c', 'd'], 2, {'b': 10, 'c': 2}) == [
+        ['b'], ['a', 'c', 'd'],
+    ]
+
+
+PYTEST_OUTPUT = textwrap.dedent("""\
+    =========================== test session starts ===========================
+    collected 4 items
+
+    test_u.py F.F                                                        [ 75%]
+    test_x.py E                                                          [100%]
+
+    ================================= ERRORS ==================================
+    ___________________ ERROR at setup of test_setup_error ____________________
+
+        @pytest.fixture
+        def broken():
+    >       1 / 0
+    E       ZeroDivisionError: division by zero
+
+    test_x.py:3: ZeroDivisionError
+    ================================ FAILURES =================================
+    ___________________________ TestFoo.test_chain ____________________________
+
+        def helper():
+    >       raise ValueError("bad")
+    E       ValueError: bad
+
+    test_u.py:3: ValueError
+
+    During handling of the above exception, another exception occurred:
+
+        def test_chain(self):
+            try:
+                helper()
+            except ValueError:
+    >           raise KeyError("k")
+    E           KeyError: 'k'
+
+    test_u.py:14: KeyError
+    ____________________________ TestFoo.test_fail ____________________________
+
+        def test_fail(self):
+    >       self.assertEqual(1, 2)
+    E       AssertionError: 1 != 2
+    E       assert 0
+
+    test_u.py:7: AssertionError
+    ========================= short test summary info =========================
+    FAILED test_u.py::TestFoo::test_chain - KeyError: 'k'
+    FAILED test_u.py::TestFoo::test_fail - AssertionError: 1 != 2
+    FAILED test_u.py::test_no_traceback - oops
+    ERROR test_x.py::test_setup_error - ZeroDivisionError: division by zero
+    ERROR test_y.py
+    ================== 3 failed, 1 passed, 1 error in 0.04s ===================
+""")
+
+
+def parse(parser, output):
+    failures = []
+    for line in output.splitlines():
+        failures += parser.feed(line)
+    return failures + parser.close()
+
+
+def test_PytestOutputParser():
+    parser = py_test_runner.PytestOutputParser()
+    Failure = py_test_runner.Failure
+    assert parse(parser, PYTEST_OUTPUT) == [
+        Failure('test_x.py', 3, 'test_setup_error',
+                'ZeroDivisionError: division by zero',
+                'test_x.py', 'test_setup_error'),
+        Failure('test_u.py', 14, 'TestFoo.test_chain', "KeyError: 'k'",
+                'test_u.py', 'TestFoo.test_chain'),
+        Failure('test_u.py', 7, 'TestFoo.test_fail', 'AssertionError: 1 != 2',
+                'test_u.py', 'TestFoo.test_fail'),
+        Failure('test_u.py', 0, 'test_no_traceback', 'oops',
+                'test_u.py', 'test_no_traceback'),
+        Failure('test_y.py', 0, '', '', 'test_y.py', ''),
+    ]
+
+
+def test_PytestOutputParser_truncated_output():
+    parser = py_test_runner.PytestOutputParser()
+    assert parse(parser, '___ test_foo ___\n') == [
+        py_test_runner.Failure('', 0, 'test_foo', '', '', 'test_foo'),
+    ]
+
+
+def test_PytestOutputParser_truncated_output_no_frames():
+    parser = py_test_runner.PytestOutputParser()
+    assert parse(parser, '___ test_foo ___\nE   oops\n___ test_bar ___\n') == [
+        py_test_runner.Failure('', 0, 'test_foo', 'oops', '', 'test_foo'),
+        py_test_runner.Failure('', 0, 'test_bar', '', '', 'test_bar'),
+    ]
+
+
+PYTEST_SHORT_OUTPUT = textwrap.dedent("""\
+    ================================= ERRORS ==================================
+    ___________________ ERROR at setup of test_setup_error ____________________
+    conftest.py:7: in broken
+        1 / 0
+    E   ZeroDivisionError: division by zero
+    ================================ FAILURES =================================
+    _______________________________ test_helper _______________________________
+    test_t.py:15: in test_helper
+        check(2)
+    helpers.py:2: in check
+        assert x == 1
+    E   AssertionError: assert 2 == 1
+    E     + where 2 = f()
+    _______________________________ test_chain ________________________________
+    test_t.py:20: in test_chain
+        raise ValueError("bad")
+    E   ValueError: bad
+
+    During handling of the above exception, another exception occurred:
+    test_t.py:22: in test_chain
+        raise KeyError("k")
+    E   KeyError: 'k'
+    ========================= short test summary info =========================
+    FAILED test_t.py::test_helper - AssertionError: assert 2 == 1
+    FAILED test_t.py::test_chain - KeyError: 'k'
+    ERROR test_t.py::test_setup_error - ZeroDivisionError: division by zero
+""")
+
+
+def test_PytestOutputParser_tb_short():
+    parser = py_test_runner.PytestOutputParser()
+    Failure = py_test_runner.Failure
+    assert parse(parser, PYTEST_SHORT_OUTPUT) == [
+        Failure('helpers.py', 2, 'test_helper',
+                'AssertionError: assert 2 == 1', 'test_t.py', 'test_helper'),
+        Failure('test_t.py', 22, 'test_chain', "KeyError: 'k'",
+                'test_t.py', 'test_chain'),
+        Failure('conftest.py', 7, 'test_setup_error',
+                'ZeroDivisionError: division by zero',
+                'test_t.py', 'test_setup_error'),
+    ]
+
+
+PYTEST_NATIVE_OUTPUT = textwrap.dedent("""\
+    ================================= ERRORS ==================================
+    ___________________ ERROR at setup of test_setup_error ____________________
+    Traceback (most recent call last):
+      File "/usr/lib/python3/site-packages/_pytest/runner.py", line 341, in fro
+        result: Optional[TResult] = func()
+                                    ^^^^^^
+      File "/tmp/proj/test_t.py", line 7, in broken
+        1 / 0
+        ~~^~~
+    ZeroDivisionError: division by zero
+    ================================ FAILURES =================================
+    _______________________________ test_helper _______________________________
+    Traceback (most recent call last):
+      File "/usr/lib/python3/site-packages/_pytest/python.py", line 159, in cal
+        result = testfunction(**testargs)
+                 ^^^^^^^^^^^^^^^^^^^^^^^^
+      File "/tmp/proj/test_t.py", line 15, in test_helper
+        check(2)
+      File "/tmp/proj/helpers.py", line 2, in check
+        assert x == 1
+               ^^^^^^
+    AssertionError
+    _______________________________ test_chain ________________________________
+    Traceback (most recent call last):
+      File "/tmp/proj/test_t.py", line 20, in test_chain
+        raise ValueError("bad")
+    ValueError: bad
+
+    During handling of the above exception, another exception occurred:
+
+    Traceback (most recent call last):
+      File "/usr/lib/python3/site-packages/_pytest/python.py", line 159, in cal
+        result = testfunction(**testargs)
+                 ^^^^^^^^^^^^^^^^^^^^^^^^
+      File "/tmp/proj/test_t.py", line 22, in test_chain
+        raise KeyError("k")
+    KeyError: 'k'
+    ========================= short test summary info =========================
+    FAILED test_t.py::test_helper - AssertionError
+    FAILED test_t.py::test_chain - KeyError: 'k'
+    ERROR test_t.py::test_setup_error - ZeroDivisionError: division by zero
+""")
+
+
+def test_PytestOutputParser_tb_native():
+    parser = py_test_runner.PytestOutputParser()
+    Failure = py_test_runner.Failure
+    assert parse(parser, PYTEST_NATIVE_OUTPUT) == [
+        Failure('/tmp/proj/helpers.py', 2, 'test_helper', 'AssertionError',
+                '/tmp/proj/test_t.py', 'test_helper'),
+        Failure('/tmp/proj/test_t.py', 22, 'test_chain', "KeyError: 'k'",
+                '/tmp/proj/test_t.py', 'test_chain'),
+        Failure('/tmp/proj/test_t.py', 7, 'test_setup_error',
+                'ZeroDivisionError: division by zero',
+                'test_t.py', 'test_setup_error'),
+    ]
+
+
+PYTEST_LINE_OUTPUT = textwrap.dedent("""\
+    ================================= ERRORS ==================================
+    ___________________ ERROR at setup of test_setup_error ____________________
+    E   ZeroDivisionError: division by zero
+    ================================ FAILURES =================================
+    E   AssertionError
+    /tmp/proj/helpers.py:2: AssertionError
+    E   ValueError: bad
+
+    During handling of the above exception, another exception occurred:
+    E   KeyError: 'k'
+    /tmp/proj/test_t.py:22: KeyError: 'k'
+    ========================= short test summary info =========================
+    FAILED test_t.py::test_helper - AssertionError
+    FAILED test_t.py::test_chain - KeyError: 'k'
+    ERROR test_t.py::test_setup_error - ZeroDivisionError: division by zero
+""")
+
+
+def test_PytestOutputParser_tb_line():
+    parser = py_test_runner.PytestOutputParser()
+    Failure = py_test_runner.Failure
+    assert parse(parser, PYTEST_LINE_OUTPUT) == [
+        Failure('test_t.py', 0, 'test_helper', 'AssertionError',
+                'test_t.py', 'test_helper'),
+        Failure('test_t.py', 0, 'test_chain', "KeyError: 'k'",
+                'test_t.py', 'test_chain'),
+        Failure('test_t.py', 0, 'test_setup_error',
+                'ZeroDivisionError: division by zero',
+                'test_t.py', 'test_setup_error'),
+    ]
+
+
+UNITTEST_OUTPUT = textwrap.dedent("""\
+    EF.
+    ======================================================================
+    ERROR: test_chain (test_u.TestFoo.test_chain)
+    ----------------------------------------------------------------------
+    Traceback (most recent call last):
+      File "/tmp/proj/test_u.py", line 12, in test_chain
+        helper()
+      File "/tmp/proj/test_u.py", line 3, in helper
+        raise ValueError("bad")
+    ValueError: bad
+
+    During handling of the above exception, another exception occurred:
+
+    Traceback (most recent call last):
+      File "/tmp/proj/test_u.py", line 14, in test_chain
+        raise KeyError("k")
+    KeyError: 'k'
+
+    ======================================================================
+    FAIL: test_fail (test_u.TestFoo.test_fail)
+    ----------------------------------------------------------------------
+    Traceback (most recent call last):
+      File "/tmp/proj/test_u.py", line 7, in test_fail
+        self.assertEqual(1, 2)
+    AssertionError: 1 != 2
+
+    ----------------------------------------------------------------------
+    Ran 3 tests in 0.001s
+
+    FAILED (failures=1, errors=1)
+""")
+
+
+def test_UnittestOutputParser():
+    parser = py_test_runner.UnittestOutputParser()
+    Failure = py_test_runner.Failure
+    assert parse(parser, UNITTEST_OUTPUT) == [
+        Failure('/tmp/proj/test_u.py', 14,
+                'test_chain (test_u.TestFoo.test_chain)', "KeyError: 'k'",
+                '/tmp/proj/test_u.py', 'TestFoo.test_chain'),
+        Failure('/tmp/proj/test_u.py', 7,
+                'test_fail (test_u.TestFoo.test_fail)',
+                'AssertionError: 1 != 2',
+                '/tmp/proj/test_u.py', 'TestFoo.test_fail'),
+    ]
+
+
+def test_UnittestOutputParser_truncated_output():
+    parser = py_test_runner.UnittestOutputParser()
+    assert parse(parser, 'FAIL: test_foo (tests.TestFoo)\n') == [
+        py_test_runner.Failure('', 0, 'test_foo (tests.TestFoo)', '',
+                               '', 'TestFoo.test_foo'),
+    ]
+
+
+ZOPE_OUTPUT = textwrap.dedent("""\
+    Running zope.testrunner.layer.UnitTests tests:
+      Set up zope.testrunner.layer.UnitTests in 0.000 seconds.
+
+
+    Failure in test test_fail (pkg.tests.TestFoo)
+    Traceback (most recent call last):
+      File "/src/pkg/tests.py", line 7, in test_fail
+        self.assertEqual(1, 2)
+    AssertionError: 1 != 2
+
+
+    Error in test test_err (pkg.tests.TestFoo)
+    Traceback (most recent call last):
+      File "/src/pkg/tests.py", line 9, in test_err
+        helper()
+      File "/src/pkg/helpers.py", line 3, in helper
+        raise ValueError("bad")
+    ValueError: bad
+
+      Ran 3 tests with 1 failures, 1 errors and 0 skipped in 0.001 seconds.
+""")
+
+
+def test_ZopeOutputParser():
+    parser = py_test_runner.ZopeOutputParser()
+    Failure = py_test_runner.Failure
+    assert parse(parser, ZOPE_OUTPUT) == [
+        Failure('/src/pkg/tests.py', 7, 'test_fail (pkg.tests.TestFoo)',
+                'AssertionError: 1 != 2',
+                '/src/pkg/tests.py', 'TestFoo.test_fail'),
+        Failure('/src/pkg/helpers.py', 3, 'test_err (pkg.tests.TestFoo)',
+                'ValueError: bad', '/src/pkg/tests.py', 'TestFoo.test_err'),
+    ]
+
+
+PYTEST_DURATIONS_OUTPUT = textwrap.dedent("""\
+    test_d.py .F.                                                        [100%]
+
+    ================================ FAILURES =================================
+    ________________________________ test_p[2] ________________________________
+
+        def test_p(x):
+    >       assert x == 1
+    E       assert 2 == 1
+
+    test_d.py:8: AssertionError
+    ============================ slowest durations ============================
+    0.02s call     test_d.py::test_a
+    0.01s call     test_d.py::test_p[2]
+    0.01s setup    test_d.py::test_p[1]
+    0.00s setup    test_d.py::TestK::test_m
+    ========================= short test summary info =========================
+    FAILED test_d.py::test_p[2] - assert 2 == 1
+    ======================= 1 failed, 2 passed in 0.06s =======================
+""")
+
+
+def test_PytestOutputParser_durations():
+    parser = py_test_runner.PytestOutputParser()
+    assert len(parse(parser, PYTEST_DURATIONS_OUTPUT)) == 1
+    assert parser.durations == {
+        ('test_d.py', 'test_a'): 0.02,
+        ('test_d.py', 'test_p'): 0.02,
+        ('test_d.py', 'TestK.test_m'): 0.0,
+    }
+
+
+def test_UnittestOutputParser_durations():
+    parser = py_test_runner.UnittestOutputParser()
+    separator = '\n' + '-' * 70 + '\nRan'
+    output = UNITTEST_OUTPUT.replace(separator, textwrap.dedent('''
+
+        Slowest test durations
+        ----------------------------------------------------------------------
+        0.501s     test_slow (pkg.test_u.TestFoo.test_slow)
+        0.002s     test_fail (pkg.test_u.TestFoo.test_fail)
+        0.001s     test_func (pkg.test_u.test_func)
+
+        ----------------------------------------------------------------------
+        Ran'''))
+    failures = parse(parser, output)
+    assert [f.message for f in failures] == [
+        "KeyError: 'k'", 'AssertionError: 1 != 2',
+    ]
+    assert parser.durations == {
+        ('pkg/test_u.py', 'TestFoo.test_slow'): 0.501,
+        ('pkg/test_u.py', 'TestFoo.test_fail'): 0.002,
+        ('pkg/test_u.py', 'test_func'): 0.001,
+    }
+
+
+def test_ZopeOutputParser_durations():
+    parser = py_test_runner.ZopeOutputParser()
+    parse(parser, ' test_ok (pkg.tests.TestFoo) (0.250 s)\n')
+    assert parser.durations == {('pkg/tests.py', 'TestFoo.test_ok'): 0.25}
+
+
+def test_UnittestOutputParser_split_test():
+    split_test = py_test_runner.UnittestOutputParser.split_test
+    assert split_test('test_foo (pkg.tests.TestFoo)') == (
+        'pkg.tests', 'TestFoo', 'test_foo')
+    assert split_test('test_foo (tests.test_foo)') == (
+        'tests', '', 'test_foo')
+    assert split_test('not a test') == ('', '', '')
+
+
+def test_OutputParser_as_quickfix_item():
+    Failure = py_test_runner.Failure
+    as_quickfix_item = py_test_runner.OutputParser.as_quickfix_item
+    assert as_quickfix_item(
+        Failure('a.py', 3, 'test_a', 'boom', 'a.py', 'test_a')) == dict(
+        filename='a.py', lnum=3, text='test_a: boom', type='E')
+    assert as_quickfix_item(
+        Failure('a.py', 0, '', 'boom', 'a.py', '')) == dict(
+        filename='a.py', lnum=0, text='boom', type='E')
+
+
+def test_OutputParser_base_class():
+    parser = py_test_runner.OutputParser()
+    assert parse(parser, 'FAIL: test_foo (tests.TestFoo)') == []
+
+
+def test_UnittestOutputParser_get_tag():
+    get_tag = py_test_runner.UnittestOutputParser.get_tag
+    assert get_tag('test_foo (pkg.tests.TestFoo)') == 'TestFoo.test_foo'
+    assert get_tag('test_foo (pkg.tests.TestFoo.test_foo)') == (
+        'TestFoo.test_foo')
+    assert get_tag('test_foo (pkg.tests)') == 'test_foo'
+    assert get_tag('doctest_foo') == ''
+
+
+def test_PytestOutputParser_get_tag():
+    get_tag = py_test_runner.PytestOutputParser.get_tag
+    assert get_tag('test_foo[1-2]') == 'test_foo'
+    assert get_tag('TestFoo.test_foo') == 'TestFoo.test_foo'
+
+
+def test_get_cache_dir(cache_dir):
+    assert py_test_runner.get_cache_dir('/src/project') == str(
+        cache_dir / 'project-d76975aa69fc')
+    assert py_test_runner.get_cache_dir('/') == str(
+        cache_dir / 'root-42099b4af021')
+
+
+def test_FailureIndex(tmp_path):
+    index = py_test_runner.FailureIndex(str(tmp_path / 'sub' / 'f.json'))
+    assert index.failures == []
+    index.failures = [('/src/tests.py', 'test_foo')]
+    index.save()
+    index = py_test_runner.FailureIndex(str(tmp_path / 'sub' / 'f.json'))
+    assert index.failures == [('/src/tests.py', 'test_foo')]
+
+
+def test_FailureIndex_corrupted(tmp_path):
+    (tmp_path / 'f.json').write_text('{')
+    index = py_test_runner.FailureIndex(str(tmp_path / 'f.json'))
+    assert index.failures == []
+
+
+def test_FailureIndex_covers():
+    covers = py_test_runner.FailureIndex.covers
+    test = ('/src/tests.py', 'TestFoo.test_foo')
+    assert covers(('', ''), test)
+    assert covers(('/src/tests.py', ''), test)
+    assert covers(('/src/tests.py', 'TestFoo'), test)
+    assert covers(('/src/tests.py', 'TestFoo.test_foo'), test)
+    assert covers(('/src/tests.py', 'TestFoo.test_foo.inner'), test)
+    assert not covers(('/src/tests.py', 'TestFoo.test_foo_bar'), test)
+    assert not covers(('/src/tests.py', 'TestBar'), test)
+    assert not covers(('/src/other.py', ''), test)
+
+
+def test_FailureIndex_update(tmp_path):
+    index = py_test_runner.FailureIndex(str(tmp_path / 'f.json'))
+    index.failures = [('a.py', 'test_a'), ('a.py', 'test_b'),
+                      ('b.py', 'test_c')]
+    index.update([('a.py', '')], [('a.py', 'test_b'), ('a.py', 'test_d')])
+    assert index.failures == [('b.py', 'test_c'), ('a.py', 'test_b'),
+                              ('a.py', 'test_d')]
+
+
+def test_DurationDB(tmp_path):
+    db = py_test_runner.DurationDB(str(tmp_path / 'sub' / 'd.jsonl'))
+    assert db.load() == {}
+    db.record([])
+    assert not (tmp_path / 'sub').exists()
+    db.record([('/src/t.py', 'test_a', 0.5, 'passed'),
+               ('/src/t.py', 'test_b', 1.5, 'failed'),
+               ('/src/u.py', 'test_c', 0.1, 'passed')], when=100)
+    db.record([('/src/t.py', 'test_a', 0.7, 'passed')], when=200)
+    assert db.load() == {
+        ('/src/t.py', 'test_a'): [(100, 0.5, 'passed'), (200, 0.7, 'passed')],
+        ('/src/t.py', 'test_b'): [(100, 1.5, 'failed')],
+        ('/src/u.py', 'test_c'): [(100, 0.1, 'passed')],
+    }
+    assert db.get_durations('/src/t.py') == {'test_a': 0.7, 'test_b': 1.5}
+    assert db.get_slowest('/src/t.py') == [
+        ('test_b', [1.5]), ('test_a', [0.5, 0.7]),
+    ]
+    assert db.get_slowest('/src/t.py', 'test_a') == [('test_a', [0.5, 0.7])]
+
+
+def test_DurationDB_ignores_partial_lines(tmp_path):
+    (tmp_path / 'd.jsonl').write_text(
+        '[1, "/t.py", "test_a", 0.5, "passed"]\n[2, "/t.py", "te')
+    db = py_test_runner.DurationDB(str(tmp_path / 'd.jsonl'))
+    assert db.load() == {('/t.py', 'test_a'): [(1, 0.5, 'passed')]}
+
+
+def test_DurationDB_compacts(tmp_path):
+    db = py_test_runner.DurationDB(str(tmp_path / 'd.jsonl'))
+    db.MAX_SIZE = 1000
+    db.HISTORY = 2
+    for n in range(30):
+        db.record([('/t.py', 'test_a', n, 'passed')], when=n)
+    runs = db.load()[('/t.py', 'test_a')]
+    assert len(runs) < 30
+    assert runs[-1] == (29, 29, 'passed')
+    assert (tmp_path / 'd.jsonl').stat().st_size <= 1000
+
+
+def test_format_durations():
+    fmt = py_test_runner.format_durations
+    assert fmt('test_a', [0.5]) == '   0.500s  test_a'
+    assert fmt('test_a', [1, 2, 3, 4, 5, 6]) == (
+        '   6.000s  test_a  (2.000 3.000 4.000 5.000 6.000, +71%)')
+    assert fmt('test_a', [0, 0.5]) == '   0.500s  test_a  (0.000 0.500)'
+
+
+def make_config(text):
+    cp = py_test_runner.new_config_parser()
+    cp.read_string(textwrap.dedent(text))
+    return cp
+
+
+def test_PathIndex():
+    index = py_test_runner.PathIndex(make_config('''
+        [default]
+        [path:/src]
+        [path:/src/foo/]
+        [path:/src/foo/bar]
+        [path:/other]
+    '''))
+    assert index.find('/src/foo/bar/baz.py') == [
+        'path:/src', 'path:/src/foo/', 'path:/src/foo/bar',
+    ]
+    assert index.find('/src/foo') == ['path:/src', 'path:/src/foo/']
+    assert index.find('/elsewhere/foo.py') == []
+
+
+def test_PathIndex_matches_whole_components_only():
+    index = py_test_runner.PathIndex(make_config('''
+        [path:/src/foo]
+    '''))
+    assert index.find('/src/foobar/test.py') == []
+
+
+def test_PathIndex_keeps_config_file_order():
+    index = py_test_runner.PathIndex(make_config('''
+        [path:/src/foo]
+        [path:/]
+        [path:/src]
+    '''))
+    assert index.find('/src/foo/test.py') == [
+        'path:/src/foo', 'path:/', 'path:/src',
+    ]
+
+
+def test_PathIndex_expands_user(monkeypatch):
+    monkeypatch.setenv('HOME', '/home/user')
+    index = py_test_runner.PathIndex(make_config('''
+        [path:~/src]
+    '''))
+    assert index.find('/home/user/src/test.py') == ['path:~/src']
+
+
+def test_PathIndex_relative_paths(monkeypatch, tmp_path):
+    index = py_test_runner.PathIndex(make_config('''
+        [path:/]
+        [path:src]
+    '''))
+    monkeypatch.chdir(tmp_path)
+    assert index.find('src/test.py') == ['path:/', 'path:src']
+    assert index.find('other/test.py') == ['path:/']
+    assert index.find(str(tmp_path / 'src' / 'test.py')) == [
+        'path:/', 'path:src',
+    ]
+
+
+def test_config_cache_reuses_parsed_configuration(tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nrunner = zope\n')
+    cache = py_test_runner.ConfigCache()
+    config = cache.get(configfile)
+    assert config.get('default', 'runner') == 'zope'
+    assert cache.get(str(configfile)) is config
+    assert cache.generation == 1
+
+
+def test_config_cache_notices_changes(tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nrunner = zope\n')
+    cache = py_test_runner.ConfigCache()
+    config = cache.get(configfile)
+    configfile.write_text('[default]\nrunner = nose\n')
+    new_config = cache.get(configfile)
+    assert new_config is not config
+    assert new_config.get('default', 'runner') == 'nose'
+    assert cache.generation == 2
+
+
+def test_config_cache_missing_file(tmp_path):
+    cache = py_test_runner.ConfigCache()
+    config = cache.get(tmp_path / 'nosuchfile.cfg')
+    assert config.get('default', 'runner') == 'pytest'
+    assert cache.get(tmp_path / 'nosuchfile.cfg') is config
+
+
+def test_config_cache_clear(tmp_path):
+    cache = py_test_runner.ConfigCache()
+    config = cache.get('/dev/null')
+    cache.clear()
+    assert cache.generation == 2
+    assert cache.get('/dev/null') is not config
+
+
+def test_PyTestRunner_uses_config_cache():
+    assert PyTestRunner('/dev/null').config is PyTestRunner('/dev/null').config
+
+
+def test_runner_cache():
+    cache = py_test_runner.RunnerCache(maxsize=2)
+    assert cache.get('a', 1) is None
+    cache.put('a', 'rc-a')
+    assert cache.get('a', 1) == 'rc-a'
+    assert cache.stats() == dict(hits=1, misses=1, size=1, maxsize=2)
+
+
+def test_runner_cache_evicts_least_recently_used():
+    cache = py_test_runner.RunnerCache(maxsize=2)
+    cache.get('a', 1)
+    cache.put('a', 'rc-a')
+    cache.put('b', 'rc-b')
+    cache.get('a', 1)
+    cache.put('c', 'rc-c')
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_runner_cache_new_generation():
+    cache = py_test_runner.RunnerCache()
+    cache.get('a', 1)
+    cache.put('a', 'rc-a')
+    assert cache.get('a', 2) is None
+
+
+def test_runner_cache_clear():
+    cache = py_test_runner.RunnerCache()
+    cache.get('a', 1)
+    cache.put('a', 'rc-a')
+    cache.clear()
+    assert cache.get('a', 1) is None
+    assert cache.stats()['misses'] == 2
+
+
 class MockVim:
 
-    def __init__(self, overrides={}):
+    def __init__(self, overrides=None):
         self._exprs = {
             'g:pyTestRunnerConfigFile': '/dev/null',
             'g:pyTestRunner': '',
             'g:pyTestRunnerCommand': '',
+            'g:pyTestRunnerProfile': '0',
         }
-        self._exprs.update(overrides)
+        self._exprs.update(overrides or {})
 
     def eval(self, expr):
         return self._exprs[expr]
@@ -487,6 +1664,45 @@ def test_vim_interface_with_runner_command_override(monkeypatch):
     assert rc.command == 'env/bin/pytest'
 
 
+def test_vim_interface_pytest_daemon(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunner': 'pytest-daemon',
+    }))
+    rc = py_test_runner.get_test_runner('tests.py')
+    assert rc.command == 'python %s -ra' % py_test_runner.PYTEST_DAEMON
+    assert os.path.exists(py_test_runner.PYTEST_DAEMON)
+
+
+def test_resolve_test_runner_quotes_pytest_daemon(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'PYTEST_DAEMON',
+                        '/home/me/My Plugins/pytest_daemon.py')
+    rc = py_test_runner.resolve_test_runner(
+        '/dev/null', 'tests.py', 'pytest-daemon', '')
+    assert rc.command == (
+        "python '/home/me/My Plugins/pytest_daemon.py' -ra")
+
+
+def test_vim_interface_caches_resolved_runner(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.setattr(py_test_runner, 'runner_cache',
+                        py_test_runner.RunnerCache())
+    rc = py_test_runner.get_test_runner('tests.py')
+    assert py_test_runner.get_test_runner('tests.py') is rc
+    assert py_test_runner.get_cache_stats() == dict(
+        hits=1, misses=1, size=1, maxsize=128)
+
+
+def test_vim_interface_cache_notices_config_changes(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nrunner = zope\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    assert py_test_runner.get_test_runner('tests.py').command == 'bin/test'
+    configfile.write_text('[default]\nrunner = nose\n')
+    assert py_test_runner.get_test_runner('tests.py').command == 'nosetests'
+
+
 def test_get_test_command(monkeypatch):
     monkeypatch.setattr(py_test_runner, 'vim', MockVim())
     gtc = py_test_runner.get_test_command
@@ -507,6 +1723,102 @@ def test_get_test_command_adds_workdir(monkeypatch, tmp_path):
     assert gtc('tests.py') == 'cd src && pytest -ra'
 
 
+@pytest.mark.parametrize('runner, command', [
+    ('pytest', 'pytest -ra -x'),
+    ('unittest', 'python -m unittest discover --failfast'),
+    ('zope', 'bin/test --stop-on-error'),
+])
+def test_get_test_command_fail_fast(monkeypatch, runner, command):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunner': runner,
+    }))
+    gtc = py_test_runner.get_test_command
+    assert gtc('tests.py', fail_fast=True) == command
+
+
+@pytest.mark.parametrize('runner, command', [
+    ('pytest', 'pytest -ra --durations=0 --durations-min=0'),
+    ('unittest', 'python -m unittest discover'),
+])
+def test_get_test_command_durations(monkeypatch, runner, command):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunner': runner,
+    }))
+    gtc = py_test_runner.get_test_command
+    assert gtc('tests.py', durations=True) == command
+
+
+def test_get_test_command_fail_fast_not_supported(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nrunner = custom\n'
+                          '[runner:custom]\ncommand = runtests\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    gtc = py_test_runner.get_test_command
+    assert gtc('tests.py', fail_fast=True) == 'runtests'
+
+
+def test_get_test_command_adds_watchdog(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text(textwrap.dedent('''
+        [default]
+        workdir = src
+        timeout = 600
+
+        [path:%s]
+        per_test_timeout = 30
+    ''' % (tmp_path / 'slow')))
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.setattr(sys, 'executable', '/usr/bin/vim')
+    gtc = py_test_runner.get_test_command
+    watchdog = 'python3 %s' % py_test_runner.WATCHDOG
+    assert gtc('tests.py') == (
+        'cd src && %s --timeout 600 pytest -ra' % watchdog)
+    assert gtc(str(tmp_path / 'slow' / 'tests.py')) == (
+        'cd src && %s --timeout 600 --per-test-timeout 30 pytest -ra'
+        % watchdog)
+    assert os.path.exists(py_test_runner.WATCHDOG)
+
+
+def test_get_test_command_quotes_watchdog(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\ntimeout = 60\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.setattr(py_test_runner, 'WATCHDOG',
+                        '/home/me/My Plugins/py_test_watchdog.py')
+    monkeypatch.setattr(sys, 'executable', '')
+    assert py_test_runner.get_test_command('tests.py') == (
+        "python3 '/home/me/My Plugins/py_test_watchdog.py' --timeout 60"
+        " pytest -ra")
+
+
+def test_add_watchdog(monkeypatch):
+    monkeypatch.setattr(sys, 'executable', '/usr/bin/vim')
+    rc = RunnerConfiguration()
+    assert rc.add_watchdog('pytest') == 'pytest'
+    rc = rc.replace(timeout='soon', per_test_timeout='-1')
+    assert rc.add_watchdog('pytest') == 'pytest'
+    rc = rc.replace(per_test_timeout='2.5')
+    assert rc.add_watchdog('pytest') == (
+        'python3 %s --per-test-timeout 2.5 pytest' % py_test_runner.WATCHDOG)
+
+
+def test_add_watchdog_uses_the_command_python(monkeypatch):
+    monkeypatch.setattr(sys, 'executable', '/opt/My Python/bin/python3.12')
+    rc = RunnerConfiguration(timeout='60')
+    assert rc.add_watchdog('.venv/bin/python -m pytest') == (
+        '.venv/bin/python %s --timeout 60 .venv/bin/python -m pytest'
+        % py_test_runner.WATCHDOG)
+    assert rc.add_watchdog('pytest') == (
+        "'/opt/My Python/bin/python3.12' %s --timeout 60 pytest"
+        % py_test_runner.WATCHDOG)
+
+
 def test_get_test(monkeypatch):
     monkeypatch.setattr(py_test_runner, 'vim', MockVim())
     gt = py_test_runner.get_test
@@ -517,3 +1829,1241 @@ def test_get_clipboard_command(monkeypatch):
     monkeypatch.setattr(py_test_runner, 'vim', MockVim())
     gcc = py_test_runner.get_clipboard_command
     assert gcc('tests.py', 'test_foo') == 'pytest -ra tests.py::test_foo'
+
+
+class MockBuffer(list):
+    number = 1
+
+
+class MockWindow:
+    cursor = (13, 0)
+
+
+class MockCurrent:
+    buffer = MockBuffer(SAMPLE_SOURCE.splitlines())
+    window = MockWindow()
+
+
+def test_get_tag_under_cursor(monkeypatch):
+    mock_vim = MockVim({'b:changedtick': '42'})
+    mock_vim.current = MockCurrent()
+    monkeypatch.setattr(py_test_runner, 'vim', mock_vim)
+    monkeypatch.setattr(py_test_runner, 'tag_cache',
+                        py_test_runner.TagCache())
+    assert py_test_runner.get_tag_under_cursor() == 'TestFoo.setUp'
+
+
+def test_get_output_format(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunner': 'zope',
+    }))
+    assert py_test_runner.get_output_format('tests.py') == 'zope'
+
+
+def test_parse_output():
+    parser_id = py_test_runner.start_output_parser('unittest')
+    lines = UNITTEST_OUTPUT.splitlines()
+    items = py_test_runner.parse_output(parser_id, lines[:18])
+    assert items[:2] == [
+        dict(text='EF.', valid=0),
+        dict(text='=' * 70, valid=0),
+    ]
+    assert len(items) == 18
+    items = py_test_runner.parse_output(parser_id, lines[18:20])
+    assert items == [
+        dict(text='=' * 70, valid=0),
+        dict(filename='/tmp/proj/test_u.py', lnum=14, type='E',
+             text="test_chain (test_u.TestFoo.test_chain): KeyError: 'k'",
+             user_data=dict(test_file='/tmp/proj/test_u.py',
+                            tag='TestFoo.test_chain')),
+        dict(text='FAIL: test_fail (test_u.TestFoo.test_fail)', valid=0),
+    ]
+    assert py_test_runner.stop_output_parser(parser_id) == [
+        dict(filename='', lnum=0, type='E',
+             text='test_fail (test_u.TestFoo.test_fail): '),
+    ]
+    assert parser_id not in py_test_runner.output_parsers
+    assert py_test_runner.stop_output_parser(parser_id) == []
+
+
+def test_stop_output_parser_updates_failure_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    index = py_test_runner.FailureIndex.for_workdir(str(tmp_path))
+    index.failures = [(str(tmp_path / 'test_u.py'), 'TestFoo.test_ok')]
+    index.save()
+    parser_id = py_test_runner.start_output_parser(
+        'pytest', 'test_u.py', [['test_u.py', '']])
+    py_test_runner.parse_output(parser_id, PYTEST_OUTPUT.splitlines())
+    py_test_runner.stop_output_parser(parser_id, completed=True)
+    assert py_test_runner.FailureIndex.for_workdir(str(tmp_path)).failures == [
+        (str(tmp_path / 'test_x.py'), 'test_setup_error'),
+        (str(tmp_path / 'test_u.py'), 'TestFoo.test_chain'),
+        (str(tmp_path / 'test_u.py'), 'TestFoo.test_fail'),
+        (str(tmp_path / 'test_u.py'), 'test_no_traceback'),
+        (str(tmp_path / 'test_y.py'), ''),
+    ]
+
+
+def test_stop_output_parser_interrupted_run(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    index = py_test_runner.FailureIndex.for_workdir(str(tmp_path))
+    index.failures = [(str(tmp_path / 'test_u.py'), 'TestFoo.test_ok')]
+    index.save()
+    parser_id = py_test_runner.start_output_parser(
+        'pytest', scope=[['', '']])
+    py_test_runner.parse_output(parser_id, PYTEST_OUTPUT.splitlines()[:22])
+    py_test_runner.stop_output_parser(parser_id)
+    assert py_test_runner.FailureIndex.for_workdir(str(tmp_path)).failures == [
+        (str(tmp_path / 'test_u.py'), 'TestFoo.test_ok'),
+        (str(tmp_path / 'test_x.py'), 'test_setup_error'),
+    ]
+
+
+def test_stop_output_parser_interrupted_run_no_failures(cache_dir):
+    parser_id = py_test_runner.start_output_parser('pytest')
+    py_test_runner.stop_output_parser(parser_id)
+    assert not cache_dir.exists()
+
+
+def test_get_failed_tests(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    index = py_test_runner.FailureIndex.for_workdir(str(tmp_path))
+    index.failures = [
+        (str(tmp_path / 'test_u.py'), 'TestFoo.test_fail'),
+        (str(tmp_path / 'test_u.py'), 'TestFoo.test_fail'),
+        ('/elsewhere/test_x.py', 'test_a'),
+    ]
+    index.save()
+    assert py_test_runner.get_failed_tests('test_u.py') == dict(
+        filter='test_u.py::TestFoo::test_fail /elsewhere/test_x.py::test_a',
+        scope=[
+            [str(tmp_path / 'test_u.py'), 'TestFoo.test_fail'],
+            [str(tmp_path / 'test_u.py'), 'TestFoo.test_fail'],
+            ['/elsewhere/test_x.py', 'test_a'],
+        ],
+    )
+
+
+def test_get_tests(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    assert py_test_runner.get_tests('test_u.py', [
+        'TestFoo.test_a', 'TestFoo', 'test_b',
+    ]) == 'test_u.py::TestFoo test_u.py::test_b'
+
+
+def test_get_failed_tests_merges_tests(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunner': 'zope',
+    }))
+    monkeypatch.chdir(tmp_path)
+    index = py_test_runner.FailureIndex.for_workdir(str(tmp_path))
+    index.failures = [
+        (str(tmp_path / 'test_u.py'), 'TestFoo.test_a'),
+        (str(tmp_path / 'test_v.py'), 'test_b'),
+        (str(tmp_path / 'test_u.py'), 'test_c'),
+    ]
+    index.save()
+    assert py_test_runner.get_failed_tests('test_u.py')['filter'] == (
+        "-m test_u -t 'test_a [(].*[.]TestFoo[)]' -t test_c"
+        " -m test_v -t test_b")
+
+
+def test_get_failed_tests_none(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    assert py_test_runner.get_failed_tests('test_u.py') == dict(
+        filter='', scope=[])
+
+
+def test_get_test_shards(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nshards = 2\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(SAMPLE_SOURCE)
+    assert py_test_runner.get_test_shards('test_s.py', '') == [
+        dict(filter=('test_s.py::test_s.doctest_foo'
+                     ' test_s.py::TestFoo::test_baz'),
+             scope=[['test_s.py', 'doctest_foo'],
+                    ['test_s.py', 'TestFoo.test_baz']]),
+        dict(filter='test_s.py::TestFoo::test_bar',
+             scope=[['test_s.py', 'TestFoo.test_bar']]),
+    ]
+    assert len(py_test_runner.get_test_shards('test_s.py', 'TestFoo')) == 2
+
+
+def test_get_test_shards_not_applicable(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nshards = 2\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(SAMPLE_SOURCE)
+    (tmp_path / 'test_one.py').write_text('def test_one():\n    pass\n')
+    (tmp_path / 'test_bad.py').write_text('def test_one(:\n')
+    get_test_shards = py_test_runner.get_test_shards
+    assert get_test_shards('test_s.py', 'TestFoo.test_bar') == []
+    assert get_test_shards('test_s.py', 'doctest_foo') == []
+    assert get_test_shards('test_one.py', '') == []
+    assert get_test_shards('test_bad.py', '') == []
+    assert get_test_shards('test_missing.py', '') == []
+    assert get_test_shards('README.rst', '') == []
+    configfile.write_text('[default]\nrunner = unittest\nshards = 2\n')
+    assert get_test_shards('test_s.py', '') == []
+    assert len(get_test_shards('test_s.py', 'TestFoo')) == 2
+
+
+def test_get_test_shards_inherited_tests(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nshards = 2\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(
+        SAMPLE_SOURCE + 'class TestBar(TestFoo):\n    pass\n')
+    get_test_shards = py_test_runner.get_test_shards
+    assert get_test_shards('test_s.py', '') == []
+    assert get_test_shards('test_s.py', 'TestBar') == []
+    assert len(get_test_shards('test_s.py', 'TestFoo')) == 2
+    record_history(tmp_path, ['TestFoo.test_baz'], {})
+    get_scheduled_tests = py_test_runner.get_scheduled_tests
+    assert get_scheduled_tests('test_s.py', '') == {}
+    assert get_scheduled_tests('test_s.py', 'TestFoo') != {}
+
+
+def test_schedule_tests():
+    tests = ['test_a', 'test_b', 'test_c', 'test_d']
+    assert py_test_runner.schedule_tests(tests, set(), {}) == tests
+    assert py_test_runner.schedule_tests(tests, {'test_c'}, {
+        'test_a': 3.0, 'test_b': 1.0, 'test_d': 2.0,
+    }) == ['test_c', 'test_b', 'test_d', 'test_a']
+
+
+def record_history(tmp_path, failures, durations):
+    workdir = str(tmp_path)
+    index = py_test_runner.FailureIndex.for_workdir(workdir)
+    index.failures = [(str(tmp_path / 'test_s.py'), tag) for tag in failures]
+    index.save()
+    py_test_runner.DurationDB.for_workdir(workdir).record([
+        (str(tmp_path / 'test_s.py'), tag, seconds, 'passed')
+        for tag, seconds in durations.items()])
+
+
+def test_get_scheduled_tests(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(SAMPLE_SOURCE)
+    get_scheduled_tests = py_test_runner.get_scheduled_tests
+    assert get_scheduled_tests('test_s.py', '') == {}
+    record_history(tmp_path, ['TestFoo.test_baz'], {
+        'doctest_foo': 2.5, 'TestFoo.test_bar': 0.5,
+    })
+    assert get_scheduled_tests('test_s.py', '') == dict(
+        filter=('test_s.py::TestFoo::test_baz test_s.py::TestFoo::test_bar'
+                ' test_s.py::test_s.doctest_foo'),
+        scope=[['test_s.py', 'TestFoo.test_baz'],
+               ['test_s.py', 'TestFoo.test_bar'],
+               ['test_s.py', 'doctest_foo']])
+    assert get_scheduled_tests('test_s.py', 'TestFoo')['scope'] == [
+        ['test_s.py', 'TestFoo.test_baz'], ['test_s.py', 'TestFoo.test_bar'],
+    ]
+    assert get_scheduled_tests('test_s.py', 'TestFoo.test_bar') == {}
+    assert get_scheduled_tests('test_missing.py', '') == {}
+
+
+def test_get_test_shards_scheduled(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nshards = 2\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(SAMPLE_SOURCE)
+    record_history(tmp_path, ['TestFoo.test_baz'], {})
+    shards = py_test_runner.get_test_shards('test_s.py', '', schedule=True)
+    assert [shard['scope'] for shard in shards] == [
+        [['test_s.py', 'TestFoo.test_baz'], ['test_s.py', 'doctest_foo']],
+        [['test_s.py', 'TestFoo.test_bar']],
+    ]
+
+
+def test_get_test_shards_scheduled_runner_keeps_no_order(
+        monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nrunner = unittest\nshards = 2\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(
+        'import unittest\n\n\nclass TestFoo(unittest.TestCase):\n'
+        '    def test_a(self):\n        pass\n\n'
+        '    def test_b(self):\n        pass\n\n'
+        '    def test_c(self):\n        pass\n')
+    record_history(tmp_path, ['TestFoo.test_c'], {})
+    shards = py_test_runner.get_test_shards('test_s.py', '', schedule=True)
+    assert [shard['scope'] for shard in shards] == [
+        [['test_s.py', 'TestFoo.test_a'], ['test_s.py', 'TestFoo.test_c']],
+        [['test_s.py', 'TestFoo.test_b']],
+    ]
+    assert py_test_runner.get_scheduled_tests('test_s.py', '') == {}
+
+
+def test_get_test_shards_disabled(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    assert py_test_runner.get_test_shards('test_s.py', '') == []
+
+
+def test_stop_output_parser_records_durations(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    parser_id = py_test_runner.start_output_parser('pytest')
+    py_test_runner.parse_output(parser_id,
+                                PYTEST_DURATIONS_OUTPUT.splitlines())
+    py_test_runner.stop_output_parser(parser_id, completed=True)
+    db = py_test_runner.DurationDB.for_workdir(str(tmp_path))
+    assert [(key, [runs[0][1:]]) for key, runs in db.load().items()] == [
+        ((str(tmp_path / 'test_d.py'), 'test_a'), [(0.02, 'passed')]),
+        ((str(tmp_path / 'test_d.py'), 'test_p'), [(0.02, 'failed')]),
+        ((str(tmp_path / 'test_d.py'), 'TestK.test_m'), [(0.0, 'passed')]),
+    ]
+
+
+STACK_DUMP_OUTPUT = '''\
+============================ test session starts =============================
+collected 2 items
+
+test_h.py .Fatal Python error: Aborted
+
+Thread 0x00007f0000000001 (most recent call first):
+  File "/usr/lib/python3/threading.py", line 324 in wait
+
+Current thread 0x00007f0000000000 (most recent call first):
+  File "{workdir}/helpers.py", line 2 in wait_forever
+  File "{workdir}/test_h.py", line 9 in inner
+  File "{workdir}/test_h.py", line 10 in test_hang
+  File "/usr/lib/python3/site-packages/_pytest/python.py", line 159 in call
+py-test-runner: test run killed after 30 seconds without output \
+(per_test_timeout)
+'''
+
+STACK_DUMP_SOURCE = textwrap.dedent('''\
+    def test_ok():
+        pass
+
+
+    class TestHang:
+
+        def test_hang(self):
+
+            def inner():
+                wait_forever()
+            inner()
+''')
+
+
+def test_StackDumpParser(tmp_path):
+    (tmp_path / 'test_h.py').write_text(STACK_DUMP_SOURCE)
+    parser = py_test_runner.StackDumpParser(str(tmp_path))
+    failures = []
+    for line in STACK_DUMP_OUTPUT.format(workdir=tmp_path).splitlines():
+        failures += parser.feed(line)
+    message = ('test run killed after 30 seconds without output'
+               ' (per_test_timeout)')
+    filename = str(tmp_path / 'test_h.py')
+    assert failures == [
+        py_test_runner.Failure(filename, 9, 'TestHang.test_hang', message,
+                               filename, 'TestHang.test_hang'),
+    ]
+    assert parser.seconds == 30
+
+
+def test_StackDumpParser_unknown_test(tmp_path):
+    parser = py_test_runner.StackDumpParser(str(tmp_path))
+    failures = []
+    for line in STACK_DUMP_OUTPUT.format(workdir=tmp_path).splitlines():
+        failures += parser.feed(line)
+    assert failures[0].filename == str(tmp_path / 'test_h.py')
+    assert failures[0].test_file == ''
+    parser = py_test_runner.StackDumpParser()
+    assert parser.feed('py-test-runner: test run killed after 5 seconds'
+                       ' (timeout)') == [
+        py_test_runner.Failure('', 0, '', 'test run killed after 5 seconds'
+                               ' (timeout)', '', ''),
+    ]
+
+
+def test_stop_output_parser_records_timeout(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_h.py').write_text(STACK_DUMP_SOURCE)
+    index = py_test_runner.FailureIndex.for_workdir(str(tmp_path))
+    index.failures = [(str(tmp_path / 'test_h.py'), 'test_ok')]
+    index.save()
+    parser_id = py_test_runner.start_output_parser(
+        'pytest', scope=[['test_h.py', '']], cache_key='abc')
+    items = py_test_runner.parse_output(
+        parser_id, STACK_DUMP_OUTPUT.format(workdir=tmp_path).splitlines())
+    assert items[-1] == dict(
+        filename=str(tmp_path / 'test_h.py'), lnum=9, type='E',
+        text='TestHang.test_hang: test run killed after 30 seconds without'
+             ' output (per_test_timeout)',
+        user_data=dict(test_file=str(tmp_path / 'test_h.py'),
+                       tag='TestHang.test_hang'))
+    py_test_runner.stop_output_parser(parser_id, completed=True,
+                                      exit_status=124)
+    # The run didn't finish, so we don't know if test_ok passes now
+    assert py_test_runner.FailureIndex.for_workdir(str(tmp_path)).failures == [
+        (str(tmp_path / 'test_h.py'), 'test_ok'),
+        (str(tmp_path / 'test_h.py'), 'TestHang.test_hang'),
+    ]
+    db = py_test_runner.DurationDB.for_workdir(str(tmp_path))
+    assert [(key, [runs[0][1:]]) for key, runs in db.load().items()] == [
+        ((str(tmp_path / 'test_h.py'), 'TestHang.test_hang'),
+         [(30.0, 'timeout')]),
+    ]
+    assert py_test_runner.ResultCache.for_workdir(
+        str(tmp_path)).get('abc') is None
+
+
+def test_get_test_shards_balances_by_duration(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nshards = 2\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'test_s.py').write_text(SAMPLE_SOURCE)
+    py_test_runner.DurationDB.for_workdir(str(tmp_path)).record([
+        (str(tmp_path / 'test_s.py'), 'TestFoo.test_baz', 5.0, 'passed'),
+    ])
+    assert [shard['scope'] for shard in py_test_runner.get_test_shards(
+        'test_s.py', '')] == [
+        [['test_s.py', 'TestFoo.test_baz']],
+        [['test_s.py', 'doctest_foo'], ['test_s.py', 'TestFoo.test_bar']],
+    ]
+
+
+def test_get_slow_tests(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    db = py_test_runner.DurationDB.for_workdir(str(tmp_path))
+    db.record([(str(tmp_path / 'test_s.py'), 'TestFoo.test_bar', 1.0,
+                'passed'),
+               (str(tmp_path / 'test_s.py'), 'test_foo', 2.0, 'passed')])
+    db.record([(str(tmp_path / 'test_s.py'), 'TestFoo.test_bar', 1.5,
+                'passed')])
+    assert py_test_runner.get_slow_tests('test_s.py', '') == [
+        '   2.000s  test_foo',
+        '   1.500s  TestFoo.test_bar  (1.000 1.500, +50%)',
+    ]
+    assert py_test_runner.get_slow_tests('test_s.py', 'TestFoo.setUp') == [
+        '   1.500s  TestFoo.test_bar  (1.000 1.500, +50%)',
+    ]
+    assert py_test_runner.get_slow_tests('test_s.py', '', 1) == [
+        '   2.000s  test_foo',
+    ]
+
+
+def make_project(root, files):
+    for name, text in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(textwrap.dedent(text))
+
+
+PROJECT_FILES = {
+    'setup.py': '',
+    'src/pkg/__init__.py': 'from .core import main\n',
+    'src/pkg/core.py': 'from pkg import utils\n',
+    'src/pkg/utils.py': 'import os\n',
+    'src/pkg/extra.py': '',
+    'src/pkg/tests/__init__.py': '',
+    'src/pkg/tests/conftest.py': '',
+    'src/pkg/tests/test_core.py': 'from pkg.core import main\n',
+    'src/pkg/tests/test_extra.py': 'from .. import extra\n',
+    'tests/test_utils.py': 'import pkg.utils\n',
+    'tests/test_broken.py': 'import (\n',
+    '.tox/py3/lib/test_nope.py': '',
+    'venv/pyvenv.cfg': '',
+    'venv/lib/test_nope.py': '',
+}
+
+
+def test_ImportGraph(tmp_path):
+    make_project(tmp_path, PROJECT_FILES)
+    rc = RunnerConfiguration()
+    graph = py_test_runner.ImportGraph(
+        str(tmp_path), rc, str(tmp_path / 'cache' / 'imports.json'))
+    graph.scan()
+    assert sorted(os.path.relpath(f, str(tmp_path)) for f in graph.files) == [
+        'setup.py',
+        'src/pkg/__init__.py',
+        'src/pkg/core.py',
+        'src/pkg/extra.py',
+        'src/pkg/tests/__init__.py',
+        'src/pkg/tests/conftest.py',
+        'src/pkg/tests/test_core.py',
+        'src/pkg/tests/test_extra.py',
+        'src/pkg/utils.py',
+        'tests/test_broken.py',
+        'tests/test_utils.py',
+    ]
+
+    def imports(name):
+        return graph.files[str(tmp_path / name)].imports
+
+    assert imports('src/pkg/__init__.py') == ['pkg.core', 'pkg.core.main']
+    assert imports('src/pkg/core.py') == ['pkg', 'pkg.utils']
+    assert imports('src/pkg/tests/test_extra.py') == ['pkg', 'pkg.extra']
+    assert imports('tests/test_broken.py') == []
+
+    def affected(*names):
+        return [os.path.relpath(f, str(tmp_path)) for f in graph.get_affected(
+            [str(tmp_path / name) for name in names])]
+
+    assert affected('src/pkg/utils.py') == [
+        'src/pkg/tests/test_core.py',
+        'src/pkg/tests/test_extra.py',
+        'tests/test_utils.py',
+    ]
+    assert affected('src/pkg/extra.py') == ['src/pkg/tests/test_extra.py']
+    assert affected('tests/test_utils.py') == ['tests/test_utils.py']
+    assert affected('src/pkg/tests/conftest.py') == [
+        'src/pkg/tests/test_core.py',
+        'src/pkg/tests/test_extra.py',
+    ]
+    assert affected('src/pkg/gone.py') == []
+
+
+def test_ImportGraph_reuses_cache(tmp_path, monkeypatch):
+    make_project(tmp_path, {'test_a.py': 'import b\n', 'b.py': ''})
+    cache_file = str(tmp_path / 'cache' / 'imports.json')
+    rc = RunnerConfiguration()
+    py_test_runner.ImportGraph(str(tmp_path), rc, cache_file).scan()
+    graph = py_test_runner.ImportGraph(str(tmp_path), rc, cache_file)
+    monkeypatch.setattr(graph, 'parse', None)
+    graph.scan()
+    assert graph.files[str(tmp_path / 'test_a.py')].imports == ['b']
+
+
+def test_ImportGraph_skips_unreadable_files(tmp_path, monkeypatch):
+    make_project(tmp_path, {'test_a.py': ''})
+    graph = py_test_runner.ImportGraph(
+        str(tmp_path), RunnerConfiguration(), str(tmp_path / 'imports.json'))
+
+    def parse(filename, st, cached):
+        raise IOError('permission denied')
+
+    monkeypatch.setattr(graph, 'parse', parse)
+    graph.scan()
+    assert graph.files == {}
+
+
+def test_ImportGraph_get_imports_relative():
+    get_imports = py_test_runner.ImportGraph.get_imports
+    tree = ast.parse('from ..x import y\nfrom . import *\n')
+    assert get_imports(tree, 'a.b.c', False) == {'a.x', 'a.x.y', 'a.b'}
+    assert get_imports(tree, 'a.b', True) == {'a.x', 'a.x.y', 'a.b'}
+    assert get_imports(tree, 'c', False) == {'x', 'x.y'}
+
+
+def test_ImportGraph_get_changed(tmp_path):
+    graph = py_test_runner.ImportGraph(
+        str(tmp_path), RunnerConfiguration(), str(tmp_path / 'imports.json'))
+    graph.files = {
+        'a.py': py_test_runner.ModuleInfo(0, 0, 'aaa', []),
+        'b.py': py_test_runner.ModuleInfo(0, 0, 'bbb', []),
+        'c.py': py_test_runner.ModuleInfo(0, 0, 'ccc', []),
+    }
+    snapshot = {'a.py': 'aaa', 'b.py': 'old', 'd.py': 'ddd'}
+    assert graph.get_changed(snapshot) == ['b.py', 'c.py', 'd.py']
+
+
+def test_get_affected_tests(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    make_project(tmp_path, PROJECT_FILES)
+    monkeypatch.chdir(tmp_path)
+    assert py_test_runner.get_affected_tests('tests/test_utils.py') == dict(
+        filter='', scope=[], changed=[], snapshot=0)
+    assert py_test_runner.get_affected_tests('tests/test_utils.py') == dict(
+        filter='', scope=[], changed=[], snapshot=1)
+    (tmp_path / 'src/pkg/extra.py').write_text('import os\n')
+    index = py_test_runner.FailureIndex.for_workdir(str(tmp_path))
+    index.failures = [(str(tmp_path / 'tests/test_utils.py'), 'test_a'),
+                      (str(tmp_path / 'tests/test_gone.py'), 'test_b')]
+    index.save()
+    assert py_test_runner.get_affected_tests('tests/test_utils.py') == dict(
+        filter='src/pkg/tests/test_extra.py tests/test_utils.py',
+        scope=[[str(tmp_path / 'src/pkg/tests/test_extra.py'), ''],
+               [str(tmp_path / 'tests/test_utils.py'), '']],
+        changed=['src/pkg/extra.py'], snapshot=1)
+
+
+def test_ImportGraph_get_dependencies(tmp_path):
+    make_project(tmp_path, PROJECT_FILES)
+    graph = py_test_runner.ImportGraph(
+        str(tmp_path), RunnerConfiguration(), str(tmp_path / 'imports.json'))
+    graph.scan()
+
+    def dependencies(*names):
+        return [os.path.relpath(f, str(tmp_path))
+                for f in graph.get_dependencies(
+                    [str(tmp_path / name) for name in names])]
+
+    assert dependencies('src/pkg/tests/test_core.py') == [
+        'src/pkg/__init__.py',
+        'src/pkg/core.py',
+        'src/pkg/tests/__init__.py',
+        'src/pkg/tests/conftest.py',
+        'src/pkg/tests/test_core.py',
+        'src/pkg/utils.py',
+    ]
+    assert dependencies('tests/test_utils.py') == [
+        'src/pkg/__init__.py',
+        'src/pkg/core.py',
+        'src/pkg/utils.py',
+        'tests/test_utils.py',
+    ]
+    assert dependencies('tests/test_gone.py') == []
+
+
+def test_ImportGraph_refresh(tmp_path, monkeypatch):
+    root = tmp_path / 'project'
+    make_project(root, PROJECT_FILES)
+    graph = py_test_runner.ImportGraph(
+        str(root), RunnerConfiguration(), str(tmp_path / 'imports.json'))
+    graph.scan()
+    test_file = str(root / 'tests' / 'test_utils.py')
+    utils = str(root / 'src' / 'pkg' / 'utils.py')
+    stats = []
+    real_stat = os.stat
+
+    def stat(filename, **kw):
+        stats.append(os.path.relpath(filename, str(root)))
+        return real_stat(filename, **kw)
+
+    monkeypatch.setattr(os, 'stat', stat)
+    assert graph.refresh([test_file])
+    # Only the test file, the files it imports, and their directories.
+    assert sorted(set(stats)) == [
+        '.', 'src', 'src/pkg', 'src/pkg/__init__.py', 'src/pkg/core.py',
+        'src/pkg/utils.py', 'tests', 'tests/test_utils.py',
+    ]
+    with open(utils, 'a') as f:
+        f.write('import pkg.extra\n')
+    assert graph.refresh([test_file])
+    assert graph.files[utils].imports == ['os', 'pkg.extra']
+    (root / 'src' / 'pkg' / 'new.py').write_text('')
+    os.utime(str(root / 'src' / 'pkg'), (0, 0))
+    assert not graph.refresh([test_file])
+    assert not graph.refresh([str(root / 'tests' / 'test_gone.py')])
+    graph.scan()
+    os.unlink(utils)
+    mtime = graph.dirs[os.path.dirname(utils)]
+    os.utime(os.path.dirname(utils), (mtime, mtime))
+    assert not graph.refresh([test_file])
+
+
+def test_ImportGraph_directory_removed_during_scan(tmp_path, monkeypatch):
+    make_project(tmp_path, {'a/test_a.py': ''})
+    graph = py_test_runner.ImportGraph(
+        str(tmp_path), RunnerConfiguration(), str(tmp_path / 'imports.json'))
+    real_stat = os.stat
+
+    def stat(filename, **kw):
+        if filename == str(tmp_path / 'a'):
+            raise OSError('no such directory')
+        return real_stat(filename, **kw)
+
+    monkeypatch.setattr(os, 'stat', stat)
+    graph.scan()
+    assert graph.files == {}
+
+
+TEST_PROJECT_FILES = {
+    'setup.py': '',
+    'pkg/__init__.py': '',
+    'pkg/utils.py': 'def test_helper():\n    pass\n',
+    'pkg/tests/__init__.py': '',
+    'pkg/tests/test_utils.py': """\
+        class TestUtils:
+            def setUp(self):
+                pass
+            def test_helper(self):
+                pass
+        def test_other():
+            pass
+    """,
+    'tests/test_broken.py': 'def test_broken(:\n',
+    'tests/test_more.py': 'def test_more():\n    pass\n',
+}
+
+
+def test_TestIndex(tmp_path, monkeypatch):
+    make_project(tmp_path, TEST_PROJECT_FILES)
+    index = py_test_runner.TestIndex.for_workdir(str(tmp_path),
+                                                 RunnerConfiguration())
+    index.scan()
+    assert [(os.path.relpath(f, str(tmp_path)), tag)
+            for f, tag in index.get_tests()] == [
+        ('pkg/tests/test_utils.py', 'TestUtils.test_helper'),
+        ('pkg/tests/test_utils.py', 'test_other'),
+        ('tests/test_more.py', 'test_more'),
+    ]
+    # Files that were touched, but not changed, aren't parsed again.
+    os.utime(str(tmp_path / 'tests/test_more.py'), (1, 1))
+    monkeypatch.setattr(index, 'analyze', None)
+    index.scan()
+    assert index.files[str(tmp_path / 'tests/test_more.py')].mtime == 1
+    assert len(index.get_tests()) == 3
+
+
+def test_TestIndex_refresh(tmp_path):
+    make_project(tmp_path, TEST_PROJECT_FILES)
+    index = py_test_runner.TestIndex.for_workdir(str(tmp_path),
+                                                 RunnerConfiguration())
+    assert not hasattr(index, 'get_dependencies')
+    index.scan()
+    # The cache directory is in tmp_path too, and new after the first scan.
+    assert not index.refresh()
+    index.scan()
+    assert index.refresh()
+    assert len(index.get_tests()) == 3
+    test_more = tmp_path / 'tests/test_more.py'
+    test_more.write_text('def test_more():\n    pass\n\n\n'
+                         'def test_again():\n    pass\n')
+    os.utime(str(test_more), (1, 1))
+    assert index.refresh()
+    assert len(index.get_tests()) == 4
+    # New files need a scan()
+    (tmp_path / 'tests/test_new.py').write_text('def test_new():\n  pass\n')
+    os.utime(str(tmp_path / 'tests'), (1, 1))
+    assert not index.refresh()
+    index.scan()
+    assert len(index.get_tests()) == 5
+    test_more.unlink()
+    assert not index.refresh()
+
+
+def test_fuzzy_filter():
+    assert py_test_runner.fuzzy_score('bar', 'TestFoo.test_bar') == (0, 16)
+    assert py_test_runner.fuzzy_score('tfb', 'TestFoo.test_bar') == (
+        1, 13, 16)
+    assert py_test_runner.fuzzy_score('xyz', 'TestFoo.test_bar') is None
+    assert py_test_runner.fuzzy_filter('tb', [
+        'TestFoo.test_bar', 'test_b', 'test_a', 'TestFoo',
+    ]) == ['test_b', 'TestFoo.test_bar']
+
+
+def test_complete_test(monkeypatch):
+    mock_vim = MockVim()
+    mock_vim.current = MockCurrent()
+    monkeypatch.setattr(py_test_runner, 'vim', mock_vim)
+    complete_test = py_test_runner.complete_test
+    assert complete_test('test_s.py', '') == [
+        'TestFoo', 'doctest_foo', 'TestFoo.test_bar', 'TestFoo.test_baz',
+    ]
+    assert complete_test('test_s.py', 'baz') == ['TestFoo.test_baz']
+    mock_vim.current = MockCurrent()
+    mock_vim.current.buffer = MockBuffer(['def (:'])
+    assert complete_test('test_s.py', '') == []
+
+
+def test_find_tests(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    make_project(tmp_path, TEST_PROJECT_FILES)
+    monkeypatch.chdir(tmp_path)
+    find_tests = py_test_runner.find_tests
+    assert find_tests('tests/test_more.py', 'utilhelp') == dict(
+        filter='pkg/tests/test_utils.py::TestUtils::test_helper',
+        scope=[[str(tmp_path / 'pkg/tests/test_utils.py'),
+                'TestUtils.test_helper']],
+        names=['pkg/tests/test_utils.py::TestUtils.test_helper'],
+    )
+    assert py_test_runner.find_tests('tests/test_more.py', 'more')[
+        'names'] == ['tests/test_more.py::test_more']
+    assert py_test_runner.find_tests('tests/test_more.py', 'test')[
+        'filter'] == ('pkg/tests/test_utils.py::TestUtils::test_helper'
+                      ' pkg/tests/test_utils.py::test_other'
+                      ' tests/test_more.py::test_more')
+
+
+def test_find_tests_reuses_the_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    make_project(tmp_path, TEST_PROJECT_FILES)
+    monkeypatch.chdir(tmp_path)
+    find_tests = py_test_runner.find_tests
+    # The cache directory is in tmp_path too, and new after the first scan.
+    assert len(find_tests('tests/test_more.py', '')['names']) == 3
+    assert len(find_tests('tests/test_more.py', '')['names']) == 3
+    walk = os.walk
+    monkeypatch.setattr(os, 'walk', None)
+    assert len(find_tests('tests/test_more.py', '')['names']) == 3
+    (tmp_path / 'tests/test_new.py').write_text('def test_new():\n  pass\n')
+    os.utime(str(tmp_path / 'tests'), (1, 1))
+    monkeypatch.setattr(os, 'walk', walk)
+    assert len(find_tests('tests/test_more.py', '')['names']) == 4
+    py_test_runner.reload_config()
+    assert py_test_runner.test_indexes == {}
+
+
+def test_ResultCache(tmp_path, monkeypatch):
+    cache = py_test_runner.ResultCache(str(tmp_path / 'results'))
+    assert cache.get('a') is None
+    cache.put('a', dict(items=[], exit_status=0))
+    assert cache.get('a') == dict(items=[], exit_status=0)
+    size = os.path.getsize(cache.get_filename('a'))
+    monkeypatch.setattr(cache, 'MAX_SIZE', 2 * size)
+    os.utime(cache.get_filename('a'), (1, 1))
+    cache.put('b', dict(items=[], exit_status=1))
+    cache.put('c', dict(items=[], exit_status=1))
+    assert sorted(os.listdir(cache.dirname)) == ['b.json', 'c.json']
+
+
+def test_get_cached_result(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    make_project(tmp_path, PROJECT_FILES)
+    monkeypatch.chdir(tmp_path)
+    command = 'pytest -ra tests/test_utils.py'
+    scope = [['tests/test_utils.py', '']]
+    cached = py_test_runner.get_cached_result('tests/test_utils.py',
+                                              command, scope)
+    assert cached['result'] == {}
+    parser_id = py_test_runner.start_output_parser(
+        'pytest', 'tests/test_utils.py', scope, cache_key=cached['key'])
+    items = py_test_runner.parse_output(parser_id, ['1 passed'])
+    py_test_runner.stop_output_parser(parser_id, completed=True,
+                                      exit_status=0)
+    assert py_test_runner.get_cached_result(
+        'tests/test_utils.py', command, scope) == dict(
+            key=cached['key'], result=dict(items=items, exit_status=0))
+    (tmp_path / 'setup.cfg').write_text('[tool:pytest]\n')
+    assert py_test_runner.get_cached_result(
+        'tests/test_utils.py', command, scope)['result'] == {}
+
+
+def test_get_cached_result_depends_on_imports(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    make_project(tmp_path, PROJECT_FILES)
+    monkeypatch.chdir(tmp_path)
+    get_result_key = py_test_runner.get_result_key
+    scope = [['tests/test_utils.py', 'test_a']]
+    key = get_result_key('tests/test_utils.py', 'pytest', scope)
+    (tmp_path / 'src/pkg/extra.py').write_text('import os\n')
+    assert get_result_key('tests/test_utils.py', 'pytest', scope) == key
+    assert get_result_key('tests/test_utils.py', 'pytest -x', scope) != key
+    (tmp_path / 'src/pkg/utils.py').write_text('import sys\n')
+    assert get_result_key('tests/test_utils.py', 'pytest', scope) != key
+
+
+def test_get_cached_result_not_cacheable(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[path:nope]\noutput_format =\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    make_project(tmp_path, {'test_a.py': '', 'nope/test_b.py': ''})
+    monkeypatch.chdir(tmp_path)
+    get_result_key = py_test_runner.get_result_key
+    assert get_result_key('test_a.py', 'pytest', [['', '']]) == ''
+    assert get_result_key('test_a.py', 'pytest', []) == ''
+    assert get_result_key('test_a.py', 'pytest', [['/elsewhere.py', '']]) == ''
+    assert get_result_key('nope/test_b.py', 'pytest',
+                          [['nope/test_b.py', '']]) == ''
+    assert py_test_runner.get_cached_result(
+        'test_a.py', 'pytest', []) == dict(key='', result={})
+
+
+def test_get_display_filename(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    get_display_filename = py_test_runner.get_display_filename
+    assert get_display_filename(str(tmp_path / 'a.py')) == 'a.py'
+    assert get_display_filename('/elsewhere/a.py') == '/elsewhere/a.py'
+
+
+def make_coverage_data(filename, contexts, files, line_bits):
+    conn = sqlite3.connect(filename)
+    conn.executescript('''
+        CREATE TABLE file (id INTEGER PRIMARY KEY, path TEXT);
+        CREATE TABLE context (id INTEGER PRIMARY KEY, context TEXT);
+        CREATE TABLE line_bits (file_id INTEGER, context_id INTEGER,
+                                numbits BLOB);
+    ''')
+    conn.executemany('INSERT INTO context VALUES (?, ?)',
+                     enumerate(contexts, 1))
+    conn.executemany('INSERT INTO file VALUES (?, ?)', enumerate(files, 1))
+    conn.executemany('INSERT INTO line_bits VALUES (?, ?, ?)', line_bits)
+    conn.commit()
+    conn.close()
+
+
+def test_numbits_to_ranges():
+    ranges = py_test_runner.numbits_to_ranges
+    assert ranges(b'') == []
+    assert ranges(b'\xca') == [[1, 1], [3, 3], [6, 7]]
+    assert ranges(b'\x80\x03\x00\x01') == [[7, 9], [24, 24]]
+
+
+def test_CoverageMap_get_test():
+    get_test = py_test_runner.CoverageMap.get_test
+    files = ['/src/pkg/mod.py', '/src/pkg/tests/test_mod.py']
+    assert get_test('pkg.tests.test_mod.TestFoo.test_bar', files) == (
+        '/src/pkg/tests/test_mod.py', 'TestFoo.test_bar')
+    assert get_test('pkg.tests.test_mod.test_bar', files) == (
+        '/src/pkg/tests/test_mod.py', 'test_bar')
+    assert get_test('test_mod.test_bar', files) == (
+        '/src/pkg/tests/test_mod.py', 'test_bar')
+    assert get_test('test_other.test_bar', files) is None
+    assert get_test('Tests.TestFoo.test_bar', files) is None
+    assert get_test('test_bar', files) is None
+
+
+def test_CoverageMap(tmp_path):
+    data_file = str(tmp_path / 'coverage.db.1')
+    make_coverage_data(
+        data_file,
+        ['', 'test_cov.test_f', 'test_cov.TestG.test_g', 'other.test_x'],
+        ['/p/test_cov.py', '/p/pkg/mod.py'],
+        [(1, 1, b'\xca'), (2, 1, b'\x01'),
+         (1, 2, b'\x10'), (2, 2, b'\x0c'),
+         (1, 3, b'\x00\x01'), (2, 3, b'\x80'),
+         (2, 4, b'\x80')])
+    coverage_map = py_test_runner.CoverageMap(str(tmp_path / 'map.json'))
+    assert coverage_map.update(data_file)
+    assert coverage_map.find_tests('/p/pkg/mod.py', 1, 4) == [
+        ('/p/test_cov.py', 'test_f'),
+    ]
+    assert coverage_map.find_tests('/p/pkg/mod.py', 6, 7) == [
+        ('/p/test_cov.py', 'TestG.test_g'),
+    ]
+    assert coverage_map.find_tests('/p/pkg/mod.py', 1, 100) == [
+        ('/p/test_cov.py', 'TestG.test_g'), ('/p/test_cov.py', 'test_f'),
+    ]
+    assert coverage_map.find_tests('/p/pkg/other.py', 1, 100) == []
+    coverage_map.save()
+    coverage_map = py_test_runner.CoverageMap(str(tmp_path / 'map.json'))
+    assert coverage_map.find_tests('/p/pkg/mod.py', 6, 7) == [
+        ('/p/test_cov.py', 'TestG.test_g'),
+    ]
+    # Later runs replace the coverage of the tests they ran
+    coverage_map.set_coverage(('/p/test_cov.py', 'TestG.test_g'),
+                              {'/p/pkg/mod.py': [[2, 2]]})
+    assert coverage_map.find_tests('/p/pkg/mod.py', 6, 7) == []
+    assert coverage_map.find_tests('/p/pkg/mod.py', 2, 2) == [
+        ('/p/test_cov.py', 'TestG.test_g'), ('/p/test_cov.py', 'test_f'),
+    ]
+
+
+def test_CoverageMap_bad_data_file(tmp_path):
+    (tmp_path / 'coverage.db.1').write_text('not a database')
+    coverage_map = py_test_runner.CoverageMap(str(tmp_path / 'map.json'))
+    assert not coverage_map.update(str(tmp_path / 'coverage.db.1'))
+
+
+def test_get_coverage_rcfile(cache_dir):
+    rcfile = py_test_runner.get_coverage_rcfile('/src/project')
+    assert rcfile.startswith(str(cache_dir))
+    with open(rcfile) as f:
+        text = f.read()
+    assert 'dynamic_context = test_function\n' in text
+    assert 'source = /src/project\n' in text
+    mtime = os.stat(rcfile).st_mtime_ns
+    os.utime(rcfile, ns=(0, 0))
+    assert py_test_runner.get_coverage_rcfile('/src/project') == rcfile
+    assert os.stat(rcfile).st_mtime_ns == 0 != mtime
+
+
+def test_update_coverage_map(tmp_path):
+    workdir = str(tmp_path)
+    py_test_runner.update_coverage_map(workdir)
+    assert not os.path.exists(
+        py_test_runner.CoverageMap.for_workdir(workdir).filename)
+    cache_dir = py_test_runner.get_cache_dir(workdir)
+    os.makedirs(cache_dir)
+    make_coverage_data(os.path.join(cache_dir, 'coverage.db.host.1'),
+                       ['test_a.test_a'], [str(tmp_path / 'test_a.py')],
+                       [(1, 1, b'\x02')])
+    (tmp_path / 'bad').write_text('junk')
+    os.rename(str(tmp_path / 'bad'),
+              os.path.join(cache_dir, 'coverage.db.host.2'))
+    py_test_runner.update_coverage_map(workdir)
+    coverage_map = py_test_runner.CoverageMap.for_workdir(workdir)
+    assert coverage_map.tests == [(str(tmp_path / 'test_a.py'), 'test_a')]
+    assert sorted(os.listdir(cache_dir)) == [
+        'coverage.db.host.2', 'coverage.json',
+    ]
+
+
+def test_stop_output_parser_updates_coverage_map(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    cache_dir = py_test_runner.get_cache_dir(str(tmp_path))
+    os.makedirs(cache_dir)
+    make_coverage_data(os.path.join(cache_dir, 'coverage.db.host.1'),
+                       ['test_a.test_a'], [str(tmp_path / 'test_a.py')],
+                       [(1, 1, b'\x02')])
+    parser_id = py_test_runner.start_output_parser('pytest', coverage=True)
+    py_test_runner.stop_output_parser(parser_id, completed=True)
+    coverage_map = py_test_runner.CoverageMap.for_workdir(str(tmp_path))
+    assert coverage_map.tests == [(str(tmp_path / 'test_a.py'), 'test_a')]
+
+
+def test_get_test_command_with_coverage(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    rcfile = py_test_runner.get_coverage_rcfile(str(tmp_path))
+    assert py_test_runner.get_test_command('tests.py', coverage=True) == (
+        'coverage run --rcfile=%s -m pytest -ra' % rcfile)
+
+
+def test_get_test_command_with_coverage_not_supported(monkeypatch, tmp_path):
+    configfile = tmp_path / 'py-test-runner.cfg'
+    configfile.write_text('[default]\nrunner = custom\n'
+                          '[runner:custom]\ncommand = runtests\n')
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerConfigFile': str(configfile),
+    }))
+    assert py_test_runner.get_test_command('tests.py', coverage=True) == (
+        'runtests')
+
+
+def test_get_tests_covering_cursor(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    mock_vim = MockVim({'b:changedtick': '42'})
+    mock_vim.current = MockCurrent()
+    mock_vim.current.buffer = MockBuffer(SAMPLE_SOURCE.splitlines())
+    mock_vim.current.buffer.name = str(tmp_path / 'pkg' / 'mod.py')
+    mock_vim.current.window = MockWindow()
+    monkeypatch.setattr(py_test_runner, 'vim', mock_vim)
+    monkeypatch.setattr(py_test_runner, 'tag_cache',
+                        py_test_runner.TagCache())
+    coverage_map = py_test_runner.CoverageMap.for_workdir(str(tmp_path))
+    mod = str(tmp_path / 'pkg' / 'mod.py')
+    coverage_map.set_coverage((str(tmp_path / 'test_a.py'), 'test_a'),
+                              {mod: [[14, 14]]})
+    coverage_map.set_coverage((str(tmp_path / 'test_a.py'), 'test_b'),
+                              {mod: [[1, 1]]})
+    coverage_map.set_coverage((str(tmp_path / 'test_a.py'), 'test_a'),
+                              {mod: [[14, 14]]})
+    coverage_map.save()
+    # The cursor is on line 13, in TestFoo.setUp
+    assert py_test_runner.get_tests_covering_cursor() == dict(
+        filter='test_a.py::test_a',
+        scope=[[str(tmp_path / 'test_a.py'), 'test_a']])
+    mock_vim.current.window.cursor = (1, 0)
+    assert py_test_runner.get_tests_covering_cursor() == dict(
+        filter='test_a.py::test_b',
+        scope=[[str(tmp_path / 'test_a.py'), 'test_b']])
+
+
+def test_get_tests_covering_cursor_syntax_error(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    mock_vim = MockVim({'b:changedtick': '42'})
+    mock_vim.current = MockCurrent()
+    mock_vim.current.buffer = MockBuffer(['def (:'])
+    mock_vim.current.buffer.name = 'mod.py'
+    mock_vim.current.window = MockWindow()
+    monkeypatch.setattr(py_test_runner, 'vim', mock_vim)
+    monkeypatch.setattr(py_test_runner, 'tag_cache',
+                        py_test_runner.TagCache())
+    assert py_test_runner.get_tests_covering_cursor() == dict(
+        filter='', scope=[])
+
+
+def test_get_tests_in_range(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    mock_vim = MockVim({'b:changedtick': '42'})
+    mock_vim.current = MockCurrent()
+    mock_vim.current.buffer = MockBuffer(SAMPLE_SOURCE.splitlines())
+    mock_vim.current.buffer.name = str(tmp_path / 'test_s.py')
+    monkeypatch.setattr(py_test_runner, 'vim', mock_vim)
+    monkeypatch.setattr(py_test_runner, 'tag_cache',
+                        py_test_runner.TagCache())
+    assert py_test_runner.get_tests_in_range(1, 30) == dict(
+        filter='test_s.py::test_s.doctest_foo test_s.py::TestFoo::test_bar'
+               ' test_s.py::TestFoo::test_baz',
+        scope=[[str(tmp_path / 'test_s.py'), 'doctest_foo'],
+               [str(tmp_path / 'test_s.py'), 'TestFoo.test_bar'],
+               [str(tmp_path / 'test_s.py'), 'TestFoo.test_baz']])
+    assert py_test_runner.get_tests_in_range(12, 14) == dict(
+        filter='', scope=[])
+    mock_vim.current.buffer = MockBuffer(['def (:'])
+    mock_vim.current.buffer.name = str(tmp_path / 'test_broken.py')
+    mock_vim.current.buffer.number = 2
+    assert py_test_runner.get_tests_in_range(1, 1) == dict(
+        filter='', scope=[])
+
+
+def test_get_tests_at_lines(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    make_project(tmp_path, {
+        'test_s.py': SAMPLE_SOURCE,
+        'test_broken.py': 'def (:',
+        'doc.txt': '>>> 1\n1\n',
+    })
+    test_s = str(tmp_path / 'test_s.py')
+    doc = str(tmp_path / 'doc.txt')
+    assert py_test_runner.get_tests_at_lines('test_s.py', [
+        [test_s, '16'], [test_s, '18'], [test_s, '13'], [doc, '1'],
+        [str(tmp_path / 'test_broken.py'), '1'],
+        [str(tmp_path / 'test_broken.py'), '2'],
+        [str(tmp_path / 'test_gone.py'), '1'],
+    ]) == dict(
+        filter='test_s.py::TestFoo::test_bar doc.txt -k doc.txt',
+        scope=[[test_s, 'TestFoo.test_bar'], [doc, '']])
+
+
+def test_get_tests_at_lines_failure_in_helper(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.chdir(tmp_path)
+    make_project(tmp_path, {
+        'helpers.py': 'def check(x):\n    assert x\n',
+        'test_h.py': 'from helpers import check\n\n'
+                     'def test_it():\n    check(0)\n',
+    })
+    parser_id = py_test_runner.start_output_parser(
+        'pytest', 'test_h.py', [['test_h.py', '']])
+    items = py_test_runner.parse_output(parser_id, [
+        '_' * 20 + ' test_it ' + '_' * 20,
+        '',
+        '    def test_it():',
+        '>       check(0)',
+        '',
+        'test_h.py:4: ',
+        '_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _',
+        '',
+        '    def check(x):',
+        '>       assert x',
+        'E       assert 0',
+        '',
+        'helpers.py:2: AssertionError',
+        '=' * 20 + ' short test summary info ' + '=' * 20,
+    ])
+    py_test_runner.stop_output_parser(parser_id)
+    [item] = [item for item in items if 'filename' in item]
+    assert item['filename'] == 'helpers.py'
+    test_h = str(tmp_path / 'test_h.py')
+    assert item['user_data'] == dict(test_file=test_h, tag='test_it')
+    # The line in the helper isn't in a test
+    helpers = str(tmp_path / 'helpers.py')
+    assert py_test_runner.get_tests_at_lines(
+        'test_h.py', [[helpers, item['lnum']]]) == dict(filter='', scope=[])
+    # what pytestrunner#get_quickfix_tests() does with user_data
+    assert py_test_runner.get_tests_at_lines(
+        'test_h.py', [], [[test_h, 'test_it'], [test_h, 'test_it']]) == dict(
+        filter='test_h.py::test_it', scope=[[test_h, 'test_it']])
+
+
+def test_start_output_parser_unknown_format():
+    assert py_test_runner.start_output_parser('') == 0
+    assert py_test_runner.start_output_parser('tap') == 0
+
+
+def test_Profiler(tmp_path):
+    profiler = py_test_runner.Profiler(maxruns=2)
+    profiler.add('get_runner', 0.002)
+    profiler.add('find_overrides', 0.001)
+    profiler.add('find_overrides', 0.0005)
+    profiler.end_run('pytest test_a.py', {'process': '1.5', 'launch': '0'})
+    assert profiler.runs[0]['spans'] == [
+        ('get_runner', 0.002), ('find_overrides', 0.001),
+        ('find_overrides', 0.0005), ('launch', 0.0), ('process', 1.5),
+    ]
+    assert list(profiler.spans) == []
+    assert profiler.summarize(profiler.runs[0]['spans']) == OrderedDict([
+        ('process', [1, 1.5]), ('get_runner', [1, 0.002]),
+        ('find_overrides', [2, 0.0015]), ('launch', [1, 0.0]),
+    ])
+    profiler.runs[0]['time'] = 0
+    assert profiler.format() == [
+        time.strftime('%H:%M:%S', time.localtime(0)) + '  pytest test_a.py',
+        '    1500.000 ms  process              (1x)',
+        '       2.000 ms  get_runner           (1x)',
+        '       1.500 ms  find_overrides       (2x)',
+        '       0.000 ms  launch               (1x)',
+    ]
+    profiler.end_run('pytest test_b.py')
+    profiler.end_run('pytest test_c.py')
+    assert [run['command'] for run in profiler.runs] == [
+        'pytest test_b.py', 'pytest test_c.py']
+    profiler.save(str(tmp_path / 'profile.json'))
+    with open(str(tmp_path / 'profile.json')) as f:
+        assert json.load(f) == [
+            dict(command='pytest test_b.py', spans=[],
+                 time=profiler.runs[0]['time']),
+            dict(command='pytest test_c.py', spans=[],
+                 time=profiler.runs[1]['time']),
+        ]
+
+
+def test_profiling(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'profiler', py_test_runner.Profiler())
+    monkeypatch.setattr(py_test_runner, 'runner_cache',
+                        py_test_runner.RunnerCache())
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    py_test_runner.get_test('tests.py', 'test_a')
+    assert list(py_test_runner.profiler.spans) == []
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim({
+        'g:pyTestRunnerProfile': '1',
+    }))
+    py_test_runner.get_test('test_b.py', 'test_a')
+    assert [name for name, seconds in py_test_runner.profiler.spans] == [
+        'find_overrides', 'get_runner', 'construct_filter',
+    ]
+    py_test_runner.end_profiled_run('pytest test_b.py', {'process': 1})
+    profile = py_test_runner.get_profile()
+    assert profile[0].endswith('  pytest test_b.py')
+    assert profile[1] == '    1000.000 ms  process              (1x)'
+    assert len(profile) == 5
+
+
+def test_save_profile(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'profiler', py_test_runner.Profiler())
+    py_test_runner.save_profile(str(tmp_path / 'profile.json'))
+    assert (tmp_path / 'profile.json').read_text() == '[]'
+
+
+def test_file_changed(monkeypatch, tmp_path):
+    monkeypatch.setattr(py_test_runner, 'file_digests', {})
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.py').write_text('a = 1\n')
+    (tmp_path / 'b.py').write_text('b = 1\n')
+    py_test_runner.watch_files(['a.py', str(tmp_path / 'gone.py')])
+    assert not py_test_runner.file_changed('a.py')
+    assert py_test_runner.file_changed('b.py')
+    assert not py_test_runner.file_changed('b.py')
+    (tmp_path / 'a.py').write_text('a = 2\n')
+    assert py_test_runner.file_changed(str(tmp_path / 'a.py'))
+    assert not py_test_runner.file_changed('a.py')
+    assert not py_test_runner.file_changed('gone.py')
+
+
+def test_prewarm(monkeypatch):
+    monkeypatch.setattr(py_test_runner, 'vim', MockVim())
+    monkeypatch.setattr(py_test_runner, 'runner_cache',
+                        py_test_runner.RunnerCache())
+    py_test_runner.prewarm('tests.py')
+    assert py_test_runner.runner_cache.stats()['size'] == 1
+
+
+def test_import_is_lazy():
+    # These modules take a while to import and are rarely needed.
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, py_test_runner; print(" ".join(sorted(sys.modules)))',
+    ], cwd=os.path.dirname(os.path.abspath(py_test_runner.__file__)))
+    modules = output.decode().split()
+    assert 'py_test_runner' in modules
+    for name in ['configparser', 'sqlite3', 'glob', 'ast', 'json',
+                 'hashlib']:
+        assert name not in modules
+
+
+def test_reload_config():
+    config = PyTestRunner('/dev/null').config
+    py_test_runner.reload_config()
+    assert PyTestRunner('/dev/null').config is not config
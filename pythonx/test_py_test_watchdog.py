@@ -0,0 +1,126 @@
+import io
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import py_test_watchdog
+
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, 'killpg'), reason='needs Unix')
+
+
+HANG = textwrap.dedent('''\
+    import time
+    print('started', flush=True)
+    def test_hang():
+        time.sleep(60)
+    test_hang()
+''')
+
+
+def run(code, **kw):
+    output = io.BytesIO()
+    watchdog = py_test_watchdog.Watchdog(
+        [sys.executable, '-c', code], output=output, grace_period=5, **kw)
+    status = watchdog.run()
+    return status, output.getvalue().decode('UTF-8')
+
+
+def test_Watchdog_passes_exit_status_and_output():
+    status, output = run('print("hello"); raise SystemExit(3)', timeout=30)
+    assert status == 3
+    assert output == 'hello\n'
+
+
+def test_Watchdog_timeout():
+    status, output = run(HANG, timeout=0.5)
+    assert status == py_test_watchdog.TIMED_OUT
+    assert output.startswith('started\n')
+    # faulthandler's stack dump
+    assert 'line 4 in test_hang' in output
+    assert output.endswith(
+        'py-test-runner: test run killed after 0.5 seconds (timeout)\n')
+
+
+def test_Watchdog_per_test_timeout():
+    status, output = run(HANG, per_test_timeout=0.5)
+    assert status == py_test_watchdog.TIMED_OUT
+    assert output.endswith(
+        'py-test-runner: test run killed after 0.5 seconds without output'
+        ' (per_test_timeout)\n')
+
+
+def test_Watchdog_per_test_timeout_counts_partial_lines():
+    code = textwrap.dedent('''\
+        import sys, time
+        for i in range(4):
+            time.sleep(0.3)
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    ''')
+    status, output = run(code, per_test_timeout=1)
+    assert status == 0
+    assert output == '....'
+
+
+def test_Watchdog_kills_processes_that_ignore_sigabrt():
+    code = 'import signal; signal.signal(signal.SIGABRT, signal.SIG_IGN)\n'
+    output = io.BytesIO()
+    watchdog = py_test_watchdog.Watchdog(
+        [sys.executable, '-c', code + HANG], output=output, timeout=0.5,
+        grace_period=0.5)
+    assert watchdog.run() == py_test_watchdog.TIMED_OUT
+    assert watchdog.process.returncode == -signal.SIGKILL
+
+
+def test_Watchdog_signal_before_start():
+    py_test_watchdog.Watchdog(['true']).signal(signal.SIGKILL)
+
+
+def test_Watchdog_signal_after_exit():
+    watchdog = py_test_watchdog.Watchdog([sys.executable, '-c', 'pass'],
+                                         output=io.BytesIO())
+    assert watchdog.run() == 0
+    watchdog.signal(signal.SIGKILL)
+
+
+def test_parse_args():
+    args = py_test_watchdog.parse_args(
+        ['--timeout', '60', 'pytest', '-ra', '--timeout=5', 'test_foo.py'])
+    assert args.timeout == 60
+    assert args.per_test_timeout == 0
+    assert args.argv == ['pytest', '-ra', '--timeout=5', 'test_foo.py']
+
+
+def test_parse_args_no_command(capsys):
+    with pytest.raises(SystemExit):
+        py_test_watchdog.parse_args(['--timeout', '5'])
+    assert 'no command to run' in capsys.readouterr().err
+
+
+def test_main():
+    output = subprocess.run(
+        [sys.executable, py_test_watchdog.__file__, '--timeout', '0.5',
+         sys.executable, '-c', HANG],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    assert output.returncode == py_test_watchdog.TIMED_OUT
+    assert b'killed after 0.5 seconds (timeout)' in output.stdout
+
+
+def test_Watchdog_stops_when_parent_dies(monkeypatch):
+    watchdog = py_test_watchdog.Watchdog(
+        [sys.executable, '-c', HANG], output=io.BytesIO())
+    start = watchdog.start
+
+    def start_and_die():
+        start()
+        monkeypatch.setattr(os, 'getppid', lambda: 1)
+
+    monkeypatch.setattr(watchdog, 'start', start_and_die)
+    assert watchdog.run() == py_test_watchdog.ORPHANED
+    assert watchdog.process.wait() == -signal.SIGKILL
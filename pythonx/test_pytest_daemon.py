@@ -0,0 +1,213 @@
+import faulthandler
+import os
+import signal
+import socket
+import sys
+import textwrap
+import threading
+import time
+import types
+
+import pytest
+
+import pytest_daemon
+
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork'),
+    reason='needs Unix')
+
+
+def test_get_socket_path(tmp_path):
+    path = pytest_daemon.get_socket_path(str(tmp_path))
+    assert path == pytest_daemon.get_socket_path(str(tmp_path) + '/')
+    assert path != pytest_daemon.get_socket_path(str(tmp_path / 'other'))
+
+
+def test_get_socket_dir(monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    assert pytest_daemon.get_socket_dir() == '/run/user/1000/py-test-runner'
+    monkeypatch.delenv('XDG_RUNTIME_DIR')
+    assert pytest_daemon.get_socket_dir() == os.path.join(
+        pytest_daemon.tempfile.gettempdir(),
+        'py-test-runner-%d' % os.getuid())
+
+
+def test_make_private_dir(tmp_path):
+    dirname = str(tmp_path / 'private')
+    assert pytest_daemon.make_private_dir(dirname)
+    assert os.stat(dirname).st_mode & 0o777 == 0o700
+    assert pytest_daemon.make_private_dir(dirname)
+    os.chmod(dirname, 0o777)
+    assert not pytest_daemon.make_private_dir(dirname)
+    os.symlink(str(tmp_path), str(tmp_path / 'link'))
+    assert not pytest_daemon.make_private_dir(str(tmp_path / 'link'))
+    assert not pytest_daemon.make_private_dir(str(tmp_path / 'no' / 'such'))
+
+
+def test_send_recv_message():
+    a, b = socket.socketpair()
+    with a, b:
+        pytest_daemon.send_message(a, {'args': ['-k', 'foo']})
+        assert pytest_daemon.recv_message(b) == ({'args': ['-k', 'foo']}, [])
+
+
+def test_send_recv_message_with_fds():
+    a, b = socket.socketpair()
+    r, w = os.pipe()
+    with a, b:
+        pytest_daemon.send_message(a, {'hello': 'world'}, fds=[w])
+        os.close(w)
+        message, fds = pytest_daemon.recv_message(b, maxfds=2)
+    assert message == {'hello': 'world'}
+    assert len(fds) == 1
+    os.write(fds[0], b'hi')
+    os.close(fds[0])
+    assert os.read(r, 10) == b'hi'
+    os.close(r)
+
+
+def test_recv_message_connection_closed():
+    a, b = socket.socketpair()
+    r, w = os.pipe()
+    with b:
+        fds = pytest_daemon.array.array('i', [w])
+        a.sendmsg([b'{"incomplete'],
+                  [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        a.close()
+        assert pytest_daemon.recv_message(b, maxfds=1) == (None, [])
+    os.close(r)
+    os.close(w)
+
+
+def test_ModuleWatcher(tmp_path, monkeypatch):
+    (tmp_path / 'watched_module.py').write_text('')
+    module = types.ModuleType('watched_module')
+    module.__file__ = str(tmp_path / 'watched_module.py')
+    monkeypatch.setitem(sys.modules, 'watched_module', module)
+    watcher = pytest_daemon.ModuleWatcher(str(tmp_path))
+    watcher.snapshot()
+    assert str(tmp_path / 'watched_module.py') in watcher.mtimes
+    assert str(tmp_path / 'conftest.py') in watcher.mtimes
+    assert not any(filename.startswith(os.path.dirname(os.__file__))
+                   for filename in watcher.mtimes)
+    assert not watcher.changed()
+    (tmp_path / 'conftest.py').write_text('')
+    assert watcher.changed()
+
+
+def test_wait_for_exit(tmp_path):
+    socket_path = str(tmp_path / 'stale.sock')
+    open(socket_path, 'w').close()
+    pytest_daemon.wait_for_exit(socket_path, timeout=0)
+    assert not os.path.exists(socket_path)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    (tmp_path / 'helper.py').write_text('VALUE = 1\n')
+    (tmp_path / 'conftest.py').write_text('import helper\n')
+    (tmp_path / 'test_sample.py').write_text(textwrap.dedent('''\
+        from helper import VALUE
+
+        def test_value():
+            assert VALUE == 1
+    '''))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    pytest_daemon.stop()
+
+
+def test_run(project, capfd):
+    assert pytest_daemon.run(['test_sample.py', '-p', 'no:cacheprovider']) == 0
+    assert os.path.exists(pytest_daemon.get_socket_path(str(project)))
+    assert '1 passed' in capfd.readouterr().out
+    # second time around the server is already running
+    args = ['test_sample.py', '-p', 'no:cacheprovider']
+    assert pytest_daemon.main(args) == 0
+    assert '1 passed' in capfd.readouterr().out
+
+
+def test_run_restarts_when_sources_change(project, capfd):
+    assert pytest_daemon.run(['test_sample.py', '-p', 'no:cacheprovider']) == 0
+    (project / 'helper.py').write_text('VALUE = 2\n')
+    os.utime(str(project / 'helper.py'), (0, 0))
+    assert pytest_daemon.run(['test_sample.py', '-p', 'no:cacheprovider']) == 1
+    assert 'assert 2 == 1' in capfd.readouterr().out
+
+
+def test_run_server_fails_to_start(project, capfd, monkeypatch):
+    monkeypatch.setattr(pytest_daemon, 'start_server', lambda path, args: (
+        pytest_daemon.subprocess.Popen([sys.executable, '-c', 'pass'])))
+    assert pytest_daemon.run(['test_sample.py', '-p', 'no:cacheprovider']) == 0
+    out, err = capfd.readouterr()
+    assert 'pytest daemon failed to start' in err
+    assert '1 passed' in out
+
+
+def test_run_socket_dir_not_private(project, capfd, monkeypatch, tmp_path):
+    socket_dir = tmp_path / 'shared'
+    socket_dir.mkdir(mode=0o777)
+    socket_dir.chmod(0o777)
+    monkeypatch.setattr(pytest_daemon, 'get_socket_dir',
+                        lambda: str(socket_dir))
+    assert pytest_daemon.run(['test_sample.py', '-p', 'no:cacheprovider']) == 0
+    out, err = capfd.readouterr()
+    assert 'pytest daemon not started: %s is not private' % socket_dir in err
+    assert '1 passed' in out
+    assert os.listdir(str(socket_dir)) == []
+
+
+def test_run_server_crashes(project, capfd, monkeypatch):
+    monkeypatch.setattr(pytest_daemon, 'recv_message',
+                        lambda conn: (None, []))
+    assert pytest_daemon.run(['test_sample.py']) == 1
+    assert 'pytest daemon crashed' in capfd.readouterr().err
+
+
+def test_run_passes_sigabrt_on(project, capfd):
+    (project / 'test_hang.py').write_text(textwrap.dedent('''\
+        import time
+
+        def test_hang():
+            open('started', 'w').close()
+            time.sleep(60)
+    '''))
+    default_handler = signal.getsignal(signal.SIGABRT)
+
+    def abort_when_started():
+        # like py_test_watchdog.py does when the test takes too long
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            if (os.path.exists(str(project / 'started'))
+                    and signal.getsignal(signal.SIGABRT) != default_handler):
+                os.kill(os.getpid(), signal.SIGABRT)
+                return
+            time.sleep(0.01)
+
+    thread = threading.Thread(target=abort_when_started)
+    thread.start()
+    status = pytest_daemon.run(['test_hang.py', '-p', 'no:cacheprovider'])
+    thread.join()
+    assert status == 128 + signal.SIGABRT
+    assert signal.getsignal(signal.SIGABRT) == default_handler
+    assert 'in test_hang' in capfd.readouterr().err
+
+
+def test_forward_signal_process_gone():
+    # A handler that wasn't set from Python, like PYTHONFAULTHANDLER's
+    faulthandler.register(signal.SIGUSR1)
+    try:
+        with pytest_daemon.forward_signal(signal.SIGUSR1, 0x7ffffff0) as fwd:
+            os.kill(os.getpid(), signal.SIGUSR1)
+        assert fwd == [signal.SIGUSR1]
+        assert signal.getsignal(signal.SIGUSR1) == signal.SIG_DFL
+    finally:
+        faulthandler.unregister(signal.SIGUSR1)
+
+
+def test_stop(project):
+    assert not pytest_daemon.stop()
+    pytest_daemon.run(['--collect-only', '-p', 'no:cacheprovider'])
+    assert pytest_daemon.main(['--stop']) == 0
+    assert not os.path.exists(pytest_daemon.get_socket_path(str(project)))